@@ -0,0 +1,528 @@
+"""
+@file benchmark.py
+
+The functions in this file are used for timing the database operations & the map drawing, either on the data in the
+"data" folder or on seeded synthetic SIPRI data at several scales, and the start-up of main.py.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import db_ops
+import deal_store
+import map_drawing
+import sipri_info as si
+
+SCALES = {
+    "small": {"countries": 20, "deals": 2000, "years": (1990, 2020)},
+    "medium": {"countries": 80, "deals": 20000, "years": (1970, 2020)},
+    "large": {"countries": len(si.ENTITY_DICT), "deals": 100000, "years": (1950, 2020)}
+}
+"""
+Sizes of the synthetic datasets used by the benchmark suite.
+"""
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+"""
+Folder holding this file, Transparency.csv, Stockpiles.csv, Centroids.csv & Regions.csv.
+"""
+
+STARTUP_COMMANDS = {
+    "main.py --help": ["main.py", "--help"],
+    "import main": ["-c", "import main"],
+    "first prompt": ["-c", "import runpy, sys\n"
+                           "try:\n"
+                           "    runpy.run_path('main.py', run_name='__main__')\n"
+                           "except EOFError:\n"
+                           "    pass\n"
+                           "assert 'pandas.core.frame' not in sys.modules, 'pandas loaded before the first prompt'"],
+    "cached timelapse": ["-c", "import timelapse_cache; timelapse_cache.load_tl_map_dfs()"]
+}
+"""
+Python command lines timed by benchmark_startup: printing the usage, importing main.py, running it up to its first
+prompt (which fails on the closed stdin) & loading the cached timelapse DataFrames. The first prompt must be reached
+without loading pandas; "pandas" itself is always in sys.modules, as the placeholder of lazy_import.lazy_module, so
+the check is on one of its submodules.
+"""
+
+
+def _legacy_columns_csv(file, legacy_file) -> bytes:
+    """
+    Rewrites a tl_map_df CSV file with only the columns of a legacy one, leaving every value as written.
+
+    :param str file: Path of the CSV file
+    :param str legacy_file: Path of the CSV file written by perform_db_timelapse_ops_legacy
+    :return: CSV bytes
+    """
+    legacy_cols = pd.read_csv(legacy_file, nrows=0).columns
+    tl_map_df = pd.read_csv(file, dtype=str, keep_default_na=False)
+    return tl_map_df[legacy_cols].to_csv(index=False, lineterminator="\n").encode()
+
+
+def compare_timelapse_engines(starting_year=1992) -> dict:
+    """
+    Times the legacy row-by-row timelapse operations against the vectorized ones on the CSV files in the "data" folder,
+    and checks that both write the same tl_map_df CSV files. The legacy operations only sum "nrdel", so the columns of
+    the other measures are left out of the comparison.
+
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :return: Dictionary with the timings (in seconds) and whether the outputs are identical, for imports & exports
+    """
+    results = {}
+
+    for is_import in (True, False):
+        file = "data/tl_map_i_df.csv" if is_import else "data/tl_map_e_df.csv"
+
+        start = time.perf_counter()
+        db_ops.perform_db_timelapse_ops_legacy(is_import, starting_year)
+        legacy_time = time.perf_counter() - start
+        with open(file, "rb") as legacy_file:
+            legacy_bytes = legacy_file.read()
+        legacy_copy = file + ".legacy"
+        with open(legacy_copy, "wb") as legacy_file:
+            legacy_file.write(legacy_bytes)
+
+        start = time.perf_counter()
+        db_ops.perform_db_timelapse_ops(is_import, starting_year)
+        vectorized_time = time.perf_counter() - start
+        vectorized_bytes = _legacy_columns_csv(file, legacy_copy)
+        os.remove(legacy_copy)
+
+        results["imports" if is_import else "exports"] = {
+            "legacy_s": legacy_time,
+            "vectorized_s": vectorized_time,
+            "speedup": legacy_time / vectorized_time if vectorized_time else float("inf"),
+            "identical": legacy_bytes == vectorized_bytes
+        }
+
+    return results
+
+
+def compare_single_pass(starting_year=1992) -> dict:
+    """
+    Times & measures the peak memory of building both timelapse DataFrames with two perform_db_timelapse_ops calls
+    against a single perform_db_timelapse_ops_both pass, and checks that both write the same timelapse DataFrames. The
+    share columns are summed in a different order by each pass, so they are compared with a tolerance.
+
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :return: Dictionary with the timings (in seconds), peak memory (in bytes) and whether the outputs are identical
+    """
+    def measure(func):
+        tracemalloc.start()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak, [pd.read_csv(file) for file in ("data/tl_map_i_df.csv", "data/tl_map_e_df.csv")]
+
+    def same_outputs(outputs, other_outputs):
+        try:
+            for tl_map_df, other_tl_map_df in zip(outputs, other_outputs):
+                pd.testing.assert_frame_equal(tl_map_df, other_tl_map_df, check_exact=False)
+        except AssertionError:
+            return False
+        return True
+
+    # Make sure the deal store is built before either run
+    db_ops.deal_store.load_deal_store()
+
+    two_pass_s, two_pass_peak, two_pass_out = measure(lambda: (db_ops.perform_db_timelapse_ops(True, starting_year),
+                                                               db_ops.perform_db_timelapse_ops(False, starting_year)))
+    single_pass_s, single_pass_peak, single_pass_out = measure(
+        lambda: db_ops.perform_db_timelapse_ops_both(starting_year))
+
+    return {
+        "two_pass_s": two_pass_s,
+        "single_pass_s": single_pass_s,
+        "two_pass_peak_bytes": two_pass_peak,
+        "single_pass_peak_bytes": single_pass_peak,
+        "identical": same_outputs(two_pass_out, single_pass_out)
+    }
+
+
+def compare_parallel_scaling(worker_counts=(1, 2, 4, 8, 16), starting_year=1992) -> dict:
+    """
+    Times perform_db_timelapse_ops for imports with different numbers of worker processes, and checks that every run
+    writes the same CSV file.
+
+    :param worker_counts: Numbers of workers to try
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :return: Dictionary mapping each number of workers to its timing (in seconds) & speedup over the first one
+    """
+    db_ops.deal_store.load_deal_store()
+
+    results = {}
+    reference = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        db_ops.perform_db_timelapse_ops(True, starting_year, workers=workers)
+        elapsed = time.perf_counter() - start
+        with open("data/tl_map_i_df.csv", "rb") as tl_map_df_file:
+            output = tl_map_df_file.read()
+        reference = output if reference is None else reference
+
+        results[workers] = {
+            "seconds": elapsed,
+            "speedup": results[worker_counts[0]]["seconds"] / elapsed if results else 1.0,
+            "identical": output == reference
+        }
+
+    return results
+
+
+def compare_tl_map_figures(is_import=True) -> dict:
+    """
+    Times & measures the HTML size of the timelapse map built by px.choropleth with animation_frame against the map
+    built by map_drawing.build_tl_figure.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :return: Dictionary with the build times (in seconds) & HTML sizes (in bytes) of both figures
+    """
+    tl_map_df = db_ops.load_tl_map_df(is_import).sort_values(by="odat")
+
+    start = time.perf_counter()
+    px_fig = px.choropleth(tl_map_df,
+                           locations="iso_alpha",
+                           hover_name="sipri_name",
+                           color="All",
+                           range_color=[tl_map_df["All"].min(), tl_map_df["All"].max()],
+                           animation_group="sipri_name",
+                           animation_frame="odat",
+                           hover_data=list(si.WCATS_DICT.keys()),
+                           labels=dict(si.WCATS_DICT, **{"odat": "Year", "All": "Total"}),
+                           color_continuous_scale="dense",
+                           projection="robinson")
+    px_html = px_fig.to_html(include_plotlyjs="cdn")
+    px_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    frames_fig = map_drawing.build_tl_figure(tl_map_df, "", "dense")
+    frames_html = frames_fig.to_html(include_plotlyjs="cdn")
+    frames_s = time.perf_counter() - start
+
+    return {
+        "px_s": px_s,
+        "frames_s": frames_s,
+        "px_html_bytes": len(px_html.encode()),
+        "frames_html_bytes": len(frames_html.encode())
+    }
+
+
+def report_memory_footprint() -> pd.DataFrame:
+    """
+    Compares the memory footprint of the deal & timelapse DataFrames with pandas' default types against the compact
+    types of deal_store.DEAL_DTYPES & db_ops.TL_MAP_DTYPES.
+
+    :return: DataFrame with the bytes used by each frame before & after, and their ratio
+    """
+    raw_files = sorted(glob.glob("data/*_buyer.csv") + glob.glob("data/*_seller.csv"))
+    frames = {
+        "deals": (pd.concat([pd.read_csv(file, encoding='latin-1', index_col="tidn") for file in raw_files]),
+                  db_ops.deal_store.load_deal_store().df())
+    }
+    for is_import in (True, False):
+        file = "data/tl_map_i_df.csv" if is_import else "data/tl_map_e_df.csv"
+        frames["tl_map_i_df" if is_import else "tl_map_e_df"] = (pd.read_csv(file), db_ops.load_tl_map_df(is_import))
+
+    report = pd.DataFrame({name: {"before_bytes": before.memory_usage(deep=True).sum(),
+                                  "after_bytes": after.memory_usage(deep=True).sum()}
+                           for name, (before, after) in frames.items()}).T
+    report["ratio"] = report["after_bytes"] / report["before_bytes"]
+    return report.astype({"before_bytes": np.int64, "after_bytes": np.int64})
+
+
+def generate_synthetic_data(n_countries, n_deals, years=(1950, 2020), seed=0):
+    """
+    Writes seeded synthetic SIPRI data under the "data" folder of the current directory: one buyer & one seller CSV
+    file laid out like sipri_info.CSV_HEADER for each of the first n_countries entities of ENTITY_DICT. Every deal is
+    written to both its buyer's & its seller's file, as SIPRI does.
+
+    :param int n_countries: Number of countries with data
+    :param int n_deals: Number of deals
+    :param years: First & last order year
+    :param int seed: Seed of the random generator
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    codes = np.array([value[0] for value in si.ENTITY_DICT.values()][:n_countries], dtype=object)
+    wcats = np.array(list(si.WCATS_DICT), dtype=object)
+
+    # Buyer & seller are drawn from different offsets so that nobody sells to itself
+    buyers = rng.integers(0, len(codes), n_deals)
+    sellers = (buyers + rng.integers(1, max(len(codes), 2), n_deals)) % len(codes)
+    odat = rng.integers(years[0], years[1] + 1, n_deals)
+    nrdel = rng.geometric(0.05, n_deals)
+    tivunit = np.round(rng.gamma(2.0, 5.0, n_deals), 2)
+    header = si.CSV_HEADER.split(",")
+    deals_df = pd.DataFrame({col.strip(): "" for col in header}, index=range(n_deals))
+    deals_df = deals_df.assign(tidn=np.arange(1, n_deals + 1), buyercod=codes[buyers], sellercod=codes[sellers],
+                               odat=odat, onum=nrdel, ldat=np.minimum(odat + rng.integers(0, 6, n_deals), years[1]),
+                               wcat=wcats[rng.integers(0, len(wcats), n_deals)], desig2="Synthetic",
+                               desc="Synthetic", nrdel=nrdel, delyears=odat, buyer=codes[buyers],
+                               seller=codes[sellers], tivunit=tivunit, tivorder=np.round(tivunit * nrdel, 2),
+                               tivdel=np.round(tivunit * nrdel, 2))
+
+    os.makedirs("data", exist_ok=True)
+    for code_id, code in enumerate(codes):
+        for suffix, mask in (("_buyer.csv", buyers == code_id), ("_seller.csv", sellers == code_id)):
+            with open("data/" + code + suffix, "w") as csv_file:
+                csv_file.write(si.CSV_HEADER + "\n")
+                deals_df[mask].to_csv(csv_file, header=False, index=False, lineterminator="\n")
+
+    for code in [value[0] for value in si.ENTITY_DICT.values()][n_countries:]:
+        for suffix in ("_buyer.csv", "_seller.csv"):
+            with open("data/" + code + suffix, "w") as csv_file:
+                csv_file.write(si.CSV_HEADER)
+
+
+def _measure(func) -> dict:
+    """
+    Runs a function twice: once for its wall-clock time, once under tracemalloc for its peak memory.
+
+    :param func: Function without arguments
+    :return: Dictionary with "seconds" & "peak_bytes", or with "error" if the function raised
+    """
+    try:
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    except Exception as e:
+        return {"error": repr(e)}
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": seconds, "peak_bytes": peak}
+
+
+def run_scale(n_countries, n_deals, years, seed=0) -> dict:
+    """
+    Times every stage of the pipeline on a fresh synthetic dataset, in a temporary directory.
+
+    :param int n_countries: Number of countries with data
+    :param int n_deals: Number of deals
+    :param years: First & last order year
+    :param int seed: Seed of the random generator
+    :return: Dictionary mapping each stage to its measurements; map stages also report their "html_bytes"
+    """
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(prefix="gwtm_bench_")
+    results = {}
+    try:
+        os.chdir(tmp_dir)
+        for file in ("Transparency.csv", "Stockpiles.csv", "Centroids.csv", "Regions.csv"):
+            shutil.copy(os.path.join(REPO_DIR, file), file)
+        os.mkdir("plots")
+        generate_synthetic_data(n_countries, n_deals, years, seed)
+        deal_store._loaded_store = None
+
+        codes = [value[0] for value in si.ENTITY_DICT.values()]
+        results["ingest"] = _measure(deal_store.build_deal_store)
+        results["create_df"] = _measure(lambda: [db_ops.create_df(code, is_import)
+                                                 for code in codes for is_import in (True, False)])
+        results["perform_db_timelapse_ops"] = _measure(lambda: [db_ops.perform_db_timelapse_ops(is_import)
+                                                                for is_import in (True, False)])
+        results["load_tl_map_df"] = _measure(lambda: [db_ops.load_tl_map_df(is_import)
+                                                      for is_import in (True, False)])
+
+        tl_i_map_df, tl_e_map_df = db_ops.load_tl_map_df(True), db_ops.load_tl_map_df(False)
+        draws = {
+            "draw_tl_map (imports)": (lambda: map_drawing.draw_tl_map(tl_i_map_df, True, show=False),
+                                      "plots/imports_map.html"),
+            "draw_tl_map (exports)": (lambda: map_drawing.draw_tl_map(tl_e_map_df, False, show=False),
+                                      "plots/exports_map.html"),
+            "draw_transparency_map": (lambda: map_drawing.draw_transparency_map(db_ops.load_transparency_df(),
+                                                                                show=False),
+                                      "plots/transparency_map.html"),
+            "draw_stockpiles_map": (lambda: map_drawing.draw_stockpiles_map(db_ops.load_stockpiles_df(), show=False),
+                                    "plots/stockpiles_map.html"),
+            "draw_combined_ie_map": (lambda: map_drawing.draw_combined_ie_map(tl_i_map_df, tl_e_map_df, show=False),
+                                     "plots/combined_ie_map.html"),
+            "draw_combined_ie_map (net)": (lambda: map_drawing.draw_combined_ie_map(tl_i_map_df, tl_e_map_df,
+                                                                                    show=False, mode="net"),
+                                           "plots/combined_ie_map_net.html"),
+            "draw_flow_map": (lambda: map_drawing.draw_flow_map(db_ops.flow_map_df(), db_ops.load_centroids_df(),
+                                                                show=False),
+                              "plots/flow_map.html"),
+            "draw_region_map (imports)": (lambda: map_drawing.draw_region_map(True, show=False),
+                                          "plots/imports_region_map.html")
+        }
+        for stage, (func, html_file) in draws.items():
+            results[stage] = _measure(func)
+            if os.path.exists(html_file):
+                results[stage]["html_bytes"] = os.path.getsize(html_file)
+    finally:
+        os.chdir(cwd)
+        deal_store._loaded_store = None
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return results
+
+
+def run_suite(scales=None, seed=0) -> dict:
+    """
+    Runs the benchmark at several scales.
+
+    :param scales: Names of the SCALES to run (default all)
+    :param int seed: Seed of the random generator
+    :return: Dictionary mapping each scale to the results of run_scale
+    """
+    results = {}
+    for name in (SCALES if scales is None else scales):
+        print("Benchmarking", name)
+        scale = SCALES[name]
+        results[name] = run_scale(scale["countries"], scale["deals"], scale["years"], seed)
+    return results
+
+
+def find_regressions(results, baseline, tolerance=0.25) -> list:
+    """
+    Compares benchmark results against a baseline.
+
+    :param dict results: Results of run_suite
+    :param dict baseline: Earlier results of run_suite
+    :param float tolerance: Allowed relative increase of time, peak memory & HTML size (default 25%)
+    :return: List of messages, one per stage & metric that got worse than allowed or started failing
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for stage, measurements in stages.items():
+            before = baseline.get(scale, {}).get(stage)
+            if before is None:
+                continue
+            if "error" in measurements and "error" not in before:
+                regressions.append(f"{scale} / {stage}: now fails with {measurements['error']}")
+                continue
+            for metric in ("seconds", "peak_bytes", "html_bytes"):
+                if metric in measurements and before.get(metric) and \
+                        measurements[metric] > before[metric] * (1 + tolerance):
+                    regressions.append(f"{scale} / {stage}: {metric} {before[metric]:.4g} -> "
+                                       f"{measurements[metric]:.4g} (+{measurements[metric] / before[metric] - 1:.0%})")
+    return regressions
+
+
+def import_time_report(code="import main", top=20) -> list:
+    """
+    Reports which modules take the longest to import, from the output of `python -X importtime`.
+
+    :param str code: Python code to run in a fresh interpreter in REPO_DIR (default "import main")
+    :param int top: Number of modules to report (default 20)
+    :return: List of dictionaries with the "module", its own import time "self_us" & its import time including the
+        modules it imports "cumulative_us", in microseconds, slowest first
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_DIR, capture_output=True,
+                            text=True).stderr
+
+    modules = []
+    for line in stderr.splitlines():
+        fields = line[len("import time:"):].split("|") if line.startswith("import time:") else []
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            modules.append({"module": fields[2].strip(), "self_us": int(fields[0]), "cumulative_us": int(fields[1])})
+    modules.sort(key=lambda module: module["cumulative_us"], reverse=True)
+
+    print(f"{'module':<40}{'self':>10}{'cumulative':>12}  ({code})")
+    for module in modules[:top]:
+        print(f"{module['module']:<40}{module['self_us'] / 1000:9.1f}ms{module['cumulative_us'] / 1000:10.1f}ms")
+    return modules[:top]
+
+
+def benchmark_startup(repeats=5) -> dict:
+    """
+    Times STARTUP_COMMANDS in fresh interpreters in REPO_DIR, with a closed stdin. The cached timelapse is skipped if
+    there is none. A command that fails, e.g. main.py loading pandas before its first prompt, raises
+    subprocess.CalledProcessError.
+
+    :param int repeats: Runs of each command (default 5)
+    :return: Dictionary mapping each command to its fastest & median wall-clock "best_s" & "median_s"
+    """
+    results = {}
+    for name, command in STARTUP_COMMANDS.items():
+        if name == "cached timelapse" and not os.path.exists(os.path.join(REPO_DIR, db_ops.tl_file(True, "df.csv"))):
+            continue
+
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + command, cwd=REPO_DIR, stdin=subprocess.DEVNULL, capture_output=True,
+                           check=True)
+            seconds.append(time.perf_counter() - start)
+        results[name] = {"best_s": min(seconds), "median_s": float(np.median(seconds))}
+        print(f"{name:<24}best {results[name]['best_s']:.3f}s, median {results[name]['median_s']:.3f}s")
+    return results
+
+
+def compare_on_data():
+    """
+    Prints the comparisons that run on the data in the "data" folder.
+
+    :return: None
+    """
+    for name, result in compare_timelapse_engines().items():
+        print(f"{name}: legacy {result['legacy_s']:.2f}s, vectorized {result['vectorized_s']:.2f}s "
+              f"({result['speedup']:.1f}x), identical output: {result['identical']}")
+
+    result = compare_single_pass()
+    print(f"two passes {result['two_pass_s']:.2f}s / {result['two_pass_peak_bytes'] / 2 ** 20:.1f} MiB, "
+          f"single pass {result['single_pass_s']:.2f}s / {result['single_pass_peak_bytes'] / 2 ** 20:.1f} MiB, "
+          f"identical output: {result['identical']}")
+
+    for workers, result in compare_parallel_scaling().items():
+        print(f"{workers} workers: {result['seconds']:.2f}s ({result['speedup']:.1f}x), "
+              f"identical output: {result['identical']}")
+
+    result = compare_tl_map_figures()
+    print(f"timelapse map: px {result['px_s']:.2f}s / {result['px_html_bytes']} bytes, "
+          f"frames {result['frames_s']:.2f}s / {result['frames_html_bytes']} bytes")
+
+    print(report_memory_footprint())
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks the weapons tracking map pipeline.")
+    parser.add_argument("--suite", action="store_true",
+                        help="run the synthetic-data suite instead of the comparisons on the \"data\" folder")
+    parser.add_argument("--scales", nargs="*", choices=list(SCALES), help="scales of the suite (default all)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data (default 0)")
+    parser.add_argument("--out", default="bench_results.json", help="file to write the suite results to")
+    parser.add_argument("--baseline", help="earlier results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative increase (default 0.25)")
+    parser.add_argument("--startup", action="store_true",
+                        help="report the import times of main.py & time its start-up instead")
+    args = parser.parse_args()
+
+    if args.startup:
+        import_time_report()
+        benchmark_startup()
+    elif not args.suite:
+        compare_on_data()
+    else:
+        suite_results = run_suite(args.scales, args.seed)
+        with open(args.out, "w") as results_file:
+            json.dump(suite_results, results_file, indent=1)
+        print(json.dumps(suite_results, indent=1))
+
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                found = find_regressions(suite_results, json.load(baseline_file), args.tolerance)
+            for message in found:
+                print("REGRESSION", message)
+            raise SystemExit(1 if found else 0)
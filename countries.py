@@ -0,0 +1,103 @@
+"""
+@file countries.py
+
+The data structures & functions in this file are used for identifying countries by dense integer IDs, so that the SIPRI
+transfers, the UNROCA transparency scores & the stockpiles join on arrays instead of on names & codes, and for
+reporting the country codes that do not join.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import numpy as np
+import pandas as pd
+
+import sipri_info as si
+
+KINDS = ("name", "sipri", "iso")
+"""
+Kinds of country keys: name of ENTITY_DICT, SIPRI code & ISO code.
+"""
+
+NON_ISO_CODES = {"KSV"}
+"""
+"ISO" codes of ENTITY_DICT that are not ISO 3166-1 alpha-3 codes, so Plotly's maps cannot place them.
+"""
+
+
+class CountryTable:
+    """
+    Country dimension: the countries of ENTITY_DICT numbered 0..n-1 in its order, which is also the order of the
+    countries in db_ops.gather_yearly_counts & timelapse_query.TimelapseQuery. "names", "sipri" & "iso" map IDs to
+    keys; ids() maps keys back to IDs.
+    """
+
+    def __init__(self, entity_dict=si.ENTITY_DICT):
+        """
+        :param dict entity_dict: Country names mapped to their (SIPRI code, ISO code) (default ENTITY_DICT)
+        """
+        self.names = np.array(list(entity_dict), dtype=object)
+        self.sipri = np.array([value[0] for value in entity_dict.values()], dtype=object)
+        self.iso = np.array([value[1] for value in entity_dict.values()], dtype=object)
+        self._indexes = {"name": pd.Index(self.names), "sipri": pd.Index(self.sipri), "iso": pd.Index(self.iso)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def ids(self, keys, kind="iso") -> np.ndarray:
+        """
+        Looks up the IDs of some countries.
+
+        :param keys: Names or codes of the countries
+        :param str kind: One of KINDS (default "iso")
+        :return: Array of IDs, -1 for the keys not in the table
+        """
+        return self._indexes[kind].get_indexer(pd.Index(np.asarray(keys, dtype=object)))
+
+    def convert(self, keys, from_kind, to_kind) -> np.ndarray:
+        """
+        Converts country keys from one kind to another, e.g. SIPRI codes to ISO codes.
+
+        :param keys: Names or codes of the countries
+        :param str from_kind: One of KINDS
+        :param str to_kind: One of KINDS
+        :return: Array of keys, None for the keys not in the table
+        """
+        ids = self.ids(keys, from_kind)
+        values = {"name": self.names, "sipri": self.sipri, "iso": self.iso}[to_kind]
+        return np.where(ids >= 0, values[ids], None)
+
+    def unmatched(self, keys, kind="iso") -> list:
+        """
+        Finds the keys that are not in the table.
+
+        :param keys: Names or codes of the countries
+        :param str kind: One of KINDS (default "iso")
+        :return: Sorted list of the distinct unmatched keys
+        """
+        keys = np.asarray(keys, dtype=object)
+        return sorted(set(keys[self.ids(keys, kind) < 0].tolist()))
+
+
+COUNTRIES = CountryTable()
+"""
+Country dimension of ENTITY_DICT.
+"""
+
+
+def validate(datasets) -> dict:
+    """
+    Reports the country keys that do not join with COUNTRIES, and the ISO codes of COUNTRIES that maps cannot place.
+
+    :param dict datasets: Names of the datasets mapped to their (keys, kind), e.g.
+        {"Transparency.csv": (transparency_df.index, "iso")}
+    :return: Names of the datasets (and "ISO 3166") mapped to their unmatched keys, for those with any
+    """
+    report = {name: COUNTRIES.unmatched(keys, kind) for name, (keys, kind) in datasets.items()}
+    report["ISO 3166"] = sorted(set(COUNTRIES.iso) & NON_ISO_CODES)
+
+    report = {name: keys for name, keys in report.items() if keys}
+    for name, keys in report.items():
+        print("Unmatched country codes in " + name + ": " + ", ".join(keys))
+    return report
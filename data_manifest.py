@@ -0,0 +1,189 @@
+"""
+@file data_manifest.py
+
+The functions in this file are used for keeping track of the contents of the downloaded SIPRI files, so that a refresh
+only rewrites & reprocesses the files that changed. The manifest on disk never vouches for a file that was replaced
+since: the entry of a file is dropped before the file is replaced and saved again afterwards, so an interrupted
+download leaves files that are hashed again instead of trusted.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+MANIFEST_FILE = "data/manifest.json"
+"""
+Manifest of the SIPRI files under the "data" folder.
+"""
+
+_lock = threading.RLock()
+
+
+def file_key(sipri_code, is_seller) -> str:
+    """
+    Gets the manifest key (also the file name without extension) of a country's seller/buyer file.
+
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True for the seller file, False for the buyer file
+    :return: Manifest key
+    """
+    return sipri_code + ("_seller" if is_seller else "_buyer")
+
+
+def load_manifest() -> dict:
+    """
+    Loads the manifest of the "data" folder.
+
+    :return: Dictionary mapping each file key to its "sha256", "rows" & "fetched" entries; empty if there is no manifest
+    """
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest):
+    """
+    Saves the manifest of the "data" folder.
+
+    :param dict manifest: Manifest to save
+    :return: None
+    """
+    # The download threads update & save the manifest concurrently
+    with _lock:
+        tmp_file = MANIFEST_FILE + ".tmp"
+        with open(tmp_file, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(tmp_file, MANIFEST_FILE)
+
+
+def content_hash(content) -> str:
+    """
+    Hashes the contents of a file.
+
+    :param bytes content: File contents
+    :return: SHA-256 hex digest
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_hash(path) -> str:
+    """
+    Hashes a file on disk.
+
+    :param str path: Path of the file
+    :return: SHA-256 hex digest
+    """
+    with open(path, "rb") as f:
+        return content_hash(f.read())
+
+
+def input_hash(manifest, sipri_code, is_seller) -> str:
+    """
+    Gets the hash of a country's seller/buyer file, from the manifest if it is listed there.
+
+    :param dict manifest: Manifest of the "data" folder
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True for the seller file, False for the buyer file
+    :return: SHA-256 hex digest, or None if the file does not exist
+    """
+    key = file_key(sipri_code, is_seller)
+    path = "data/" + key + ".csv"
+    if not os.path.exists(path):
+        return None
+    if key in manifest:
+        return manifest[key]["sha256"]
+    return file_hash(path)
+
+
+def write_if_changed(manifest, sipri_code, is_seller, content) -> bool:
+    """
+    Writes a country's seller/buyer file unless it already holds the same content, and records it in the manifest.
+
+    :param dict manifest: Manifest of the "data" folder, updated in place
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True for the seller file, False for the buyer file
+    :param bytes content: New file contents
+    :return: True if the file was (re)written, False if it was left untouched
+    """
+    key = file_key(sipri_code, is_seller)
+    path = "data/" + key + ".csv"
+    new_hash = content_hash(content)
+    changed = input_hash(manifest, sipri_code, is_seller) != new_hash
+
+    if changed:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as csv_file:
+            csv_file.write(content)
+        _forget(manifest, key)
+        os.replace(tmp_path, path)
+
+    _record(manifest, key, new_hash, max(len(content.splitlines()) - 1, 0), save=changed)
+    return changed
+
+
+def replace_if_changed(manifest, sipri_code, is_seller, tmp_path, new_hash, rows) -> bool:
+    """
+    Moves a fully written temporary file over a country's seller/buyer file unless that file already holds the same
+    content, in which case the temporary file is deleted, and records it in the manifest.
+
+    :param dict manifest: Manifest of the "data" folder, updated in place
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True for the seller file, False for the buyer file
+    :param str tmp_path: Path of the temporary file, in the "data" folder
+    :param str new_hash: SHA-256 hex digest of the temporary file
+    :param int rows: Number of data rows in the temporary file
+    :return: True if the file was (re)placed, False if it was left untouched
+    """
+    key = file_key(sipri_code, is_seller)
+    changed = input_hash(manifest, sipri_code, is_seller) != new_hash
+
+    if changed:
+        _forget(manifest, key)
+        os.replace(tmp_path, "data/" + key + ".csv")
+    else:
+        os.remove(tmp_path)
+
+    _record(manifest, key, new_hash, rows, save=changed)
+    return changed
+
+
+def _forget(manifest, key):
+    """
+    Drops the entry of a file that is about to be replaced and saves the manifest, so that the file is hashed again
+    if the run stops before it is recorded.
+
+    :param dict manifest: Manifest of the "data" folder, updated in place
+    :param str key: Manifest key of the file
+    :return: None
+    """
+    with _lock:
+        if manifest.pop(key, None) is not None:
+            save_manifest(manifest)
+
+
+def _record(manifest, key, new_hash, rows, save=False):
+    """
+    Records the current content of a file in the manifest.
+
+    :param dict manifest: Manifest of the "data" folder, updated in place
+    :param str key: Manifest key of the file
+    :param str new_hash: SHA-256 hex digest of the file
+    :param int rows: Number of data rows in the file
+    :param boolean save: True to also save the manifest (default False)
+    :return: None
+    """
+    with _lock:
+        manifest[key] = {
+            "sha256": new_hash,
+            "rows": rows,
+            "fetched": datetime.now(timezone.utc).isoformat(timespec="seconds")
+        }
+        if save:
+            save_manifest(manifest)
@@ -8,9 +8,19 @@ The functions in this file are used for performing specific operations on databa
 @author Jack Ayvazian
 """
 
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
 import numpy as np
 import pandas as pd
 
+import countries
+import data_manifest as dm
+import deal_store
+import flow_index
+import instrumentation
 import sipri_info as si
 
 EXTRA_COLS = ["sipri_name", "sipri_alpha", "iso_alpha"]
@@ -18,34 +28,674 @@ EXTRA_COLS = ["sipri_name", "sipri_alpha", "iso_alpha"]
 Important extra columns used for processing data for each country.
 """
 
+TIMELAPSE_VERSION = 4
+"""
+Version of the timelapse database operations. Increase it whenever a change alters their output, so that cached
+timelapse DataFrames are rebuilt.
+"""
+
+MEASURES = si.MEASURES
+"""
+Deal columns summed by the timelapse operations; see sipri_info.MEASURES.
+"""
+
+METRICS = si.METRICS
+"""
+Metrics derived from the running totals of each measure; see sipri_info.METRICS.
+"""
+
+MIN_CHUNK_COUNTRIES = 96
+"""
+Fewest countries gather_yearly_counts hands to a worker process. Reading a country from the deal store takes about a
+millisecond, so smaller chunks cost more to start & collect than they save; when the countries do not fill two chunks,
+they are aggregated in this process.
+"""
+
+TL_MAP_DTYPES = {
+    "sipri_name": "category",
+    "sipri_alpha": "category",
+    "iso_alpha": "category",
+    "odat": np.int16,
+    "AC": np.int32,
+    "AR": np.int32,
+    "AV": np.int32,
+    "EN": np.int32,
+    "GR": np.int32,
+    "MI": np.int32,
+    "SH": np.int32,
+    "OT": np.int32,
+    "NW": np.int32,
+    "SA": np.int32,
+    "AD": np.int32,
+    "All": np.int32,
+    "yearly": np.int32,
+    "rolling_3": np.int32,
+    "rolling_5": np.int32,
+    "yoy_change": np.int32
+}
+"""
+Column types of a timelapse DataFrame once it is loaded for drawing.
+"""
+
+
+def measure_column(col, measure) -> str:
+    """
+    Gets the name of a timelapse column for a measure.
+
+    :param str col: Weapon category or "All"
+    :param str measure: One of MEASURES
+    :return: Column name
+    """
+    return col if measure == "nrdel" else col + "_" + measure
+
+
+def compact_tl_map_df(tl_map_df) -> pd.DataFrame:
+    """
+    Applies TL_MAP_DTYPES to the columns of a timelapse DataFrame.
+
+    :param pd.DataFrame tl_map_df: Timelapse DataFrame
+    :return: Timelapse DataFrame with categorical names & codes, int16 years and int32 counts
+    """
+    return tl_map_df.astype({col: dtype for col, dtype in TL_MAP_DTYPES.items() if col in tl_map_df.columns})
+
 
 def create_df(sipri_code, is_import) -> pd.DataFrame:
     """
-    Creates the buyer/seller DataFrame of the given SIPRI entity from corresponding CSV files.
+    Creates the buyer/seller DataFrame of the given SIPRI entity from its slice of the deal store.
 
     :param str sipri_code: SIPRI code of chosen country
     :param boolean is_import: True if data is imports, False if exports
     :return: DataFrame for buyer or seller
     """
-    if is_import:
-        df = pd.read_csv("data//" + sipri_code + "_buyer.csv", encoding='latin-1', index_col="tidn")
-    else:
-        df = pd.read_csv("data//" + sipri_code + "_seller.csv", encoding='latin-1', index_col="tidn")
+    store = deal_store.load_deal_store()
+    return store.df(store.rows(sipri_code, is_import))
+
+
+def gather_yearly_counts(is_import, starting_year=1992, names=None, workers=1) -> pd.DataFrame:
+    """
+    Reads the deals of the given countries and sums their delivered weapons by year & weapon category.
+
+    With several workers, the countries are split into contiguous chunks of at least MIN_CHUNK_COUNTRIES that are
+    aggregated in separate processes; the partial counts are concatenated in chunk order, so the result does not depend
+    on which worker finishes first.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param names: Names of the countries to read (default all of ENTITY_DICT)
+    :param int workers: Number of worker processes (default 1, which aggregates in this process)
+    :return: DataFrame with one row per ("sipri_name", "odat", "wcat") and the sums of the MEASURES
+    """
+    names = list(si.ENTITY_DICT if names is None else names)
+    chunk_size = max(MIN_CHUNK_COUNTRIES, -(-len(names) // (workers * 4)))
+
+    if workers > 1 and len(names) >= 2 * chunk_size:
+        # Build the deal store once, so that every worker only memory-maps it
+        deal_store.load_deal_store()
+
+        chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            partials = [instrumentation.merge(traced) for traced in
+                        executor.map(instrumentation.traced_call, repeat(gather_yearly_counts), repeat(is_import),
+                                     repeat(starting_year), chunks)]
+
+        partials = [partial for partial in partials if not partial.empty]
+        if not partials:
+            return pd.DataFrame(columns=["sipri_name", "odat", "wcat"] + MEASURES)
+        return pd.concat(partials, ignore_index=True)
+
+    country_dfs = []
+    for key in names:
+        country_df = create_df(si.ENTITY_DICT[key][0], is_import)
+        country_df = country_df.loc[country_df["odat"] >= starting_year, ["odat", "wcat"] + MEASURES]
+
+        if not country_df.empty:
+            country_dfs.append(country_df.assign(sipri_name=key))
+
+    instrumentation.count("countries_read", len(names))
+    if not country_dfs:
+        return pd.DataFrame(columns=["sipri_name", "odat", "wcat"] + MEASURES)
+
+    with instrumentation.stage("pivot", countries=len(country_dfs)):
+        deals_df = pd.concat(country_dfs, ignore_index=True)
+        counts_df = deals_df.groupby(["sipri_name", "odat", "wcat"], sort=False, observed=True)[MEASURES].sum()
+    instrumentation.count("deals_aggregated", len(deals_df))
+    return counts_df.reset_index().astype({"wcat": str})
+
+
+def gather_yearly_counts_both(starting_year=1992):
+    """
+    Sums the delivered weapons of every country by year & weapon category, for imports & exports at once.
+
+    Each deal is taken only once from the deal store, then counted for its buyer (imports) and its seller (exports) in
+    a single groupby over (direction, country, year, wcat). This relies on the "buyercod"/"sellercod" of a deal being
+    the SIPRI codes of ENTITY_DICT.
+
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :return: Tuple of the import & export yearly counts, laid out like gather_yearly_counts
+    """
+    store = deal_store.load_deal_store()
+    rows = store.unique_rows()
+    rows = rows[np.asarray(store.arrays["odat"])[rows] >= starting_year]
+
+    # Stack the buyer view (direction 0) over the seller view (direction 1) of the deals
+    country_ids = np.concatenate([np.asarray(store.arrays["buyercod"])[rows],
+                                  np.asarray(store.arrays["sellercod"])[rows]])
+    stacked = pd.DataFrame({
+        "direction": np.repeat(np.array([0, 1], dtype=np.int8), len(rows)),
+        "country": country_ids,
+        "odat": np.tile(np.asarray(store.arrays["odat"])[rows], 2),
+        "wcat": np.tile(np.asarray(store.arrays["wcat"])[rows], 2),
+        **{measure: np.tile(np.asarray(store.arrays[measure])[rows], 2) for measure in MEASURES}
+    })
+    stacked = stacked[(stacked["country"] >= 0) & (stacked["country"] < len(si.ENTITY_DICT)) & (stacked["wcat"] >= 0)]
+
+    with instrumentation.stage("pivot", deals=len(rows)):
+        counts_df = stacked.groupby(["direction", "country", "odat", "wcat"], sort=False)[MEASURES].sum().reset_index()
+    instrumentation.count("deals_aggregated", len(stacked))
+    counts_df["sipri_name"] = np.array(list(si.ENTITY_DICT), dtype=object)[counts_df["country"].to_numpy()]
+    counts_df["wcat"] = np.asarray(store.wcats, dtype=object)[counts_df["wcat"].to_numpy()]
+    counts_df["odat"] = counts_df["odat"].astype(np.int64)
 
-    return df
+    cols = ["sipri_name", "odat", "wcat"] + MEASURES
+    return (counts_df.loc[counts_df["direction"] == 0, cols].reset_index(drop=True),
+            counts_df.loc[counts_df["direction"] == 1, cols].reset_index(drop=True))
 
 
-def perform_db_timelapse_ops(is_import, starting_year=1992) -> pd.DataFrame:
+def input_hashes(manifest, is_import) -> dict:
+    """
+    Gets the hashes of the files a timelapse is built from, which tell the countries to read again after a refresh.
+
+    :param dict manifest: Manifest of the "data" folder
+    :param boolean is_import: True for the buyer files, False for the seller files
+    :return: Dictionary mapping every country of ENTITY_DICT to the hash of its file (None if it has none)
+    """
+    return {key: dm.input_hash(manifest, value[0], not is_import) for key, value in si.ENTITY_DICT.items()}
+
+
+def perform_db_timelapse_ops_both(starting_year=1992, ending_year=si.LAST_YEAR):
+    """
+    Performs the database operations to accumulate imports & exports over time, reading every deal only once.
+
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param int ending_year: Last year of the timelapse (default sipri_info.LAST_YEAR)
+    :return: Tuple of the import & export map DataFrames
+    """
+    manifest = dm.load_manifest()
+
+    results = []
+    for is_import, counts_df in zip((True, False), gather_yearly_counts_both(starting_year)):
+        results.append(_finish_timelapse(counts_df, is_import, starting_year, input_hashes(manifest, is_import),
+                                         ending_year))
+
+    return tuple(results)
+
+
+def update_db_timelapse_ops_both(starting_year=1992, ending_year=None, workers=1):
+    """
+    Brings both the import & export timelapse DataFrames up to date, with update_db_timelapse_ops if they were built
+    before and with a single perform_db_timelapse_ops_both pass otherwise.
+
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param int ending_year: Last year of the timelapse (default default_ending_year())
+    :param int workers: Number of worker processes reading the changed countries (default 1); see gather_yearly_counts
+    :return: Tuple of the import & export map DataFrames
+    """
+    ending_year = default_ending_year() if ending_year is None else ending_year
+    states = [_load_tl_state(is_import) for is_import in (True, False)]
+    if any(state is None or (state["starting_year"], state["ending_year"]) != (starting_year, ending_year)
+           for state in states):
+        return perform_db_timelapse_ops_both(starting_year, ending_year)
+
+    return (update_db_timelapse_ops(True, starting_year, ending_year, workers),
+            update_db_timelapse_ops(False, starting_year, ending_year, workers))
+
+
+def perform_db_timelapse_ops(is_import, starting_year=1992, workers=1, ending_year=si.LAST_YEAR) -> pd.DataFrame:
     """
     Performs the database operations to accumulate imports/exports over time.
 
+    All countries are concatenated into one deal table and aggregated in a single groupby over (country, year, wcat).
+    The result is reindexed onto a dense country x year grid, where running totals come from a cumulative sum and
+    missing years are forward-filled. The CSV written to the "data" folder is identical to the one written by
+    perform_db_timelapse_ops_legacy.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param int workers: Number of worker processes reading & aggregating the countries (default 1)
+    :param int ending_year: Last year of the timelapse (default sipri_info.LAST_YEAR)
+    :return: Map DataFrame for drawing a choropleth map of imports & exports.
+    """
+    manifest = dm.load_manifest()
+    inputs = input_hashes(manifest, is_import)
+
+    counts_df = gather_yearly_counts(is_import, starting_year, workers=workers)
+
+    return _finish_timelapse(counts_df, is_import, starting_year, inputs, ending_year)
+
+
+def update_db_timelapse_ops(is_import, starting_year=1992, ending_year=None, workers=1) -> pd.DataFrame:
+    """
+    Brings the timelapse DataFrame up to date after a refresh of the "data" folder. Only the countries whose
+    buyer/seller file changed since the last run are read again; their yearly counts are spliced into the stored ones
+    before the timelapse is rebuilt. Falls back to perform_db_timelapse_ops when there is nothing to update from.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param int ending_year: Last year of the timelapse (default default_ending_year())
+    :param int workers: Number of worker processes reading the countries (default 1); see gather_yearly_counts
+    :return: Map DataFrame for drawing a choropleth map of imports & exports.
+    """
+    ending_year = default_ending_year() if ending_year is None else ending_year
+    state = _load_tl_state(is_import)
+    if state is None or (state["starting_year"], state["ending_year"]) != (starting_year, ending_year):
+        return perform_db_timelapse_ops(is_import, starting_year, workers, ending_year)
+
+    manifest = dm.load_manifest()
+    inputs = input_hashes(manifest, is_import)
+    changed = [key for key in si.ENTITY_DICT if state["inputs"].get(key) != inputs[key]]
+    instrumentation.count("countries_changed", len(changed))
+
+    if not changed and set(state["inputs"]) == set(inputs):
+        return load_tl_map_df(is_import)
+
+    counts_df = pd.read_csv(tl_file(is_import, "counts.csv"), keep_default_na=False, na_values=[""])
+    counts_df = counts_df[counts_df["sipri_name"].isin(set(si.ENTITY_DICT) - set(changed))]
+    counts_df = pd.concat([counts_df, gather_yearly_counts(is_import, starting_year, changed, workers)],
+                          ignore_index=True)
+
+    return _finish_timelapse(counts_df, is_import, starting_year, inputs, ending_year)
+
+
+def append_db_timelapse_years_both(ending_year, starting_year=1992):
+    """
+    Adds the years after the last stored year to both the import & export timelapse DataFrames; see
+    append_db_timelapse_years.
+
+    :param int ending_year: New last year of the timelapse
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :return: Tuple of the import & export map DataFrames
+    """
+    return (append_db_timelapse_years(True, ending_year, starting_year),
+            append_db_timelapse_years(False, ending_year, starting_year))
+
+
+def append_db_timelapse_years(is_import, ending_year, starting_year=1992) -> pd.DataFrame:
+    """
+    Adds the years after the last stored year, up to ending_year, to the timelapse DataFrame without recomputing the
+    earlier years: only the deals of the new years are counted, each country's running totals carry on from its last
+    stored row, and the new rows are appended to the stored CSV files. The earlier rows are left as they are, even if
+    the deals of earlier years changed since; use update_db_timelapse_ops for those.
+
+    Falls back to perform_db_timelapse_ops when there is no stored timelapse to extend, or when the new years bring a
+    weapon category the stored timelapse has no column for.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int ending_year: New last year of the timelapse
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :return: Map DataFrame for drawing a choropleth map of imports & exports.
+    """
+    state = _load_tl_state(is_import)
+    if state is None or state["starting_year"] != starting_year:
+        return perform_db_timelapse_ops(is_import, starting_year, ending_year=ending_year)
+    if ending_year <= state["ending_year"]:
+        return load_tl_map_df(is_import)
+
+    first_year = state["ending_year"] + 1
+    manifest = dm.load_manifest()
+    inputs = input_hashes(manifest, is_import)
+
+    counts_df = gather_yearly_counts(is_import, first_year)
+    counts_df = counts_df[counts_df["odat"] <= ending_year]
+    stored_df = pd.read_csv(tl_file(is_import, "df.csv"))
+
+    new_df = None if stored_df.empty else _extend_timelapse(stored_df, counts_df, first_year, ending_year)
+    if new_df is None:
+        print("Nothing to extend; rebuilding every year")
+        return perform_db_timelapse_ops(is_import, starting_year, ending_year=ending_year)
+
+    with instrumentation.stage("csv_write", file=tl_file(is_import, "df.csv"), rows=len(new_df)):
+        new_df[stored_df.columns].to_csv(tl_file(is_import, "df.csv"), mode="a", header=False, index=False)
+        counts_cols = pd.read_csv(tl_file(is_import, "counts.csv"), nrows=0).columns
+        counts_df[counts_cols].to_csv(tl_file(is_import, "counts.csv"), mode="a", header=False, index=False)
+    _save_tl_state(is_import, starting_year, ending_year, inputs)
+    print(len(new_df), "rows appended for", first_year, "-", ending_year)
+
+    return load_tl_map_df(is_import)
+
+
+def carry_forward(present, carried_in=None) -> tuple:
+    """
+    Lays out the rows of a timelapse over a window of years: a country gets a row for every year from its first year
+    with deals in the window on (every year if it carries a row in from before the window), showing the weapon
+    category sums of the latest year with deals at or before the row's year.
+
+    :param np.ndarray present: Country x year boolean array, True where the country has deals in the window
+    :param np.ndarray carried_in: Boolean array, True for the countries carrying a row in from before the window
+        (default none)
+    :return: Tuple of the country & year positions of the rows, in (country, year) order, and of the position of the
+        latest year with deals of each row (-1 where the row carried in is shown)
+    """
+    latest = np.maximum.accumulate(np.where(present, np.arange(present.shape[1]), -1), axis=1)
+    has_row = latest >= 0 if carried_in is None else (latest >= 0) | carried_in[:, None]
+    country, year = np.nonzero(has_row)
+    return country, year, latest[country, year]
+
+
+def _extend_timelapse(stored_df, counts_df, first_year, ending_year):
+    """
+    Builds the rows of the years after a stored timelapse DataFrame, as timelapse_from_deals would have: each country
+    with stored rows or new deals gets a row for every new year (from its first new deal on for countries without
+    stored rows), with the weapon category sums of the latest year with deals (the stored last row before any) and
+    running totals carried on from the stored last row.
+
+    :param pd.DataFrame stored_df: Stored timelapse DataFrame, as written to tl_map_*_df.csv, ending at first_year - 1
+    :param pd.DataFrame counts_df: Yearly counts of the new years, laid out like gather_yearly_counts
+    :param int first_year: First new year
+    :param int ending_year: Last new year
+    :return: DataFrame of the new rows with the columns of stored_df (float numeric columns, as written), in
+        (country, year) order, or None if counts_df has a weapon category stored_df has no column for
+    """
+    # The weapon category columns of "nrdel" are those without a measure suffix, besides "odat", "All" & the metrics
+    cols = list(stored_df.columns)
+    suffixes = tuple("_" + measure for measure in MEASURES if measure != "nrdel")
+    wcats = [col for col in cols[len(EXTRA_COLS):]
+             if col not in ["odat", "All"] + METRICS and not col.endswith(suffixes)]
+    if not set(counts_df["wcat"].astype(str)) <= set(wcats):
+        return None
+
+    last_df = stored_df[stored_df["odat"] == first_year - 1]
+    present_names = set(last_df["sipri_name"]) | set(counts_df["sipri_name"])
+    names = np.array([name for name in si.ENTITY_DICT if name in present_names], dtype=object)
+    ids = {name: i for i, name in enumerate(names)}
+    years = np.arange(first_year, ending_year + 1)
+
+    country = counts_df["sipri_name"].map(ids).to_numpy(dtype=np.int64)
+    year = counts_df["odat"].to_numpy(dtype=np.int64) - first_year
+    wcat = counts_df["wcat"].astype(str).map({wcat: i for i, wcat in enumerate(wcats)}).to_numpy(dtype=np.int64)
+    stored = last_df["sipri_name"].map(ids).to_numpy(dtype=np.int64)
+
+    present = np.zeros((len(names), len(years)), dtype=bool)
+    present[country, year] = True
+    has_stored = np.zeros(len(names), dtype=bool)
+    has_stored[stored] = True
+    row_country, row_year, row_latest = carry_forward(present, has_stored)
+
+    sipri_codes = np.array([si.ENTITY_DICT[name][0] for name in names], dtype=object)
+    iso_codes = np.array([si.ENTITY_DICT[name][1] for name in names], dtype=object)
+    new_df = pd.DataFrame({"sipri_name": names[row_country], "sipri_alpha": sipri_codes[row_country],
+                           "iso_alpha": iso_codes[row_country], "odat": years[row_year].astype(np.float64)})
+    for measure in MEASURES:
+        total_col = measure_column("All", measure)
+        if total_col not in cols:
+            continue
+        wcat_cols = [measure_column(wcat, measure) for wcat in wcats]
+
+        yearly = np.zeros((len(names), len(years), len(wcats)))
+        np.add.at(yearly, (country, year, wcat), np.nan_to_num(counts_df[measure].to_numpy(dtype=np.float64)))
+        last_breakdown = np.zeros((len(names), len(wcats)))
+        last_breakdown[stored] = last_df[wcat_cols].to_numpy(dtype=np.float64)
+        last_total = np.zeros(len(names))
+        last_total[stored] = last_df[total_col].to_numpy(dtype=np.float64)
+
+        new_df[wcat_cols] = np.where((row_latest >= 0)[:, None], yearly[row_country, np.maximum(row_latest, 0)],
+                                     last_breakdown[row_country])
+        totals = last_total[:, None] + np.cumsum(yearly.sum(axis=2), axis=1)
+        new_df[total_col] = totals[row_country, row_year]
+
+    # The rolling & year-over-year metrics of the new years look back up to 5 years into the stored rows
+    tail_df = stored_df.loc[stored_df["odat"] >= first_year - 5, list(new_df.columns)]
+    with_metrics = add_derived_metrics(pd.concat([tail_df, new_df], ignore_index=True))
+    return with_metrics.iloc[len(tail_df):].reset_index(drop=True).reindex(columns=cols)
+
+
+def _finish_timelapse(counts_df, is_import, starting_year, inputs, ending_year=si.LAST_YEAR) -> pd.DataFrame:
+    """
+    Builds, writes & records the timelapse DataFrame from yearly counts.
+
+    :param pd.DataFrame counts_df: Yearly counts, as returned by gather_yearly_counts
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: Beginning year of the timelapse
+    :param dict inputs: Hash of the buyer/seller file the counts of each country were read from
+    :param int ending_year: Last year of the timelapse; later deals are left out, so that append_db_timelapse_years
+        can add their years (default sipri_info.LAST_YEAR)
+    :return: Map DataFrame for drawing a choropleth map of imports & exports.
+    """
+    counts_df = counts_df[counts_df["odat"] <= ending_year]
+    with instrumentation.stage("csv_write", file=tl_file(is_import, "counts.csv")):
+        counts_df.to_csv(tl_file(is_import, "counts.csv"), index=False)
+
+    if counts_df.empty:
+        tl_map_df = pd.DataFrame(columns=EXTRA_COLS)
+    else:
+        present = set(counts_df["sipri_name"])
+        counts_df = counts_df.assign(sipri_name=pd.Categorical(counts_df["sipri_name"],
+                                                               categories=[k for k in si.ENTITY_DICT if k in present]))
+        tl_map_df = add_derived_metrics(timelapse_from_deals(counts_df, ending_year))
+    write_tl_map_df(tl_map_df, is_import)
+    _save_tl_state(is_import, starting_year, ending_year, inputs)
+
+    return compact_tl_map_df(tl_map_df)
+
+
+def _save_tl_state(is_import, starting_year, ending_year, inputs):
+    """
+    Records what the stored timelapse DataFrame was built from.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: Beginning year of the timelapse
+    :param int ending_year: Last year of the timelapse
+    :param dict inputs: Hash of the buyer/seller file the counts of each country were read from
+    :return: None
+    """
+    with open(tl_file(is_import, "state.json"), "w") as state_file:
+        json.dump({"version": TIMELAPSE_VERSION, "starting_year": starting_year, "ending_year": ending_year,
+                   "inputs": inputs}, state_file, indent=1)
+
+
+def stored_ending_year():
+    """
+    Gets the last year of the stored import & export timelapse DataFrames, e.g. to download only the years after it.
+
+    :return: The earlier of the two last years, or None if either timelapse was not stored yet
+    """
+    states = [_load_tl_state(is_import) for is_import in (True, False)]
+    if any(state is None for state in states):
+        return None
+    return min(state["ending_year"] for state in states)
+
+
+def default_ending_year():
+    """
+    Gets the last year of the timelapse DataFrames when none is given: the stored one, so that the years added by
+    append_db_timelapse_years are kept, but no earlier than LAST_YEAR.
+
+    :return: Last year of the timelapse
+    """
+    stored_year = stored_ending_year()
+    return si.LAST_YEAR if stored_year is None else max(stored_year, si.LAST_YEAR)
+
+
+def tl_file(is_import, suffix) -> str:
+    """
+    Gets the path of a file stored next to tl_map_i_df.csv/tl_map_e_df.csv.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param str suffix: End of the file name
+    :return: Path under the "data" folder
+    """
+    return "data/tl_map_" + ("i_" if is_import else "e_") + suffix
+
+
+def _load_tl_state(is_import):
+    """
+    Loads what the stored timelapse DataFrame was built from.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :return: Dictionary with "starting_year", "ending_year" & per-country "inputs" hashes, or None if any stored file is
+        missing or was written by another TIMELAPSE_VERSION
+    """
+    files = [tl_file(is_import, suffix) for suffix in ("state.json", "counts.csv", "df.csv")]
+    if not all(os.path.exists(file) for file in files):
+        return None
+    with open(files[0]) as state_file:
+        state = json.load(state_file)
+    return state if state.get("version") == TIMELAPSE_VERSION else None
+
+
+def timelapse_from_deals(deals_df, ending_year=si.LAST_YEAR) -> pd.DataFrame:
+    """
+    Aggregates a deal table into the timelapse layout written by perform_db_timelapse_ops_legacy.
+
+    The column order and the float type of the numeric columns mimic what repeated DataFrame.append calls produce, so
+    that both engines write the same CSV bytes for the "nrdel" columns; the columns of the other measures follow.
+
+    :param pd.DataFrame deals_df: Deals with "sipri_name" (categorical, in ENTITY_DICT order), "odat", "wcat", "nrdel"
+        & optionally the other MEASURES
+    :param int ending_year: Last year that gets gap-filled
+    :return: Timelapse DataFrame
+    """
+
+    # Yearly sums of every measure per (country, year, wcat); wcat columns absent for a country stay NaN for now
+    measures = [measure for measure in MEASURES if measure in deals_df.columns]
+    with instrumentation.stage("pivot", rows=len(deals_df)):
+        sums = deals_df.groupby(["sipri_name", "odat", "wcat"], observed=True)[measures].sum().unstack("wcat")
+        sums = sums.sort_index()
+
+    # Running totals, then the gap-filled years
+    with instrumentation.stage("gap_fill", rows=len(sums)):
+        measure_counts = []
+        for measure in measures:
+            counts = sums[measure].copy()
+            counts.columns = [measure_column(str(wcat), measure) for wcat in counts.columns]
+            if measure == "nrdel":
+                wcats_present = counts.notna().groupby(level="sipri_name", observed=True).any()
+            counts = counts.fillna(0)
+            counts[measure_column("All", measure)] = counts.sum(axis=1).groupby(level="sipri_name",
+                                                                                  observed=True).cumsum()
+            measure_counts.append(counts)
+        counts = pd.concat(measure_counts, axis=1)
+
+        # Dense country x year grid from each country's first year up to ending_year, showing the latest year with deals
+        country_ids, names = pd.factorize(np.asarray(counts.index.get_level_values("sipri_name")))
+        years = counts.index.get_level_values("odat").to_numpy(dtype=np.int64)
+        first_year = years.min()
+        last_year = np.maximum(pd.Series(years).groupby(country_ids).max().to_numpy(), ending_year)
+        row_of = np.full((len(names), last_year.max() - first_year + 1), -1)
+        row_of[country_ids, years - first_year] = np.arange(len(counts))
+        country, position, latest = carry_forward(row_of >= 0)
+        keep = first_year + position <= last_year[country]
+        country, position, latest = country[keep], position[keep], latest[keep]
+
+        dense = counts.iloc[row_of[country, latest]]
+        dense.index = pd.MultiIndex.from_arrays([np.asarray(names, dtype=object)[country], first_year + position],
+                                                names=["sipri_name", "odat"])
+        is_fill = latest != position
+    instrumentation.count("gap_filled_rows", int(is_fill.sum()))
+
+    # Original rows come first, then the gap-filled ones, each in (country, year) order
+    dense = pd.concat([dense[~is_fill], dense[is_fill]]).reset_index()
+    dense.insert(1, "sipri_alpha", dense["sipri_name"].map({k: v[0] for k, v in si.ENTITY_DICT.items()}))
+    dense.insert(2, "iso_alpha", dense["sipri_name"].map({k: v[1] for k, v in si.ENTITY_DICT.items()}))
+
+    # Reproduce DataFrame.append's column order: each country adds the columns it has not seen yet at the end
+    columns = list(EXTRA_COLS)
+    for name in wcats_present.index:
+        row_cols = ["odat"] + list(wcats_present.columns[wcats_present.loc[name].to_numpy()]) + ["All"]
+        columns += [col for col in row_cols if col not in columns]
+
+    # The other measures follow, in the same order
+    columns += [measure_column(col, measure) for measure in measures if measure != "nrdel"
+                for col in columns[len(EXTRA_COLS):] if col != "odat"]
+
+    # Appending to an initially empty DataFrame turns every numeric column into floats
+    dense = dense[columns]
+    dense[columns[len(EXTRA_COLS):]] = dense[columns[len(EXTRA_COLS):]].astype(np.float64)
+
+    return dense
+
+
+def add_derived_metrics(tl_map_df) -> pd.DataFrame:
+    """
+    Adds the METRICS of every measure to a timelapse DataFrame. The running totals are laid out as a country x year
+    matrix, so that every metric is a whole-matrix operation on it.
+
+    :param pd.DataFrame tl_map_df: Timelapse DataFrame
+    :return: Timelapse DataFrame with the metric columns appended, rows unchanged
+    """
+    if tl_map_df.empty or "All" not in tl_map_df.columns:
+        return tl_map_df
+
+    with instrumentation.stage("metrics", rows=len(tl_map_df)):
+        country_ids, names = pd.factorize(tl_map_df["sipri_name"])
+        years = tl_map_df["odat"].to_numpy(dtype=np.int64)
+        year_ids = years - years.min()
+        n_years = int(year_ids.max()) + 1
+        positions = np.arange(n_years)
+
+        metrics = {}
+        for measure in MEASURES:
+            total_col = measure_column("All", measure)
+            if total_col not in tl_map_df.columns:
+                continue
+
+            # Running totals, 0 before a country's first row and carried forward over missing years
+            totals = np.full((len(names), n_years), np.nan)
+            totals[country_ids, year_ids] = tl_map_df[total_col].to_numpy(dtype=np.float64)
+            latest = np.maximum.accumulate(np.where(np.isnan(totals), 0, positions), axis=1)
+            totals = np.nan_to_num(np.take_along_axis(totals, latest, axis=1))
+
+            # With a leading year of zeros, any span of years is a difference of two columns
+            padded = np.zeros((len(names), n_years + 1))
+            padded[:, 1:] = totals
+            yearly = padded[:, 1:] - padded[:, :-1]
+            previous = np.zeros_like(yearly)
+            previous[:, 1:] = yearly[:, :-1]
+            yoy_change = yearly - previous
+            world = yearly.sum(axis=0)
+
+            values = {
+                "yearly": yearly,
+                "rolling_3": padded[:, 1:] - padded[:, np.maximum(positions - 2, 0)],
+                "rolling_5": padded[:, 1:] - padded[:, np.maximum(positions - 4, 0)],
+                "yoy_change": yoy_change,
+                "yoy_pct": np.divide(100 * yoy_change, previous, out=np.full_like(yearly, np.nan),
+                                     where=previous != 0),
+                "share": np.divide(yearly, world, out=np.zeros_like(yearly), where=world != 0)
+            }
+            for metric in METRICS:
+                metrics[measure_column(metric, measure)] = values[metric][country_ids, year_ids]
+
+    return tl_map_df.assign(**metrics)
+
+
+def write_tl_map_df(tl_map_df, is_import):
+    """
+    Writes a timelapse DataFrame to its CSV file under the "data" folder.
+
+    :param pd.DataFrame tl_map_df: Timelapse DataFrame
+    :param boolean is_import: True if data is imports, False if exports
+    :return: None
+    """
+    with instrumentation.stage("csv_write", file=tl_file(is_import, "df.csv")):
+        tl_map_df_file = open(tl_file(is_import, "df.csv"), "w")
+        tl_map_df.to_csv(path_or_buf=tl_map_df_file, index=False)
+        tl_map_df_file.close()
+
+
+def perform_db_timelapse_ops_legacy(is_import, starting_year=1992, ending_year=si.LAST_YEAR) -> pd.DataFrame:
+    """
+    Performs the database operations to accumulate imports/exports over time, one row at a time.
+
+    Kept as the reference implementation for perform_db_timelapse_ops; see benchmark.compare_timelapse_engines.
+
     :param boolean is_import: True if data is imports, False if exports
     :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param int ending_year: Last year that gets gap-filled (default sipri_info.LAST_YEAR)
     :return: Map DataFrame for drawing a choropleth map of imports & exports.
     """
 
-    # Create returning DataFrame
-    tl_map_df = pd.DataFrame(columns=EXTRA_COLS)
+    # Rows of the returning DataFrame
+    rows = []
 
     # Iterate across all countries
     for key, value in si.ENTITY_DICT.items():
@@ -53,25 +703,26 @@ def perform_db_timelapse_ops(is_import, starting_year=1992) -> pd.DataFrame:
 
         # Create the corresponding import/export DataFrame for this country & filter it by the starting year
         country_df = create_df(value[0], True) if is_import else create_df(value[0], False)
-        country_df = country_df[country_df["odat"] >= starting_year]
+        country_df = country_df[country_df["odat"] >= starting_year].astype({"wcat": object})
 
 
         if not country_df.empty:
 
             # Show how many delivered weapons of each category were sold/bought by this country for every year
-            weapons_timelapse_pt = pd.pivot_table(country_df,
-                                                  values='nrdel',
-                                                  index='odat',
-                                                  columns='wcat',
-                                                  aggfunc=np.sum,
-                                                  margins=True,
-                                                  fill_value=0)
+            with instrumentation.stage("pivot", country=key):
+                weapons_timelapse_pt = pd.pivot_table(country_df,
+                                                      values='nrdel',
+                                                      index='odat',
+                                                      columns='wcat',
+                                                      aggfunc=np.sum,
+                                                      margins=True,
+                                                      fill_value=0)
 
             # Fill NaNs
             weapons_timelapse_pt = weapons_timelapse_pt.fillna(0)
 
-            # TODO: Optimize this code! When adding rows to the tl_map_df DataFrame, perform operations here instead
-            #  to calculate the cumulative sums by year.
+            # Row-by-row on purpose: this is the reference implementation the vectorized perform_db_timelapse_ops is
+            #  checked against (benchmark.compare_timelapse_engines), so it stays as originally written.
 
             # Populate the rows of tl_map_df
             for pt_row in weapons_timelapse_pt.iterrows():
@@ -79,54 +730,52 @@ def perform_db_timelapse_ops(is_import, starting_year=1992) -> pd.DataFrame:
                                      'sipri_alpha': value[0],
                                      'iso_alpha': value[1],
                                      'odat': pt_row[0]})
-                new_row = new_row.append(pt_row[1])
+                new_row = pd.concat([new_row, pt_row[1]])
                 if new_row["odat"] != "All":
-                    tl_map_df = tl_map_df.append(new_row, ignore_index=True)
+                    rows.append(new_row)
 
-    tl_map_df = tl_map_df.fillna(0)
+    # DataFrame.append is gone since pandas 2, so the rows are gathered first, then laid out as appending them one at a
+    # time did: each row adds the columns not seen yet at the end, and every numeric column is a float column
+    columns = list(EXTRA_COLS)
+    for row in rows:
+        columns += [col for col in row.index if col not in columns]
+    tl_map_df = pd.DataFrame([row.to_dict() for row in rows], columns=columns)
+    tl_map_df[columns[len(EXTRA_COLS):]] = tl_map_df[columns[len(EXTRA_COLS):]].astype(np.float64)
 
-    for x in range(len(tl_map_df.index) - 1):
-        if tl_map_df.iloc[x]["sipri_name"] == tl_map_df.iloc[x + 1]["sipri_name"]:
-            tl_map_df.at[x + 1, "All"] += tl_map_df.at[x, "All"]
+    with instrumentation.stage("gap_fill", rows=len(tl_map_df)):
+        tl_map_df = tl_map_df.fillna(0)
 
-    for key, value in si.ENTITY_DICT.items():
-        if key in tl_map_df.values:
-            for y in range(int(tl_map_df.loc[tl_map_df['sipri_name'] == key]["odat"].min()), 2021):
-                if not ((tl_map_df['sipri_name'] == key) & (tl_map_df['odat'] == y)).any():
-                    fill_row = tl_map_df.loc[(tl_map_df["sipri_name"] == key) & (tl_map_df["odat"] == y - 1)].copy()
-                    fill_row["odat"] = y
-                    tl_map_df = tl_map_df.append(fill_row, ignore_index=True)
-
-    file = "data/tl_map_i_df.csv" if is_import else "data/tl_map_e_df.csv"
-    tl_map_df_file = open(file, "w")
-    tl_map_df.to_csv(path_or_buf=tl_map_df_file, index=False)
-    tl_map_df_file.close()
-
-    tl_map_df = tl_map_df.astype({
-        "odat": np.int32,
-        "AC": np.int32,
-        "AR": np.int32,
-        "AV": np.int32,
-        "EN": np.int32,
-        "GR": np.int32,
-        "MI": np.int32,
-        "SH": np.int32,
-        "OT": np.int32,
-        "NW": np.int32,
-        "SA": np.int32,
-        "AD": np.int32
-    })
+        for x in range(len(tl_map_df.index) - 1):
+            if tl_map_df.iloc[x]["sipri_name"] == tl_map_df.iloc[x + 1]["sipri_name"]:
+                tl_map_df.at[x + 1, "All"] += tl_map_df.at[x, "All"]
 
-    return tl_map_df
+        # Countries with rows, by ID, instead of searching every cell of tl_map_df for each name (the extra last slot
+        # takes the names without an ID)
+        present = np.zeros(len(countries.COUNTRIES) + 1, dtype=bool)
+        present[countries.COUNTRIES.ids(tl_map_df["sipri_name"].unique(), "name")] = True
+
+        for key, value in si.ENTITY_DICT.items():
+            if present[countries.COUNTRIES.ids([key], "name")[0]]:
+                for y in range(int(tl_map_df.loc[tl_map_df['sipri_name'] == key]["odat"].min()), ending_year + 1):
+                    if not ((tl_map_df['sipri_name'] == key) & (tl_map_df['odat'] == y)).any():
+                        fill_row = tl_map_df.loc[(tl_map_df["sipri_name"] == key) & (tl_map_df["odat"] == y - 1)].copy()
+                        fill_row["odat"] = y
+                        tl_map_df = pd.concat([tl_map_df, fill_row], ignore_index=True)
+
+    write_tl_map_df(tl_map_df, is_import)
+
+    return compact_tl_map_df(tl_map_df)
 
 
 def load_transparency_df() -> pd.DataFrame:
     """
     Loads transparency data CSV file.
 
-    :return: DataFrame of transparency scores
+    :return: DataFrame of transparency scores, indexed by ISO code, with the "country_id" of countries.COUNTRIES (-1
+        for countries not in it)
     """
     transparency_df = pd.read_csv("Transparency.csv").set_index('ISO Code')
+    transparency_df["country_id"] = countries.COUNTRIES.ids(transparency_df.index)
     return transparency_df
 
 
@@ -134,12 +783,129 @@ def load_stockpiles_df() -> pd.DataFrame:
     """
     Loads stockpiles data CSV file.
 
-    :return: Stockpiles DataFrame
+    :return: Stockpiles DataFrame, indexed by ISO code, with the "country_id" of countries.COUNTRIES (-1 for countries
+        not in it)
     """
     stockpile_df = pd.read_csv("Stockpiles.csv").set_index('ISO Code')
+    stockpile_df["country_id"] = countries.COUNTRIES.ids(stockpile_df.index)
     return stockpile_df
 
 
+def validate_countries() -> dict:
+    """
+    Reports the country codes of the transparency, stockpiles, centroids, regions & SIPRI data that do not join with
+    countries.COUNTRIES.
+
+    :return: Names of the datasets mapped to their unmatched codes, for those with any
+    """
+    return countries.validate({
+        "Transparency.csv": (pd.read_csv("Transparency.csv")["ISO Code"], "iso"),
+        "Stockpiles.csv": (pd.read_csv("Stockpiles.csv")["ISO Code"], "iso"),
+        "Centroids.csv": (pd.read_csv("Centroids.csv")["ISO Code"], "iso"),
+        "Regions.csv": (pd.read_csv("Regions.csv")["ISO Code"], "iso"),
+        "SIPRI deals": (deal_store.load_deal_store().codes.astype(str), "sipri")
+    })
+
+
+def country_year_df(tl_i_map_df, tl_e_map_df) -> pd.DataFrame:
+    """
+    Builds the per-country/year fact table: the yearly imports & exports of every measure along with the transparency
+    scores & stockpiles of the country, so that a map can mix them without merging on names or codes. Every dataset is
+    placed on a country ID x year grid of countries.COUNTRIES.
+
+    :param pd.DataFrame tl_i_map_df: DataFrame for Imports, with the "yearly" metrics of add_derived_metrics
+    :param pd.DataFrame tl_e_map_df: DataFrame for Exports, with the "yearly" metrics of add_derived_metrics
+    :return: DataFrame with a row for every country & year of the timelapse DataFrames, in (country ID, year) order:
+        "country_id", "sipri_name", "iso_alpha", "odat", "imports" & "exports" (suffixed for other measures than
+        "nrdel"), the columns of Transparency.csv and those of Stockpiles.csv ("Year" as "Stockpiles year"); NaN where
+        a country has no transparency or stockpiles data
+    """
+    table = countries.COUNTRIES
+    tl_dfs = {"imports": tl_i_map_df, "exports": tl_e_map_df}
+    years = np.concatenate([tl_df["odat"].to_numpy(dtype=np.int64) for tl_df in tl_dfs.values()])
+    first_year, last_year = (int(years.min()), int(years.max())) if len(years) else (0, -1)
+    n_years = last_year - first_year + 1
+
+    country_id = np.repeat(np.arange(len(table)), n_years)
+    facts_df = pd.DataFrame({"country_id": country_id,
+                             "sipri_name": table.names[country_id],
+                             "iso_alpha": table.iso[country_id],
+                             "odat": np.tile(np.arange(first_year, last_year + 1), len(table))})
+
+    # Yearly transfers: scatter each timelapse row onto the grid; countries & years without rows have none
+    for side, tl_df in tl_dfs.items():
+        ids = table.ids(tl_df["sipri_name"].astype(str), "name") if len(tl_df) else np.zeros(0, dtype=np.int64)
+        keep = ids >= 0
+        cells = ids[keep] * n_years + tl_df["odat"].to_numpy(dtype=np.int64)[keep] - first_year
+        for measure in MEASURES:
+            if measure_column("yearly", measure) not in tl_df.columns:
+                continue
+            grid = np.zeros(len(table) * n_years)
+            grid[cells] = tl_df[measure_column("yearly", measure)].to_numpy(dtype=np.float64)[keep]
+            facts_df[measure_column(side, measure)] = grid
+
+    # Per-country data: one value per ID, repeated over the years
+    for country_df in (load_transparency_df(), load_stockpiles_df().rename(columns={"Year": "Stockpiles year"})):
+        country_df = country_df[country_df["country_id"] >= 0].drop(columns="name")
+        for col in country_df.columns.drop("country_id"):
+            values = np.full(len(table), np.nan)
+            values[country_df["country_id"].to_numpy()] = country_df[col].to_numpy(dtype=np.float64)
+            facts_df[col] = values[country_id]
+
+    return facts_df
+
+
+def load_centroids_df() -> pd.DataFrame:
+    """
+    Loads country centroids CSV file.
+
+    :return: DataFrame of the latitude & longitude of each country, indexed by ISO code
+    """
+    centroids_df = pd.read_csv("Centroids.csv").set_index('ISO Code')
+    return centroids_df
+
+
+def flow_map_df(measure="nrdel", top_k=50, share=None, starting_year=1992, ending_year=si.LAST_YEAR) -> pd.DataFrame:
+    """
+    Sums the seller -> buyer flows of every year from the flow index and keeps only the largest ones of each year, so
+    that the flow map draws a bounded number of arcs.
+
+    :param str measure: One of MEASURES (default "nrdel")
+    :param int top_k: Maximum number of flows kept per year (default 50)
+    :param float share: If given, also stop once the kept flows make up this share of the year's total, e.g. 0.9
+    :param int starting_year: First year (default 1992)
+    :param int ending_year: Last year (default sipri_info.LAST_YEAR)
+    :return: DataFrame with "odat", "seller" & "buyer" (ISO codes), "seller_name", "buyer_name" & the measure, by
+        year and then largest flow first
+    """
+    index = flow_index.load_flow_index()
+    iso = countries.COUNTRIES.convert(index.codes.astype(str), "sipri", "iso")
+    names = countries.COUNTRIES.convert(index.codes.astype(str), "sipri", "name")
+
+    year_dfs = []
+    for year in range(starting_year, ending_year + 1):
+        edges_df = index.edges(year, measure=measure)
+
+        # Only countries of ENTITY_DICT have a centroid to draw from or to
+        edges_df = edges_df[pd.notna(iso[edges_df["seller"]]) & pd.notna(iso[edges_df["buyer"]])]
+        edges_df = edges_df.sort_values(measure, ascending=False, kind="stable")
+
+        if share is not None and not edges_df.empty:
+            # Keep every flow until the running share reaches the cutoff, including the one that crosses it
+            running_share = edges_df[measure].cumsum().to_numpy() / edges_df[measure].sum()
+            edges_df = edges_df[np.r_[0.0, running_share[:-1]] < share]
+
+        year_dfs.append(edges_df.head(top_k).assign(odat=year))
+
+    flows_df = pd.concat(year_dfs, ignore_index=True)
+    return pd.DataFrame({"odat": flows_df["odat"].to_numpy(),
+                         "seller": iso[flows_df["seller"]],
+                         "buyer": iso[flows_df["buyer"]],
+                         "seller_name": names[flows_df["seller"]],
+                         "buyer_name": names[flows_df["buyer"]],
+                         measure: flows_df[measure].to_numpy()})
+
+
 def load_tl_map_df(is_import) -> pd.DataFrame:
     """
     Loads previously-made tl_map_df.csv file.
@@ -147,21 +913,16 @@ def load_tl_map_df(is_import) -> pd.DataFrame:
     :param boolean is_import: True if data is imports, False if exports
     :return: Map DataFrame for drawing a timeline choropleth map of imports/exports.
     """
-    tl_map_df = pd.read_csv("data/tl_map_i_df.csv") if is_import else pd.read_csv("data/tl_map_e_df.csv")
-
-    tl_map_df = tl_map_df.astype({
-        "odat": np.int32,
-        "AC": np.int32,
-        "AR": np.int32,
-        "AV": np.int32,
-        "EN": np.int32,
-        "GR": np.int32,
-        "MI": np.int32,
-        "SH": np.int32,
-        "OT": np.int32,
-        "NW": np.int32,
-        "SA": np.int32,
-        "AD": np.int32
-    })
+    return read_tl_map_csv(tl_file(is_import, "df.csv"))
+
+
+def read_tl_map_csv(path) -> pd.DataFrame:
+    """
+    Reads a timelapse CSV file.
+
+    :param str path: Path of the CSV file
+    :return: Map DataFrame for drawing a timeline choropleth map of imports/exports.
+    """
+    tl_map_df = pd.read_csv(path, dtype={col: "category" for col in EXTRA_COLS})
 
-    return tl_map_df
+    return compact_tl_map_df(tl_map_df)
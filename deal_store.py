@@ -0,0 +1,377 @@
+"""
+@file deal_store.py
+
+The functions in this file are used for consolidating the per-country SIPRI CSV files into a single columnar deal
+store, which the database operations read slices from instead of parsing the CSV files again.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import glob
+import mmap
+import os
+import struct
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import data_manifest as dm
+import instrumentation
+import sipri_info as si
+
+STORE_FILE = "data/deals.npz"
+"""
+Columnar deal store built from the CSV files under the "data" folder.
+"""
+
+DEAL_COLS = ["tidn", "buyercod", "sellercod", "odat", "wcat", "nrdel", "tivorder", "tivdel"]
+"""
+Columns of the SIPRI CSV files kept in the deal store.
+"""
+
+CSV_DTYPES = {
+    "buyercod": str,
+    "sellercod": str,
+    "wcat": str
+}
+"""
+Types applied while parsing the SIPRI CSV files; the numeric columns are parsed as floats so that blanks become NaN.
+"""
+
+DEAL_DTYPES = {
+    "buyercod": "category",
+    "sellercod": "category",
+    "odat": np.int16,
+    "wcat": "category",
+    "nrdel": np.int32,
+    "tivorder": np.float64,
+    "tivdel": np.float64
+}
+"""
+Column types of the deal DataFrames created from the store. A missing "odat" is -1 and a missing "nrdel" is 0.
+"""
+
+DIRECTIONS = ("buyer", "seller")
+"""
+Suffixes of the CSV files, in the order of the first axis of the store's "offsets" & "hashes" arrays.
+"""
+
+
+class DealStore:
+    """
+    Read-only view of the deal store. Every column is a (memory-mapped) NumPy array; the rows of each country's buyer
+    file and seller file are contiguous, and "offsets" gives where each of them starts & ends.
+    """
+
+    def __init__(self, arrays):
+        """
+        :param dict arrays: Arrays saved by build_deal_store
+        """
+        self.arrays = arrays
+        self.codes = arrays["codes"]
+        self.wcats = arrays["wcats"]
+        self.code_ids = {str(code): i for i, code in enumerate(self.codes)}
+
+    def rows(self, sipri_code, is_import) -> slice:
+        """
+        Gets the rows of a country's buyer/seller file.
+
+        :param str sipri_code: SIPRI code of chosen country
+        :param boolean is_import: True for the buyer file, False for the seller file
+        :return: Slice into the store's columns (empty if the country has no file)
+        """
+        code_id = self.code_ids.get(sipri_code)
+        if code_id is None:
+            return slice(0, 0)
+        offsets = self.arrays["offsets"][0 if is_import else 1]
+        return slice(int(offsets[code_id]), int(offsets[code_id + 1]))
+
+    def unique_rows(self) -> np.ndarray:
+        """
+        Gets one row per deal. Every deal between two countries appears in both the seller's and the buyer's file, so
+        only the first row of each "tidn" is kept (rows without a "tidn" are all kept).
+
+        :return: Sorted array of row indices
+        """
+        tidn = np.asarray(self.arrays["tidn"])
+        _, first_rows = np.unique(tidn, return_index=True)
+        first_rows = first_rows[tidn[first_rows] >= 0]
+        return np.sort(np.concatenate([first_rows, np.flatnonzero(tidn < 0)]))
+
+    def df(self, rows=slice(None)) -> pd.DataFrame:
+        """
+        Creates a DataFrame indexed by "tidn" from some rows of the store, typed as in DEAL_DTYPES. The country codes &
+        weapon categories are categoricals built straight from the stored ids.
+
+        :param rows: Slice or index array of the rows to take (default all)
+        :return: Deals DataFrame
+        """
+        codes = pd.Index(np.asarray(self.codes, dtype=object))
+        df = pd.DataFrame({
+            "buyercod": pd.Categorical.from_codes(self.arrays["buyercod"][rows], categories=codes),
+            "sellercod": pd.Categorical.from_codes(self.arrays["sellercod"][rows], categories=codes),
+            "odat": np.asarray(self.arrays["odat"][rows]),
+            "wcat": pd.Categorical.from_codes(self.arrays["wcat"][rows],
+                                              categories=pd.Index(np.asarray(self.wcats, dtype=object))),
+            "nrdel": np.asarray(self.arrays["nrdel"][rows]),
+            "tivorder": np.asarray(self.arrays["tivorder"][rows]),
+            "tivdel": np.asarray(self.arrays["tivdel"][rows])
+        }, index=pd.Index(np.asarray(self.arrays["tidn"][rows]), name="tidn"))
+        return df
+
+
+def _encode(vocabulary_ids, values) -> np.ndarray:
+    """
+    Turns strings into integer ids, with -1 for missing values.
+
+    :param dict vocabulary_ids: Id of each known string
+    :param pd.Series values: Strings to encode
+    :return: Array of ids
+    """
+    return values.map(vocabulary_ids).fillna(-1).to_numpy(dtype=np.int64)
+
+
+def _csv_files():
+    """
+    Lists the buyer/seller CSV files under the "data" folder.
+
+    :return: Dictionary mapping (direction index, SIPRI code) to the file's path
+    """
+    files = {}
+    for direction_id, direction in enumerate(DIRECTIONS):
+        for path in glob.glob("data/*_" + direction + ".csv"):
+            files[(direction_id, os.path.basename(path)[:-len("_" + direction + ".csv")])] = path
+    return files
+
+
+def _encode_deals(deals_df, code_ids, wcat_ids) -> dict:
+    """
+    Turns parsed deals into the typed columns of the store.
+
+    :param pd.DataFrame deals_df: Deals with the columns of DEAL_COLS, as parsed from the CSV files
+    :param dict code_ids: Id of each country code
+    :param dict wcat_ids: Id of each weapon category
+    :return: Dictionary mapping each column of DEAL_COLS to its array
+    """
+    return {
+        "tidn": pd.to_numeric(deals_df["tidn"]).fillna(-1).to_numpy(dtype=np.int64),
+        "buyercod": _encode(code_ids, deals_df["buyercod"]).astype(np.int16),
+        "sellercod": _encode(code_ids, deals_df["sellercod"]).astype(np.int16),
+        "odat": pd.to_numeric(deals_df["odat"]).fillna(-1).to_numpy(dtype=np.int16),
+        "wcat": _encode(wcat_ids, deals_df["wcat"]).astype(np.int8),
+        "nrdel": pd.to_numeric(deals_df["nrdel"]).fillna(0).to_numpy(dtype=np.int32),
+        "tivorder": pd.to_numeric(deals_df["tivorder"]).to_numpy(dtype=np.float64),
+        "tivdel": pd.to_numeric(deals_df["tivdel"]).to_numpy(dtype=np.float64)
+    }
+
+
+def _recode(ids, old_vocabulary, new_ids) -> np.ndarray:
+    """
+    Turns the ids of an earlier vocabulary into those of a new one, keeping -1 for missing values.
+
+    :param np.ndarray ids: Ids into old_vocabulary
+    :param np.ndarray old_vocabulary: Strings of the earlier ids
+    :param dict new_ids: Id of each string of the new vocabulary
+    :return: Array of new ids
+    """
+    # The trailing -1 is where the missing id -1 points
+    mapping = np.array([new_ids.get(str(value), -1) for value in old_vocabulary] + [-1], dtype=np.int64)
+    return mapping[np.asarray(ids, dtype=np.int64)]
+
+
+def build_deal_store(store=None) -> DealStore:
+    """
+    Parses the buyer/seller CSV files under the "data" folder and saves them together in STORE_FILE, with typed
+    columns: country codes & weapon categories as integer ids, years as int16 and delivered units as int32.
+
+    The rows of the files an earlier store holds with the same hash are copied from it instead of being parsed again,
+    so after a refresh only the changed files are read. The result is the same as parsing every file.
+
+    :param DealStore store: Earlier deal store to copy the unchanged files from (default None, every file is parsed)
+    :return: The new deal store
+    """
+    files = _csv_files()
+    manifest = dm.load_manifest()
+    file_hashes = {(direction_id, code): dm.input_hash(manifest, code, direction_id == 1)
+                   for direction_id, code in files}
+    if store is not None and any(col not in store.arrays for col in DEAL_COLS):
+        store = None
+
+    # Countries of ENTITY_DICT take the first ids, in order
+    codes = [value[0] for value in si.ENTITY_DICT.values()]
+    codes += sorted({code for _, code in files} - set(codes))
+
+    kept, frames = {}, {}
+    for (direction_id, code), path in files.items():
+        if store is not None and code in store.code_ids \
+                and store.arrays["hashes"][direction_id, store.code_ids[code]] == file_hashes[(direction_id, code)]:
+            kept[(direction_id, code)] = store.rows(code, direction_id == 0)
+            continue
+        with instrumentation.stage("csv_parse", file=os.path.basename(path)):
+            df = pd.read_csv(path, encoding='latin-1', usecols=lambda col: col.strip() in DEAL_COLS, dtype=CSV_DTYPES)
+        instrumentation.count("csv_rows", len(df))
+        frames[(direction_id, code)] = df.rename(columns=str.strip).reindex(columns=DEAL_COLS)
+    instrumentation.count("csv_files_reused", len(kept))
+
+    # Every code & weapon category of the deals gets an id, whether its rows are parsed or copied
+    deal_codes = set()
+    deal_wcats = set()
+    for df in frames.values():
+        deal_codes |= set(df["buyercod"].dropna()) | set(df["sellercod"].dropna())
+        deal_wcats |= set(df["wcat"].dropna())
+    if kept:
+        kept_rows = np.concatenate([np.arange(rows.start, rows.stop) for rows in kept.values()])
+        for col in ("buyercod", "sellercod"):
+            ids = np.unique(np.asarray(store.arrays[col])[kept_rows])
+            deal_codes |= {str(code) for code in store.codes[ids[ids >= 0]]}
+        ids = np.unique(np.asarray(store.arrays["wcat"])[kept_rows])
+        deal_wcats |= {str(wcat) for wcat in store.wcats[ids[ids >= 0]]}
+
+    codes += sorted(deal_codes - set(codes))
+    code_ids = {code: i for i, code in enumerate(codes)}
+    wcats = list(si.WCATS_DICT) + sorted(deal_wcats - set(si.WCATS_DICT))
+    wcat_ids = {wcat: i for i, wcat in enumerate(wcats)}
+
+    pieces = [_encode_deals(pd.DataFrame(columns=DEAL_COLS), code_ids, wcat_ids)]
+    sizes = np.zeros((len(DIRECTIONS), len(codes)), dtype=np.int64)
+    hashes = np.full((len(DIRECTIONS), len(codes)), "", dtype="<U64")
+    for direction_id in range(len(DIRECTIONS)):
+        for code in codes:
+            if (direction_id, code) in frames:
+                piece = _encode_deals(frames[(direction_id, code)], code_ids, wcat_ids)
+            elif (direction_id, code) in kept:
+                rows = kept[(direction_id, code)]
+                piece = {col: np.asarray(store.arrays[col][rows]) for col in DEAL_COLS}
+                for col in ("buyercod", "sellercod"):
+                    piece[col] = _recode(piece[col], store.codes, code_ids).astype(np.int16)
+                piece["wcat"] = _recode(piece["wcat"], store.wcats, wcat_ids).astype(np.int8)
+            else:
+                continue
+            pieces.append(piece)
+            sizes[direction_id, code_ids[code]] = len(piece["tidn"])
+            hashes[direction_id, code_ids[code]] = file_hashes[(direction_id, code)]
+    offsets = np.zeros((len(DIRECTIONS), len(codes) + 1), dtype=np.int64)
+    offsets[:, 1:] = np.cumsum(sizes, axis=1)
+    offsets[1] += offsets[0, -1]
+
+    arrays = {
+        "codes": np.array(codes, dtype="<U8"),
+        "wcats": np.array(wcats, dtype="<U4"),
+        "offsets": offsets,
+        "hashes": hashes
+    }
+    for col in DEAL_COLS:
+        arrays[col] = np.concatenate([piece[col] for piece in pieces])
+
+    save_npz(STORE_FILE, arrays)
+
+    return DealStore(arrays)
+
+
+def save_npz(path, arrays):
+    """
+    Saves arrays into an uncompressed .npz file, which load_npz_mmap can memory-map. They are written to a temporary
+    file of this process first, so that readers never see a partial file.
+
+    :param str path: Path of the .npz file
+    :param dict arrays: Arrays to save, by name
+    :return: None, but creates the file
+    """
+    tmp_file = path[:-len(".npz")] + "." + str(os.getpid()) + ".tmp.npz"
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, path)
+
+
+def load_npz_mmap(path) -> dict:
+    """
+    Memory-maps an uncompressed .npz file once and views each of its arrays inside that single mapping.
+
+    :param str path: Path of the .npz file
+    :return: Dictionary of read-only arrays
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for info in zf.infolist():
+            name = info.filename[:-len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(zf.open(info))
+                continue
+
+            # Skip the zip local file header to reach the .npy data
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if int(np.prod(shape)) == 0 or dtype.hasobject:
+                arrays[name] = np.load(zf.open(info), allow_pickle=False)
+            else:
+                data = np.frombuffer(mapping, dtype=dtype, count=int(np.prod(shape)), offset=f.tell())
+                arrays[name] = data.reshape(shape, order="F" if fortran_order else "C")
+    return arrays
+
+
+_loaded_store = None
+"""
+Deal store loaded by load_deal_store, with the modification times of its file & of the manifest when it was checked.
+"""
+
+
+def load_deal_store() -> DealStore:
+    """
+    Loads the deal store, (re)building it first if it is missing or if any CSV file under the "data" folder changed
+    since it was built.
+
+    :return: Deal store
+    """
+    global _loaded_store
+
+    if _loaded_store is not None and _loaded_store[0] == _store_key():
+        return _loaded_store[1]
+
+    store = DealStore(load_npz_mmap(STORE_FILE)) if os.path.exists(STORE_FILE) else None
+    if store is None or not _is_current(store):
+        print("Building deal store" if store is None else "Updating deal store")
+        build_deal_store(store)
+
+    _loaded_store = (_store_key(), DealStore(load_npz_mmap(STORE_FILE)))
+    return _loaded_store[1]
+
+
+def _store_key() -> tuple:
+    """
+    Gets the modification times that tell whether a loaded deal store might be out of date.
+
+    :return: Modification times of STORE_FILE & of the manifest (None for a missing file)
+    """
+    return tuple(os.path.getmtime(file) if os.path.exists(file) else None for file in (STORE_FILE, dm.MANIFEST_FILE))
+
+
+def _is_current(store) -> bool:
+    """
+    Checks whether a deal store was built from the CSV files currently under the "data" folder.
+
+    :param DealStore store: Deal store to check
+    :return: True if every file is in the store with the same hash & every column of DEAL_COLS is stored
+    """
+    if any(col not in store.arrays for col in DEAL_COLS):
+        return False
+
+    manifest = dm.load_manifest()
+    files = _csv_files()
+    hashes = store.arrays["hashes"]
+    if len(files) != int((hashes != "").sum()):
+        return False
+    for (direction_id, code) in files:
+        code_id = store.code_ids.get(code)
+        if code_id is None or hashes[direction_id, code_id] != dm.input_hash(manifest, code, direction_id == 1):
+            return False
+    return True
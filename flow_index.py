@@ -0,0 +1,285 @@
+"""
+@file flow_index.py
+
+The functions in this file are used for indexing the deliveries between every seller & buyer by year & weapon
+category, so that bilateral questions ("exports from X to Y over a span of years", "top suppliers of Z in a year") are
+answered without going back to the deals.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+import deal_store
+import sipri_info as si
+
+FLOW_FILE = "data/flows.npz"
+"""
+Flow index built from the deal store.
+"""
+
+class FlowIndex:
+    """
+    Read-only view of the flow index. Every (seller, buyer, wcat) triple with at least one delivery is a row; for each
+    measure, "cum_<measure>" holds the running total of that row over the years, with a leading column of zeros, so
+    the total over any span of years is one subtraction. Rows are sorted by seller, then buyer, then wcat;
+    "seller_ptr" gives where each seller's rows start & end, and "buyer_order" & "buyer_ptr" do the same by buyer.
+    Country ids are those of the deal store, which gives the countries of ENTITY_DICT the first ids, in order.
+    """
+
+    def __init__(self, arrays):
+        """
+        :param dict arrays: Arrays saved by build_flow_index
+        """
+        self.arrays = arrays
+        self.codes = arrays["codes"]
+        self.wcats = arrays["wcats"]
+        self.first_year = int(arrays["years"][0])
+        self.last_year = int(arrays["years"][1])
+        self.seller = arrays["seller"]
+        self.buyer = arrays["buyer"]
+        self.wcat = arrays["wcat"]
+        self.code_ids = {str(code): i for i, code in enumerate(self.codes)}
+        self.wcat_ids = {str(wcat): i for i, wcat in enumerate(self.wcats)}
+
+    def _columns(self, start_year, end_year) -> tuple:
+        """
+        Gets the columns of the running totals to subtract for a span of years.
+
+        :param int start_year: First year of the span
+        :param int end_year: Last year of the span (inclusive)
+        :return: Tuple of the columns of the totals before start_year & up to end_year
+        """
+        start = min(max(start_year - self.first_year, 0), self.last_year - self.first_year + 1)
+        end = min(max(end_year - self.first_year + 1, start), self.last_year - self.first_year + 1)
+        return start, end
+
+    def _totals(self, rows, start_year, end_year, measure) -> np.ndarray:
+        """
+        Sums a measure over a span of years for some rows.
+
+        :param rows: Slice or index array of the rows
+        :param int start_year: First year of the span
+        :param int end_year: Last year of the span (inclusive)
+        :param str measure: One of sipri_info.MEASURES
+        :return: Array with the total of each row
+        """
+        start, end = self._columns(start_year, end_year)
+        cum = self.arrays["cum_" + measure]
+        return cum[rows, end] - cum[rows, start]
+
+    def seller_rows(self, sipri_code) -> slice:
+        """
+        Gets the rows of a seller.
+
+        :param str sipri_code: SIPRI code of the seller
+        :return: Slice of the rows (empty if the country never sold anything)
+        """
+        code_id = self.code_ids.get(sipri_code)
+        if code_id is None:
+            return slice(0, 0)
+        return slice(int(self.arrays["seller_ptr"][code_id]), int(self.arrays["seller_ptr"][code_id + 1]))
+
+    def buyer_rows(self, sipri_code) -> np.ndarray:
+        """
+        Gets the rows of a buyer.
+
+        :param str sipri_code: SIPRI code of the buyer
+        :return: Array of the rows (empty if the country never bought anything)
+        """
+        code_id = self.code_ids.get(sipri_code)
+        if code_id is None:
+            return np.zeros(0, dtype=np.int64)
+        ptr = self.arrays["buyer_ptr"]
+        return self.arrays["buyer_order"][int(ptr[code_id]):int(ptr[code_id + 1])]
+
+    def flow(self, seller_code, buyer_code, start_year, end_year=None, wcat=None, measure="nrdel"):
+        """
+        Sums the deliveries from a seller to a buyer over a span of years.
+
+        :param str seller_code: SIPRI code of the seller
+        :param str buyer_code: SIPRI code of the buyer
+        :param int start_year: First year of the span
+        :param int end_year: Last year of the span, inclusive (default start_year)
+        :param str wcat: Weapon category to keep (default all)
+        :param str measure: One of sipri_info.MEASURES (default "nrdel")
+        :return: Total of the measure
+        """
+        rows = self.seller_rows(seller_code)
+        buyer_id = self.code_ids.get(buyer_code)
+        if buyer_id is None:
+            return 0
+
+        # The seller's rows are sorted by buyer, so the buyer's rows are one contiguous run
+        buyers = self.buyer[rows]
+        lo = rows.start + int(np.searchsorted(buyers, buyer_id, side="left"))
+        hi = rows.start + int(np.searchsorted(buyers, buyer_id, side="right"))
+        totals = self._totals(slice(lo, hi), start_year, start_year if end_year is None else end_year, measure)
+        if wcat is not None:
+            totals = totals[self.wcat[lo:hi] == self.wcat_ids.get(wcat, -1)]
+        return totals.sum().item()
+
+    def top_partners(self, sipri_code, is_import, start_year, end_year=None, k=10, wcat=None, measure="nrdel") -> list:
+        """
+        Ranks the suppliers of a buyer, or the recipients of a seller, over a span of years.
+
+        :param str sipri_code: SIPRI code of the country
+        :param boolean is_import: True to rank the country's suppliers, False to rank its recipients
+        :param int start_year: First year of the span
+        :param int end_year: Last year of the span, inclusive (default start_year)
+        :param int k: Number of partners to return (default 10)
+        :param str wcat: Weapon category to keep (default all)
+        :param str measure: One of sipri_info.MEASURES (default "nrdel")
+        :return: List of (SIPRI code, total) pairs, largest first, without partners whose total is 0
+        """
+        rows = self.buyer_rows(sipri_code) if is_import else self.seller_rows(sipri_code)
+        if wcat is not None:
+            rows = np.arange(len(self.wcat))[rows]
+            rows = rows[self.wcat[rows] == self.wcat_ids.get(wcat, -1)]
+
+        totals = self._totals(rows, start_year, start_year if end_year is None else end_year, measure)
+        partners = (self.seller if is_import else self.buyer)[rows]
+        by_partner = np.bincount(partners, weights=totals, minlength=len(self.codes)).astype(totals.dtype)
+
+        top = np.flatnonzero(by_partner > 0)
+        if len(top) > k:
+            top = top[np.argpartition(-by_partner[top], k - 1)[:k]]
+        top = top[np.argsort(-by_partner[top], kind="stable")]
+        return [(str(self.codes[i]), by_partner[i].item()) for i in top]
+
+    def top_suppliers(self, buyer_code, year, k=10, wcat=None, measure="nrdel") -> list:
+        """
+        Ranks the suppliers of a buyer in one year.
+
+        :param str buyer_code: SIPRI code of the buyer
+        :param int year: Year of the deliveries
+        :param int k: Number of suppliers to return (default 10)
+        :param str wcat: Weapon category to keep (default all)
+        :param str measure: One of sipri_info.MEASURES (default "nrdel")
+        :return: List of (SIPRI code, total) pairs, largest first
+        """
+        return self.top_partners(buyer_code, True, year, year, k, wcat, measure)
+
+    def edges(self, start_year, end_year=None, wcat=None, measure="nrdel") -> pd.DataFrame:
+        """
+        Sums every seller -> buyer flow over a span of years.
+
+        :param int start_year: First year of the span
+        :param int end_year: Last year of the span, inclusive (default start_year)
+        :param str wcat: Weapon category to keep (default all)
+        :param str measure: One of sipri_info.MEASURES (default "nrdel")
+        :return: DataFrame with "seller", "buyer" (country ids) & the measure, without flows whose total is 0
+        """
+        totals = self._totals(slice(None), start_year, start_year if end_year is None else end_year, measure)
+        if wcat is not None:
+            totals = np.where(self.wcat == self.wcat_ids.get(wcat, -1), totals, 0)
+
+        # Rows are sorted by (seller, buyer), so each pair's wcats are one run
+        pair_key = np.asarray(self.seller, dtype=np.int64) * len(self.codes) + self.buyer
+        starts = np.flatnonzero(np.r_[True, pair_key[1:] != pair_key[:-1]]) if len(pair_key) else np.zeros(0, int)
+        pair_totals = np.add.reduceat(totals, starts) if len(starts) else totals[:0]
+        keep = pair_totals > 0
+        return pd.DataFrame({"seller": np.asarray(self.seller)[starts][keep],
+                             "buyer": np.asarray(self.buyer)[starts][keep],
+                             measure: pair_totals[keep]})
+
+
+def _source_key(store) -> str:
+    """
+    Identifies the deal store a flow index is built from.
+
+    :param deal_store.DealStore store: Deal store
+    :return: SHA-256 hex digest of the hashes of the store's CSV files & of the measures
+    """
+    key = hashlib.sha256(np.ascontiguousarray(store.arrays["hashes"]).tobytes())
+    key.update(",".join(si.MEASURES).encode())
+    return key.hexdigest()
+
+
+def build_flow_index() -> FlowIndex:
+    """
+    Sums every deal of the deal store into the flow index & saves it in FLOW_FILE. Deals without a seller, buyer,
+    year or weapon category are left out.
+
+    :return: The new flow index
+    """
+    store = deal_store.load_deal_store()
+    rows = store.unique_rows()
+    seller = np.asarray(store.arrays["sellercod"])[rows].astype(np.int64)
+    buyer = np.asarray(store.arrays["buyercod"])[rows].astype(np.int64)
+    odat = np.asarray(store.arrays["odat"])[rows].astype(np.int64)
+    wcat = np.asarray(store.arrays["wcat"])[rows].astype(np.int64)
+    keep = (seller >= 0) & (buyer >= 0) & (odat >= 0) & (wcat >= 0)
+    seller, buyer, odat, wcat = seller[keep], buyer[keep], odat[keep], wcat[keep]
+    values = {"nrdel": np.asarray(store.arrays["nrdel"])[rows][keep].astype(np.int64),
+              "tivorder": np.nan_to_num(np.asarray(store.arrays["tivorder"])[rows][keep]),
+              "tivdel": np.nan_to_num(np.asarray(store.arrays["tivdel"])[rows][keep])}
+
+    n_codes, n_wcats = len(store.codes), len(store.wcats)
+    first_year, last_year = (int(odat.min()), int(odat.max())) if len(odat) else (0, -1)
+    n_cols = last_year - first_year + 2
+
+    # One row per (seller, buyer, wcat) triple, in that order
+    triple_keys, triple_ids = np.unique((seller * n_codes + buyer) * n_wcats + wcat, return_inverse=True)
+    triple_ids = triple_ids.reshape(-1)
+    cells = triple_ids * n_cols + (odat - first_year + 1)
+
+    arrays = {
+        "codes": np.asarray(store.codes),
+        "wcats": np.asarray(store.wcats),
+        "years": np.array([first_year, last_year], dtype=np.int64),
+        "source": np.array(_source_key(store)),
+        "seller": (triple_keys // (n_codes * n_wcats)).astype(np.int16),
+        "buyer": (triple_keys // n_wcats % n_codes).astype(np.int16),
+        "wcat": (triple_keys % n_wcats).astype(np.int8)
+    }
+    for measure in si.MEASURES:
+        yearly = np.bincount(cells, weights=values[measure], minlength=len(triple_keys) * n_cols)
+        cum = np.cumsum(yearly.reshape(len(triple_keys), n_cols), axis=1)
+        arrays["cum_" + measure] = cum.astype(values[measure].dtype)
+
+    arrays["seller_ptr"] = np.searchsorted(arrays["seller"], np.arange(n_codes + 1)).astype(np.int64)
+    arrays["buyer_order"] = np.argsort(arrays["buyer"], kind="stable").astype(np.int64)
+    arrays["buyer_ptr"] = np.searchsorted(arrays["buyer"][arrays["buyer_order"]],
+                                          np.arange(n_codes + 1)).astype(np.int64)
+
+    deal_store.save_npz(FLOW_FILE, arrays)
+
+    return FlowIndex(arrays)
+
+
+_loaded_index = None
+"""
+Flow index loaded by load_flow_index, with the modification times of its file & of the deal store when it was checked.
+"""
+
+
+def load_flow_index() -> FlowIndex:
+    """
+    Loads the flow index with a single memory mapping, (re)building it first if it is missing or if the deal store
+    changed since it was built.
+
+    :return: Flow index
+    """
+    global _loaded_index
+
+    store = deal_store.load_deal_store()
+    key = tuple(os.path.getmtime(file) if os.path.exists(file) else None
+                for file in (FLOW_FILE, deal_store.STORE_FILE))
+    if _loaded_index is not None and _loaded_index[0] == key:
+        return _loaded_index[1]
+
+    if not os.path.exists(FLOW_FILE) or \
+            str(deal_store.load_npz_mmap(FLOW_FILE)["source"]) != _source_key(store):
+        print("Building flow index")
+        build_flow_index()
+
+    key = tuple(os.path.getmtime(file) for file in (FLOW_FILE, deal_store.STORE_FILE))
+    _loaded_index = (key, FlowIndex(deal_store.load_npz_mmap(FLOW_FILE)))
+    return _loaded_index[1]
@@ -8,65 +8,375 @@ The functions in this file are used for downloading data from OSINT databases.
 @author Jack Ayvazian
 """
 
+import hashlib
+import locale
 import os
-import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
 import sipri
+import data_manifest as dm
+import instrumentation
 import sipri_info as si
 
 
-def download_sipri_data():
+SIPRI_EXPORT_URL = "https://armstrade.sipri.org/armstrade/html/export_trade_register.php"
+"""
+Endpoint queried by the sipri library, used directly when a request timeout is needed.
+"""
+
+
+def create_data_folder():
     """
-    Downloads import & export data for each country from SIPRI's Arms Transfer Database, then stores them in CSV files
-    under the "data" folder.
+    Creates the "data" folder if it does not exist yet. Existing files are kept so that a refresh only rewrites the
+    ones whose content changed.
 
     :return: None
     """
-
-    try:
-        # Try to create the "data" folder locally
+    if not os.path.exists("data"):
         os.mkdir("data")
         print("\"data\" folder created")
-    except FileExistsError:
-        # If that folder already exists, wipe it & remake it
-        print("\"data\" folder already exists; deleting & remaking")
-        if os.path.exists("data"):
-            shutil.rmtree("data")
-        os.mkdir("data")
+
+
+def write_sipri_csv(sipri_code, is_seller, response_str, manifest, append_from=None) -> bool:
+    """
+    Writes a SIPRI response to the seller/buyer CSV file of a country, unless the file already holds the same data.
+
+    If the query has results, they are returned as a CSV string that can be written as a file.
+    If the query has no results, an HTML file is returned instead.
+    An empty CSV header replaces the HTML file to signify an empty dataset. The header line is normalized as in
+    stream_sipri_csv.
+
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True if the response holds the country's sales, False if its purchases
+    :param str response_str: Text returned by SIPRI
+    :param dict manifest: Manifest of the "data" folder, updated in place
+    :param int append_from: If given, the response is a query starting at that year, merged into the existing file
+        with merge_years instead of replacing it (default None)
+    :return: True if the file was (re)written, False if it was unchanged
+    """
+    csv_str = response_str if not response_str.startswith("<!DOCTYPE") else si.CSV_HEADER
+    content = _normalize_header(csv_str.encode(locale.getpreferredencoding(False)))
+    path = "data/" + dm.file_key(sipri_code, is_seller) + ".csv"
+    if append_from is not None and os.path.exists(path):
+        with open(path, "rb") as old_file:
+            content = merge_years(old_file.read(), content, append_from)
+    with instrumentation.stage("csv_write", file=dm.file_key(sipri_code, is_seller)):
+        return dm.write_if_changed(manifest, sipri_code, is_seller, content)
+
+
+def download_sipri_data(low_year=str(si.FIRST_YEAR), high_year=str(si.LAST_YEAR)):
+    """
+    Downloads import & export data for each country from SIPRI's Arms Transfer Database, then stores them in CSV files
+    under the "data" folder. Only files whose content changed are rewritten; data/manifest.json records the hash, row
+    count & fetch time of each file.
+
+    :param str low_year: First year of the queries
+    :param str high_year: Last year of the queries
+    :return: None
+    """
+
+    create_data_folder()
+    manifest = dm.load_manifest()
 
     # The third-party sipri library performs queries on SIPRI's Arms Transfer Database automatically.
-    # If the query has results, they are returned as a CSV string that can be written as a file.
-    # If the query has no results, an HTML file is returned instead.
-    # An empty CSV header replaces the HTML file to signify an empty dataset.
 
     for key, value in si.ENTITY_DICT.items():
         print(key)
 
         # Download & save seller data for each country
 
-        seller_str = sipri.sipri_data(low_year='1950',
-                                      high_year='2020',
-                                      seller=value[0],
-                                      filetype='csv')
-
-        seller_csv = open("data/" + value[0] + "_seller.csv", "w")
-        if not seller_str.startswith("<!DOCTYPE"):
-            seller_csv.write(seller_str)
-            seller_csv.close()
-        else:
-            seller_csv.write(si.CSV_HEADER)
-            seller_csv.close()
+        with instrumentation.stage("download", file=dm.file_key(value[0], True)):
+            seller_str = sipri.sipri_data(low_year=low_year,
+                                          high_year=high_year,
+                                          seller=value[0],
+                                          filetype='csv')
+        instrumentation.count("download_bytes", len(seller_str))
+        write_sipri_csv(value[0], True, seller_str, manifest)
 
         # Download & save buyer data for each country
 
-        buyer_str = sipri.sipri_data(low_year='1950',
-                                     high_year='2020',
-                                     buyer=value[0],
-                                     filetype='csv')
-
-        buyer_csv = open("data/" + value[0] + "_buyer.csv", "w")
-        if not buyer_str.startswith("<!DOCTYPE"):
-            buyer_csv.write(buyer_str)
-            buyer_csv.close()
-        else:
-            buyer_csv.write(si.CSV_HEADER)
-            buyer_csv.close()
+        with instrumentation.stage("download", file=dm.file_key(value[0], False)):
+            buyer_str = sipri.sipri_data(low_year=low_year,
+                                         high_year=high_year,
+                                         buyer=value[0],
+                                         filetype='csv')
+        instrumentation.count("download_bytes", len(buyer_str))
+        write_sipri_csv(value[0], False, buyer_str, manifest)
+
+    dm.save_manifest(manifest)
+
+
+def _sipri_params(sipri_code, is_seller, low_year, high_year) -> dict:
+    """
+    Builds the form SIPRI's trade register expects for the sales or purchases of a country, as sipri.sipri_data sends
+    it.
+
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True to query the country's sales, False for its purchases
+    :param str low_year: First year of the query
+    :param str high_year: Last year of the query
+    :return: Form fields of the POST request
+    """
+    return {
+        'low_year': low_year,
+        'high_year': high_year,
+        'seller_country_code': sipri_code if is_seller else '',
+        'buyer_country_code': '' if is_seller else sipri_code,
+        'armament_category_id': 'any',
+        'buyers_or_sellers': '',
+        'filetype': 'csv',
+        'include_open_deals': 'on',
+        'sum_deliveries': 'off',
+        'Submit4': 'Download'
+    }
+
+
+def sipri_fetch(sipri_code, is_seller, low_year=str(si.FIRST_YEAR), high_year=str(si.LAST_YEAR), timeout=60.0) -> str:
+    """
+    Sends the same query as sipri.sipri_data, but gives up after a timeout.
+
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True to query the country's sales, False for its purchases
+    :param str low_year: First year of the query
+    :param str high_year: Last year of the query
+    :param float timeout: Seconds to wait for SIPRI before raising requests.Timeout
+    :return: CSV string, or an HTML page if the query has no results
+    """
+    response = requests.post(SIPRI_EXPORT_URL, data=_sipri_params(sipri_code, is_seller, low_year, high_year),
+                             timeout=timeout)
+    response.raise_for_status()
+    return response.text
+
+
+def _is_html(first_chunk) -> bool:
+    """
+    Tells whether a SIPRI response is the HTML page sent for queries without results.
+
+    :param bytes first_chunk: Start of the response
+    :return: True if the response is HTML, False if it is CSV
+    """
+    start = first_chunk.lstrip()[:9].upper()
+    return start.startswith(b"<!DOCTYPE") or start.startswith(b"<HTML")
+
+
+def _normalize_header(content) -> bytes:
+    """
+    Removes the trailing space SIPRI leaves at the end of the CSV header line, keeping the line's ending, so that
+    write_sipri_csv & stream_sipri_csv write the same bytes for the same response.
+
+    :param bytes content: Start of the CSV, holding at least the whole header line if it has a line ending
+    :return: The content with its header line normalized
+    """
+    end = content.find(b"\n")
+    if end < 0:
+        return content.rstrip(b"\r").rstrip(b" ")
+    line_end = b"\r\n" if content[:end].endswith(b"\r") else b"\n"
+    return content[:end].rstrip(b"\r").rstrip(b" ") + line_end + content[end + 1:]
+
+
+def stream_sipri_csv(sipri_code, is_seller, manifest, low_year=str(si.FIRST_YEAR), high_year=str(si.LAST_YEAR),
+                     timeout=60.0, chunk_size=2 ** 16, post=requests.post, append=False) -> bool:
+    """
+    Sends the same query as sipri_fetch, but streams the response into a temporary file chunk by chunk instead of
+    holding it in memory, then moves that file into place unless the country's file already holds the same data.
+
+    The first chunk tells whether the response is CSV or the HTML page sent for queries without results; an HTML
+    response is not read any further and an empty CSV header is written instead. The trailing space SIPRI leaves at
+    the end of the CSV header line is removed on the way. The bytes are written as SIPRI sends them.
+
+    :param str sipri_code: SIPRI code of chosen country
+    :param boolean is_seller: True to query the country's sales, False for its purchases
+    :param dict manifest: Manifest of the "data" folder, updated in place
+    :param str low_year: First year of the query
+    :param str high_year: Last year of the query
+    :param float timeout: Seconds to wait for SIPRI before raising requests.Timeout
+    :param int chunk_size: Bytes read from the response at a time (default 64 KiB)
+    :param post: Function sending the request, with the signature of requests.post (default requests.post)
+    :param boolean append: True to merge the response into the existing file with merge_years instead of replacing it
+        (default False)
+    :return: True if the file was (re)written, False if it was unchanged
+    """
+    tmp_path = "data/" + dm.file_key(sipri_code, is_seller) + ".csv.tmp"
+    sha256 = hashlib.sha256()
+    newlines = 0
+    last_byte = b""
+
+    def write(csv_file, data):
+        nonlocal newlines, last_byte
+        if data:
+            csv_file.write(data)
+            sha256.update(data)
+            newlines += data.count(b"\n")
+            last_byte = data[-1:]
+
+    try:
+        with post(SIPRI_EXPORT_URL, data=_sipri_params(sipri_code, is_seller, low_year, high_year), timeout=timeout,
+                  stream=True) as response, \
+                open(tmp_path, "wb") as csv_file:
+            response.raise_for_status()
+            header = b""
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                instrumentation.count("download_bytes", len(chunk))
+                if header is None:
+                    write(csv_file, chunk)
+                    continue
+
+                # Hold back the start of the response until the whole header line is in
+                header += chunk
+                if _is_html(header):
+                    header = si.CSV_HEADER.encode()
+                    break
+                if b"\n" in header:
+                    write(csv_file, _normalize_header(header))
+                    header = None
+
+            if header is not None:
+                write(csv_file, _normalize_header(header.rstrip(b"\r\n")))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    rows = max(newlines + (last_byte not in (b"", b"\n")) - 1, 0)
+    path = "data/" + dm.file_key(sipri_code, is_seller) + ".csv"
+    if append and os.path.exists(path):
+        # The response only holds the queried years, which are few enough to merge in memory
+        with open(path, "rb") as old_file, open(tmp_path, "rb") as new_file:
+            content = merge_years(old_file.read(), new_file.read(), int(low_year))
+        with open(tmp_path, "wb") as csv_file:
+            csv_file.write(content)
+        return dm.replace_if_changed(manifest, sipri_code, is_seller, tmp_path, dm.content_hash(content),
+                                     max(len(content.splitlines()) - 1, 0))
+    return dm.replace_if_changed(manifest, sipri_code, is_seller, tmp_path, sha256.hexdigest(), rows)
+
+
+def merge_years(old_content, new_content, first_year) -> bytes:
+    """
+    Adds the deals of a query over recent years to a country's file. The rows of the file ordered before first_year
+    are kept byte for byte, and those ordered from first_year on (from an earlier run over the same years) are replaced
+    by the rows of the query ordered from first_year on; deals of the query ordered earlier (e.g. still being
+    delivered) are already in the file.
+
+    :param bytes old_content: Current contents of the file
+    :param bytes new_content: CSV returned by a query starting at first_year (header included)
+    :param int first_year: First year of that query
+    :return: Merged file contents
+    """
+    old_lines = old_content.splitlines(keepends=True)
+    kept = []
+    for line in old_lines[1:]:
+        year = _order_year(line)
+        if year is None or year < first_year:
+            kept.append(line)
+    if kept and not kept[-1].endswith(b"\n"):
+        kept[-1] += b"\r\n" if old_lines[0].endswith(b"\r\n") else b"\n"
+    added = [line for line in new_content.splitlines(keepends=True)[1:]
+             if _order_year(line) is not None and _order_year(line) >= first_year]
+    return b"".join(old_lines[:1] + kept + added)
+
+
+def _order_year(line):
+    """
+    Reads the order year ("odat") of a row of a SIPRI CSV file.
+
+    :param bytes line: Row of the file
+    :return: Order year, or None if the row has none
+    """
+    fields = line.split(b",", 4)
+    return int(fields[3]) if len(fields) == 5 and fields[3].strip().isdigit() else None
+
+
+class RateLimiter:
+    """
+    Spaces out calls across threads so that at most `rate` of them start per second.
+    """
+
+    def __init__(self, rate):
+        """
+        :param float rate: Maximum number of calls per second; 0 or less disables the limit
+        """
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the caller is allowed to make its call.
+
+        :return: None
+        """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def download_sipri_data_concurrent(workers=8, timeout=60.0, retries=3, backoff=1.0, rate_limit=4.0,
+                                   fetch=None, low_year=str(si.FIRST_YEAR), high_year=str(si.LAST_YEAR),
+                                   append=False) -> list:
+    """
+    Downloads the same files as download_sipri_data, but runs the seller & buyer queries of every country on a pool of
+    worker threads. Each file is written as soon as its query completes, and only if its content changed.
+
+    :param int workers: Number of queries running at the same time
+    :param float timeout: Seconds before a single query is abandoned
+    :param int retries: Number of extra attempts after a failed query
+    :param float backoff: Seconds to wait before the first retry; doubled after every further failure
+    :param float rate_limit: Maximum number of queries started per second across all workers (0 for no limit)
+    :param fetch: Function called as fetch(sipri_code, is_seller, low_year, high_year, timeout) that returns the SIPRI
+        response text, e.g. sipri_fetch (default None, which streams each response to its file with stream_sipri_csv)
+    :param str low_year: First year of the queries
+    :param str high_year: Last year of the queries
+    :param boolean append: True to only add the queried years to the existing files, keeping their earlier years (see
+        merge_years), e.g. with low_year set to the first year after the last download (default False)
+    :return: List of (SIPRI code, is_seller) pairs whose query still failed after all retries
+    """
+
+    create_data_folder()
+    manifest = dm.load_manifest()
+    limiter = RateLimiter(rate_limit)
+
+    def download(sipri_code, is_seller):
+        for attempt in range(retries + 1):
+            limiter.wait()
+            try:
+                with instrumentation.stage("download", file=dm.file_key(sipri_code, is_seller), attempt=attempt):
+                    if fetch is None:
+                        return stream_sipri_csv(sipri_code, is_seller, manifest, low_year, high_year, timeout,
+                                                append=append)
+                    response_str = fetch(sipri_code, is_seller, low_year, high_year, timeout)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                instrumentation.count("download_retries")
+                print(sipri_code, "seller" if is_seller else "buyer", "failed (" + repr(e) + "); retrying")
+                time.sleep(backoff * 2 ** attempt)
+            else:
+                instrumentation.count("download_bytes", len(response_str))
+                return write_sipri_csv(sipri_code, is_seller, response_str, manifest,
+                                       int(low_year) if append else None)
+
+    failed = []
+    changed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, value[0], is_seller): (key, value[0], is_seller)
+                   for key, value in si.ENTITY_DICT.items()
+                   for is_seller in (True, False)}
+
+        for future in as_completed(futures):
+            key, sipri_code, is_seller = futures[future]
+            if future.exception() is not None:
+                print(key, "seller" if is_seller else "buyer", "download failed:", repr(future.exception()))
+                failed.append((sipri_code, is_seller))
+            else:
+                changed += future.result()
+                print(key, "seller" if is_seller else "buyer", "updated" if future.result() else "unchanged")
+
+    dm.save_manifest(manifest)
+    print(changed, "files updated")
+
+    return failed
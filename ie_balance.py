@@ -0,0 +1,78 @@
+"""
+@file ie_balance.py
+
+The data structures in this file are used for comparing the imports & exports of every country year by year: both
+timelapse DataFrames are placed on the same country x year grid, from which the net balance, the export/import ratio
+& the share of each side are computed for all countries & years at once.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import numpy as np
+import pandas as pd
+
+import countries
+import db_ops
+
+
+class ImportExportBalance:
+    """
+    Imports & exports of one measure as country x year arrays, with countries numbered as in countries.COUNTRIES and
+    years from "first_year" to "last_year". A country has no imports (or exports) in the years before its first row
+    of the import (or export) timelapse; "present" tells which cells have a row on either side.
+    """
+
+    def __init__(self, tl_i_map_df, tl_e_map_df, measure="nrdel", value_col="All"):
+        """
+        :param pd.DataFrame tl_i_map_df: DataFrame for Imports
+        :param pd.DataFrame tl_e_map_df: DataFrame for Exports
+        :param str measure: One of db_ops.MEASURES (default "nrdel")
+        :param str value_col: Value compared, "All" (running totals) or one of db_ops.METRICS (default "All")
+        """
+        table = countries.COUNTRIES
+        value_col = db_ops.measure_column(value_col, measure)
+        tl_dfs = [tl_i_map_df, tl_e_map_df]
+
+        years = np.concatenate([tl_df["odat"].to_numpy(dtype=np.int64) for tl_df in tl_dfs])
+        self.first_year = int(years.min()) if len(years) else 0
+        self.last_year = int(years.max()) if len(years) else -1
+        self.years = np.arange(self.first_year, self.last_year + 1)
+
+        sides = []
+        self.present = np.zeros((len(table), len(self.years)), dtype=bool)
+        for tl_df in tl_dfs:
+            values = np.zeros((len(table), len(self.years)))
+            ids = table.ids(tl_df["sipri_name"].astype(str), "name") if len(tl_df) else np.zeros(0, dtype=np.int64)
+            keep = ids >= 0
+            year = tl_df["odat"].to_numpy(dtype=np.int64)[keep] - self.first_year
+            values[ids[keep], year] = tl_df[value_col].to_numpy(dtype=np.float64)[keep]
+            self.present[ids[keep], year] = True
+            sides.append(values)
+        self.imports, self.exports = sides
+
+        total = self.imports + self.exports
+        self.net = self.exports - self.imports
+        self.ratio = np.divide(self.exports, self.imports, out=np.full_like(total, np.nan), where=self.imports != 0)
+        self.import_share = np.divide(self.imports, total, out=np.full_like(total, np.nan), where=total != 0)
+        self.export_share = np.divide(self.exports, total, out=np.full_like(total, np.nan), where=total != 0)
+
+    def df(self) -> pd.DataFrame:
+        """
+        Lists the cells with a row on either side.
+
+        :return: DataFrame with "country_id", "sipri_name", "iso_alpha", "odat", "imports", "exports", "net", "ratio",
+            "import_share" & "export_share", in (country ID, year) order
+        """
+        country_id, year = np.nonzero(self.present)
+        return pd.DataFrame({"country_id": country_id,
+                             "sipri_name": countries.COUNTRIES.names[country_id],
+                             "iso_alpha": countries.COUNTRIES.iso[country_id],
+                             "odat": self.years[year],
+                             "imports": self.imports[country_id, year],
+                             "exports": self.exports[country_id, year],
+                             "net": self.net[country_id, year],
+                             "ratio": self.ratio[country_id, year],
+                             "import_share": self.import_share[country_id, year],
+                             "export_share": self.export_share[country_id, year]})
@@ -0,0 +1,259 @@
+"""
+@file instrumentation.py
+
+The functions in this file are used for timing the stages of the pipeline (download, CSV parse, pivot, cumulative sums
+& gap-fill, derived metrics, regional rollups, CSV write, figure build, HTML & image write), counting what they process
+and writing a report of each run. Nothing is recorded unless instrumentation is enabled, either with the GWTM_PROFILE
+environment variable or with enable().
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+PROFILE_ENV = "GWTM_PROFILE"
+"""
+Environment variable that enables instrumentation when set to anything but "" or "0".
+"""
+
+PROFILE_STAGES_ENV = "GWTM_PROFILE_STAGES"
+"""
+Environment variable holding the comma-separated names of the stages to run under cProfile & tracemalloc.
+"""
+
+PROFILE_DIR = "profiles"
+"""
+Folder holding the reports, the cProfile statistics (.prof) & the tracemalloc snapshots (.tracemalloc).
+"""
+
+STAGES = ["download", "csv_parse", "pivot", "gap_fill", "metrics", "rollup", "csv_write", "figure_build", "html_write",
+          "image_write"]
+"""
+Names of the instrumented stages.
+"""
+
+_enabled = os.environ.get(PROFILE_ENV, "") not in ("", "0")
+_profile_stages = {name for name in os.environ.get(PROFILE_STAGES_ENV, "").split(",") if name}
+_events = []
+_counters = {}
+_lock = threading.Lock()
+_profiling = False
+
+
+class _NullStage:
+    """
+    Stage returned while instrumentation is disabled; entering & leaving it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    Records the start & duration of one run of a stage, optionally under cProfile & tracemalloc.
+    """
+
+    def __init__(self, name, args):
+        """
+        :param str name: Name of the stage
+        :param dict args: Details shown with the stage in the report
+        """
+        self.name = name
+        self.args = args
+        self.profiler = None
+        self.started_tracemalloc = False
+
+    def __enter__(self):
+        global _profiling
+
+        if self.name in _profile_stages:
+            with _lock:
+                # cProfile cannot run twice at once, so nested or concurrent runs of a profiled stage are only timed
+                if not _profiling:
+                    _profiling = True
+                    self.profiler = cProfile.Profile()
+            if self.profiler is not None:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started_tracemalloc = True
+                self.profiler.enable()
+
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _profiling
+
+        duration = time.perf_counter_ns() - self.start
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            file_name = os.path.join(PROFILE_DIR, f"{self.name}-{os.getpid()}-{self.start}")
+            self.profiler.dump_stats(file_name + ".prof")
+            tracemalloc.take_snapshot().dump(file_name + ".tracemalloc")
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+            with _lock:
+                _profiling = False
+
+        _events.append({"name": self.name, "start_ns": self.start, "duration_ns": duration, "pid": os.getpid(),
+                        "tid": threading.get_ident(), "args": self.args, "failed": exc_info[0] is not None})
+        return False
+
+
+def enabled() -> bool:
+    """
+    Tells whether instrumentation is enabled.
+
+    :return: True if stages & counters are being recorded
+    """
+    return _enabled
+
+
+def enable(profile_stages=()):
+    """
+    Enables instrumentation in this process and in the worker processes it starts afterwards.
+
+    :param profile_stages: Names of the stages to run under cProfile & tracemalloc
+    :return: None
+    """
+    global _enabled
+
+    _enabled = True
+    _profile_stages.update(profile_stages)
+    os.environ[PROFILE_ENV] = "1"
+    os.environ[PROFILE_STAGES_ENV] = ",".join(sorted(_profile_stages))
+
+
+def stage(name, **args):
+    """
+    Times a stage of the pipeline. Use as `with instrumentation.stage("pivot", country=key):`.
+
+    :param str name: Name of the stage, one of STAGES
+    :param args: Details shown with the stage in the report
+    :return: Context manager
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, args)
+
+
+def count(name, value=1):
+    """
+    Adds to a counter, e.g. the number of rows parsed or bytes written.
+
+    :param str name: Name of the counter
+    :param value: Amount to add (default 1)
+    :return: None
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def traced_call(func, *args):
+    """
+    Calls a function and collects what it recorded, so that a worker process can hand its stages back to the parent.
+    Use together with merge().
+
+    :param func: Function to call
+    :param args: Arguments of the function
+    :return: Tuple of the function's result & the recorded stages and counters (None if instrumentation is disabled)
+    """
+    if not _enabled:
+        return func(*args), None
+
+    # Forked workers start with a copy of the parent's records, which must not be handed back
+    with _lock:
+        events_start = len(_events)
+        counters_start = dict(_counters)
+    result = func(*args)
+
+    with _lock:
+        recorded = {"events": _events[events_start:],
+                    "counters": {name: value - counters_start.get(name, 0) for name, value in _counters.items()
+                                 if value != counters_start.get(name, 0)}}
+        del _events[events_start:]
+        _counters.clear()
+        _counters.update(counters_start)
+    return result, recorded
+
+
+def merge(traced):
+    """
+    Adds the stages & counters recorded by traced_call in a worker process to those of this process.
+
+    :param tuple traced: Value returned by traced_call
+    :return: The result of the function called by traced_call
+    """
+    result, recorded = traced
+    if recorded is not None and _enabled:
+        with _lock:
+            _events.extend(recorded["events"])
+            for name, value in recorded["counters"].items():
+                _counters[name] = _counters.get(name, 0) + value
+    return result
+
+
+def report() -> dict:
+    """
+    Summarizes what was recorded so far.
+
+    :return: Dictionary with per-stage "stages" totals (calls, seconds, slowest run), the "counters" and every recorded
+        stage run in "events"
+    """
+    stages = {}
+    for event in _events:
+        summary = stages.setdefault(event["name"], {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+        summary["calls"] += 1
+        summary["seconds"] += event["duration_ns"] / 1e9
+        summary["max_seconds"] = max(summary["max_seconds"], event["duration_ns"] / 1e9)
+
+    return {"stages": stages, "counters": dict(_counters), "events": list(_events)}
+
+
+def write_report(path=os.path.join(PROFILE_DIR, "report.json"), trace_path=None) -> dict:
+    """
+    Writes the report of this run as JSON and, optionally, as a Chrome trace (chrome://tracing or Perfetto).
+
+    :param str path: Path of the JSON report (default profiles/report.json)
+    :param str trace_path: Path of the Chrome trace file (default none)
+    :return: The report
+    """
+    run_report = report()
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as report_file:
+        json.dump(run_report, report_file, indent=1, default=str)
+
+    if trace_path is not None:
+        origin = min((event["start_ns"] for event in run_report["events"]), default=0)
+        trace_events = [{"name": event["name"], "ph": "X", "ts": (event["start_ns"] - origin) / 1000,
+                         "dur": event["duration_ns"] / 1000, "pid": event["pid"], "tid": event["tid"],
+                         "args": event["args"]}
+                        for event in run_report["events"]]
+        os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+        with open(trace_path, "w") as trace_file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file, default=str)
+
+    for name, summary in run_report["stages"].items():
+        print(f"{name:<16}{summary['calls']:6d} calls{summary['seconds']:10.3f}s")
+    for name, value in run_report["counters"].items():
+        print(f"{name:<16}{value:>12}")
+
+    return run_report
@@ -0,0 +1,34 @@
+"""
+@file lazy_import.py
+
+The functions in this file are used for importing heavy modules (pandas, Plotly, the SIPRI client...) only when one of
+their attributes is first used, so that starting main.py or drawing a single map does not pay for the modules of the
+stages that do not run.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_module(name):
+    """
+    Imports a module lazily: the module object is returned at once, and its code runs on the first attribute access.
+    Use as `pd = lazy_module("pandas")` in place of `import pandas as pd`.
+
+    :param str name: Full name of the module, e.g. "plotly.express"
+    :return: The module, loaded or not
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
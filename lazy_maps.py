@@ -0,0 +1,276 @@
+"""
+@file lazy_maps.py
+
+The functions in this file are used for exporting the timelapse maps as a lightweight page that loads one year at a
+time from per-year JSON files, and for previewing those pages with a small local web server.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import map_drawing
+from lazy_import import lazy_module
+
+np = lazy_module("numpy")
+offline = lazy_module("plotly.offline")
+plotly_utils = lazy_module("plotly.utils")
+
+LAZY_DIR = "plots/lazy"
+"""
+Folder holding the lazily-loaded maps.
+"""
+
+SHELL_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8" />
+<title>{title}</title>
+<script src="https://cdn.plot.ly/plotly-{plotlyjs_version}.min.js"></script>
+</head>
+<body>
+<div id="map" style="height:90vh; width:100%;"></div>
+<div style="margin: 0 10%;">
+    <button id="play">&#9654;</button>
+    <input id="year" type="range" min="0" max="{last_index}" value="0" style="width:80%;" />
+    <span id="label"></span>
+</div>
+<script type="text/javascript">
+    const years = {years};
+    const figure = {figure};
+    const dataDir = "{data_dir}/";
+    const cache = new Map();
+    const div = document.getElementById("map");
+    const slider = document.getElementById("year");
+    const label = document.getElementById("label");
+    let timer = null;
+
+    // Fetches a year's data once; later calls reuse the same promise
+    function load(index) {{
+        if (index < 0 || index >= years.length) {{
+            return null;
+        }}
+        if (!cache.has(index)) {{
+            cache.set(index, fetch(dataDir + years[index] + ".json").then(response => response.json()));
+        }}
+        return cache.get(index);
+    }}
+
+    async function show(index) {{
+        label.textContent = "Year=" + years[index];
+        const data = await load(index);
+        if (Number(slider.value) === index) {{
+            Plotly.restyle(div, {{z: [data.z], customdata: [data.customdata]}}, [0]);
+        }}
+        // Prefetch the neighbouring years
+        load(index - 1);
+        load(index + 1);
+    }}
+
+    slider.addEventListener("input", () => show(Number(slider.value)));
+    document.getElementById("play").addEventListener("click", () => {{
+        if (timer !== null) {{
+            clearInterval(timer);
+            timer = null;
+            return;
+        }}
+        timer = setInterval(() => {{
+            const next = Number(slider.value) + 1;
+            if (next >= years.length) {{
+                clearInterval(timer);
+                timer = null;
+                return;
+            }}
+            slider.value = next;
+            show(next);
+        }}, 500);
+    }});
+
+    cache.set(0, Promise.resolve(figure.data[0]));
+    Plotly.newPlot(div, figure.data, figure.layout).then(() => show(0));
+</script>
+</body>
+</html>
+"""
+"""
+Page that draws the first year of a map & fetches the other years on demand.
+"""
+
+
+def _to_json_list(array) -> list:
+    """
+    Converts an array to lists for JSON, writing integral floats as ints and NaN as null.
+
+    :param np.ndarray array: Array to convert
+    :return: Nested lists
+    """
+    if array.dtype.kind != "f":
+        return array.tolist()
+    if array.ndim > 1:
+        return [_to_json_list(row) for row in array]
+    return [None if np.isnan(value) else int(value) if value.is_integer() else value for value in array.tolist()]
+
+
+def export_lazy_tl_map(tl_map_df, is_import, out_dir=LAZY_DIR, year_window=None, measure="nrdel", metric="All") -> str:
+    """
+    Exports the "imports/exports over time" map as a shell page plus one JSON file per year.
+
+    :param tl_map_df: Map DataFrame or timelapse_query.TimelapseQuery, as for map_drawing.draw_tl_map
+    :param boolean is_import: True is data is imports, False if exports
+    :param str out_dir: Folder to export into (default LAZY_DIR)
+    :param tuple year_window: First & last year to draw (default the years of tl_map_df); see map_drawing.build_tl_map
+    :param str measure: One of db_ops.MEASURES to color the countries by (default "nrdel")
+    :param str metric: "All" or one of db_ops.METRICS to color the countries by (default "All")
+    :return: Path of the shell page, named like the HTML file of map_drawing.draw_tl_map, e.g.
+        "plots/lazy/imports_map_tivdel.html"
+    """
+    fig, file_name = map_drawing.build_tl_map(tl_map_df, is_import, year_window, measure, metric)
+    name = os.path.basename(file_name)[:-len(".html")]
+    title = fig.layout.title.text
+    years = [frame.name for frame in fig.frames]
+
+    data_dir = os.path.join(out_dir, name)
+    os.makedirs(data_dir, exist_ok=True)
+
+    # One small file per year with only what changes between years
+    for frame in fig.frames:
+        with open(os.path.join(data_dir, frame.name + ".json"), "w") as year_file:
+            json.dump({"z": _to_json_list(np.asarray(frame.data[0].z, dtype=np.float64)),
+                       "customdata": _to_json_list(np.asarray(frame.data[0].customdata))},
+                      year_file, separators=(",", ":"))
+
+    # The shell page carries the locations, names, layout & the first year, but no frames or Plotly slider
+    trace = fig.data[0]
+    figure = {
+        "data": [{"type": "choropleth",
+                  "locations": _to_json_list(np.asarray(trace.locations)),
+                  "hovertext": _to_json_list(np.asarray(trace.hovertext)),
+                  "z": _to_json_list(np.asarray(trace.z, dtype=np.float64)),
+                  "customdata": _to_json_list(np.asarray(trace.customdata)),
+                  "coloraxis": "coloraxis",
+                  "hovertemplate": trace.hovertemplate,
+                  "name": ""}],
+        "layout": fig.layout.to_plotly_json()
+    }
+    figure["layout"].pop("sliders", None)
+    figure["layout"].pop("updatemenus", None)
+
+    shell_path = os.path.join(out_dir, name + ".html")
+    with open(shell_path, "w") as shell_file:
+        shell_file.write(SHELL_TEMPLATE.format(title=title,
+                                               plotlyjs_version=offline.get_plotlyjs_version(),
+                                               last_index=max(len(years) - 1, 0),
+                                               years=json.dumps(years),
+                                               figure=json.dumps(figure, cls=plotly_utils.PlotlyJSONEncoder),
+                                               data_dir=name))
+
+    return shell_path
+
+
+class PreviewHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the exported maps with validation & caching headers, gzip-compressing text files when the client allows it.
+    """
+
+    COMPRESSIBLE = (".html", ".json", ".js", ".css")
+    """
+    Extensions of the files that get compressed.
+    """
+
+    MAX_AGE = 3600
+    """
+    Seconds a client may reuse a file before revalidating it.
+    """
+
+    MAX_CACHED = 64
+    """
+    Number of compressed files kept in memory before the least recently served ones are dropped.
+    """
+
+    _gzip_cache = OrderedDict()
+    """
+    Compressed contents & ETag of the most recently served files, keyed by path, with the modification time they were
+    read at.
+    """
+
+    _gzip_lock = threading.Lock()
+    """
+    Lock of _gzip_cache, shared by the request threads.
+    """
+
+    def end_headers(self):
+        self.send_header("Cache-Control", "public, max-age=" + str(self.MAX_AGE))
+        super().end_headers()
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path) or not path.endswith(self.COMPRESSIBLE) \
+                or "gzip" not in self.headers.get("Accept-Encoding", ""):
+            super().do_GET()
+            return
+
+        mtime = os.path.getmtime(path)
+        with self._gzip_lock:
+            cached = self._gzip_cache.get(path)
+            if cached is not None and cached[0] == mtime:
+                self._gzip_cache.move_to_end(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, "rb") as f:
+                content = f.read()
+            cached = (mtime, gzip.compress(content), '"' + hashlib.sha1(content).hexdigest() + '"')
+            with self._gzip_lock:
+                self._gzip_cache[path] = cached
+                self._gzip_cache.move_to_end(path)
+                while len(self._gzip_cache) > self.MAX_CACHED:
+                    self._gzip_cache.popitem(last=False)
+        _, body, etag = cached
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(directory=LAZY_DIR, port=8000):
+    """
+    Serves the exported maps on http://localhost:<port>/ until interrupted.
+
+    :param str directory: Folder to serve (default LAZY_DIR)
+    :param int port: Port to listen on (default 8000)
+    :return: None
+    """
+    with ThreadingHTTPServer(("localhost", port), partial(PreviewHandler, directory=directory)) as server:
+        print("Serving \"" + directory + "\" on http://localhost:" + str(port) + "/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    import db_ops
+
+    for is_import in (True, False):
+        print(export_lazy_tl_map(db_ops.load_tl_map_df(is_import), is_import))
+
+    serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
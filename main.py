@@ -8,11 +8,21 @@ Top-level operations for generating the map for the Global Weapons Tracking webs
 @author Jack Ayvazian
 """
 
+import argparse
 import os
-import shutil
-import gen_db
-import db_ops
+import time
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation
+import lazy_maps
 import map_drawing
+import sipri_info as si
+import static_export
+from lazy_import import lazy_module
+
+# The SIPRI client, pandas & Plotly are only imported by the stages that use them, so that the prompt shows at once
+gen_db = lazy_module("gen_db")
+db_ops = lazy_module("db_ops")
+timelapse_cache = lazy_module("timelapse_cache")
 
 
 def prompt(prompt_str) -> bool:
@@ -25,34 +35,185 @@ def prompt(prompt_str) -> bool:
     return input(prompt_str + " ").lower() == "y"
 
 
-if __name__ == "__main__":
+MAP_NAMES = ["imports", "exports", "transparency", "stockpiles", "combined", "flows", "regions"]
+"""
+Maps that can be drawn in batch mode.
+"""
+
+
+def render_map(name, tl_i_map_df, tl_e_map_df, year_window=None, measure="nrdel", metric="All",
+               combined_mode="facets", region_level="region", ending_year=si.LAST_YEAR) -> float:
+    """
+    Draws one map to its HTML file without opening a browser.
+
+    :param str name: One of MAP_NAMES
+    :param pd.DataFrame tl_i_map_df: DataFrame for Imports
+    :param pd.DataFrame tl_e_map_df: DataFrame for Exports
+    :param tuple year_window: First & last year of the import, export, flow & regions maps (default those of the
+        DataFrames, and 1992 to ending_year for the flow & regions maps)
+    :param str measure: One of db_ops.MEASURES shown on the import, export, combined & flow maps (default "nrdel")
+    :param str metric: "All" or one of db_ops.METRICS coloring the import & export maps (default "All")
+    :param str combined_mode: One of map_drawing.COMBINED_MODES (default "facets")
+    :param str region_level: One of map_drawing.REGION_LEVELS the "regions" import & export maps are drawn at (default
+        "region")
+    :param int ending_year: Last year of the timelapse (default sipri_info.LAST_YEAR)
+    :return: Seconds spent drawing the map
+    """
+    start = time.perf_counter()
+
+    if name == "imports":
+        map_drawing.draw_tl_map(tl_i_map_df, True, show=False, year_window=year_window, measure=measure,
+                                metric=metric)
+    elif name == "exports":
+        map_drawing.draw_tl_map(tl_e_map_df, False, show=False, year_window=year_window, measure=measure,
+                                metric=metric)
+    elif name == "transparency":
+        map_drawing.draw_transparency_map(db_ops.load_transparency_df(), show=False)
+    elif name == "stockpiles":
+        map_drawing.draw_stockpiles_map(db_ops.load_stockpiles_df(), show=False)
+    elif name == "combined":
+        map_drawing.draw_combined_ie_map(tl_i_map_df, tl_e_map_df, show=False, measure=measure, mode=combined_mode)
+    elif name == "flows":
+        starting_year, ending_year = year_window or (1992, ending_year)
+        map_drawing.draw_flow_map(db_ops.flow_map_df(measure, starting_year=starting_year, ending_year=ending_year),
+                                  db_ops.load_centroids_df(), measure, show=False)
+    elif name == "regions":
+        for is_import in (True, False):
+            map_drawing.draw_region_map(is_import, region_level, show=False, year_window=year_window, measure=measure,
+                                        ending_year=ending_year)
+
+    return time.perf_counter() - start
+
+
+def resolve_last_year(args) -> int:
+    """
+    Gets the last year of the timelapse maps. Only the stages that use it call this: without --last-year, the year is
+    read from the stored timelapse state by db_ops, which would slow down the start-up if it were read while parsing.
+
+    :param argparse.Namespace args: Parsed command-line arguments
+    :return: --last-year, or db_ops.default_ending_year() if it is not given
+    """
+    return db_ops.default_ending_year() if args.last_year is None else args.last_year
+
+
+def run_batch(args):
+    """
+    Runs the selected stages without prompting, drawing the maps in parallel worker processes, then reports the
+    wall-clock time of each stage.
+
+    :param argparse.Namespace args: Parsed command-line arguments
+    :return: None
+    """
+    timings = {}
+    last_year = resolve_last_year(args)
+
+    # With --append, only the years after those already stored are downloaded & added to the timelapse
+    stored_year = db_ops.stored_ending_year() if args.append else None
+    first_year = si.FIRST_YEAR if stored_year is None else stored_year + 1
+    if first_year > last_year:
+        # Nothing to query: every SIPRI query would span no year
+        print("No years after " + str(stored_year) + " up to " + str(last_year) + "; skipping the download & append")
+
+    start = time.perf_counter()
+    if args.download and first_year <= last_year:
+        gen_db.download_sipri_data_concurrent(workers=args.download_workers, low_year=str(first_year),
+                                              high_year=str(last_year), append=stored_year is not None)
+        timings["download"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if args.append and first_year > last_year:
+        tl_i_map_df, tl_e_map_df = db_ops.load_tl_map_df(True), db_ops.load_tl_map_df(False)
+    elif args.append:
+        tl_i_map_df, tl_e_map_df = db_ops.append_db_timelapse_years_both(last_year)
+    elif args.rebuild:
+        tl_i_map_df, tl_e_map_df = db_ops.update_db_timelapse_ops_both(ending_year=last_year, workers=args.db_workers)
+    else:
+        tl_i_map_df, tl_e_map_df = timelapse_cache.load_tl_map_dfs(ending_year=last_year, workers=args.db_workers)
+    timings["timelapse"] = time.perf_counter() - start
+
+    # Codes that do not join are left off the maps; --strict stops before drawing them
+    unmatched = db_ops.validate_countries()
+    instrumentation.count("unmatched_country_codes", sum(len(codes) for codes in unmatched.values()))
+    if unmatched and args.strict:
+        print("Unmatched country codes in " + ", ".join(unmatched) + "; stopping as --strict is set")
+        raise SystemExit(1)
 
+    os.makedirs("plots", exist_ok=True)
+    maps = MAP_NAMES if "all" in args.maps else [name for name in MAP_NAMES if name in args.maps]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(maps)))) as executor:
+        futures = {name: executor.submit(instrumentation.traced_call, render_map, name, tl_i_map_df, tl_e_map_df,
+                                         args.years, args.measure, args.metric, args.combined_mode, args.region_level,
+                                         last_year)
+                   for name in maps}
+        for name, future in futures.items():
+            timings["map: " + name] = instrumentation.merge(future.result())
+    timings["maps (wall clock)"] = time.perf_counter() - start
+
+    if args.static is not None:
+        start = time.perf_counter()
+        for name, tl_map_df, is_import in (("imports", tl_i_map_df, True), ("exports", tl_e_map_df, False)):
+            if name in maps:
+                print(static_export.export_tl_map(tl_map_df, is_import, args.years, args.measure, args.metric,
+                                                  args.static, args.animation, workers=args.workers,
+                                                  new_frames_only=args.append))
+        static_export.export_static_maps([name for name in ("transparency", "stockpiles") if name in maps],
+                                         args.static)
+        timings["static images"] = time.perf_counter() - start
+
+    if args.lazy:
+        start = time.perf_counter()
+        for name, tl_map_df, is_import in (("imports", tl_i_map_df, True), ("exports", tl_e_map_df, False)):
+            if name in maps:
+                print(lazy_maps.export_lazy_tl_map(tl_map_df, is_import, year_window=args.years,
+                                                   measure=args.measure, metric=args.metric))
+        timings["lazy maps"] = time.perf_counter() - start
+
+    for stage, seconds in timings.items():
+        print(f"{stage:<24}{seconds:8.2f}s")
+
+
+def run_interactive(args):
+    """
+    Asks the operator which stages to run, one prompt at a time.
+
+    :param argparse.Namespace args: Parsed command-line arguments; the options of the maps (--years, --measure...)
+        apply to the maps drawn after the prompts
+    :return: None
+    """
     if prompt("Download Import & Export Tables from SIPRI [y/N]?"):
-        gen_db.download_sipri_data()
+        gen_db.download_sipri_data_concurrent(high_year=str(resolve_last_year(args)))
 
+    tl_map_dfs = []
     if prompt("Perform import & export over-time database operations [y/N]?"):
-        tl_i_map_df = db_ops.perform_db_timelapse_ops(True)
-        tl_e_map_df = db_ops.perform_db_timelapse_ops(False)
-    else:
-        tl_i_map_df = db_ops.load_tl_map_df(True)
-        tl_e_map_df = db_ops.load_tl_map_df(False)
+        tl_map_dfs.extend(db_ops.update_db_timelapse_ops_both(ending_year=resolve_last_year(args),
+                                                              workers=args.db_workers))
+
+    def load_tl_map_dfs():
+        # The cached timelapse DataFrames are only read once a map needs them
+        if not tl_map_dfs:
+            tl_map_dfs.extend(timelapse_cache.load_tl_map_dfs(ending_year=resolve_last_year(args),
+                                                              workers=args.db_workers))
+        return tl_map_dfs
 
     try:
         # Try to create the "plots" folder locally
         os.mkdir("plots")
         print("\"plots\" folder created")
     except FileExistsError:
-        # If that folder already exists, wipe it & remake it
-        print("\"plots\" folder already exists; deleting & remaking")
-        if os.path.exists("plots"):
-            shutil.rmtree("plots")
-        os.mkdir("plots")
+        # If that folder already exists, delete the maps drawn by a previous run; the lazy pages & static exports in its
+        #  subfolders are kept, as they are updated in place
+        print("\"plots\" folder already exists; deleting the maps drawn before")
+        for file in os.listdir("plots"):
+            if file.endswith(".html") and os.path.isfile(os.path.join("plots", file)):
+                os.remove(os.path.join("plots", file))
 
     if prompt("Draw timelapse import map [y/N]?"):
-        map_drawing.draw_tl_map(tl_i_map_df, True)
+        map_drawing.draw_tl_map(load_tl_map_dfs()[0], True)
 
     if prompt("Draw timelapse export map [y/N]?"):
-        map_drawing.draw_tl_map(tl_e_map_df, False)
+        map_drawing.draw_tl_map(load_tl_map_dfs()[1], False)
 
     if prompt("Draw transparency map [y/N]?"):
         transparency_df = db_ops.load_transparency_df()
@@ -63,4 +224,91 @@ if __name__ == "__main__":
         map_drawing.draw_stockpiles_map(stockpiles_df)
 
     if prompt("Draw combined I/E map [y/N]?"):
-        map_drawing.draw_combined_ie_map(tl_i_map_df, tl_e_map_df)
+        map_drawing.draw_combined_ie_map(*load_tl_map_dfs())
+
+    if prompt("Draw seller -> buyer flow map [y/N]?"):
+        starting_year, last_year = args.years or (1992, resolve_last_year(args))
+        flows_df = db_ops.flow_map_df(args.measure, starting_year=starting_year, ending_year=last_year)
+        map_drawing.draw_flow_map(flows_df, db_ops.load_centroids_df(), args.measure)
+
+    if prompt("Draw regional import & export maps [y/N]?"):
+        for is_import in (True, False):
+            map_drawing.draw_region_map(is_import, args.region_level, year_window=args.years, measure=args.measure,
+                                        ending_year=resolve_last_year(args))
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    Parses the command-line arguments.
+
+    :param argv: Arguments to parse (default sys.argv[1:])
+    :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Generates the maps for the Global Weapons Tracking website. Without "
+                                                 "--batch, every stage is chosen through prompts.")
+    parser.add_argument("--batch", action="store_true",
+                        help="run the selected stages without prompting or opening a browser")
+    parser.add_argument("--download", action="store_true", help="download the import & export tables from SIPRI")
+    parser.add_argument("--download-workers", type=int, default=8, help="concurrent SIPRI queries (default 8)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="perform the over-time database operations instead of using the cached results")
+    parser.add_argument("--last-year", type=int,
+                        help="last year downloaded & shown on the timelapse maps (default the last stored year, which "
+                             "--append may have raised, or " + str(si.LAST_YEAR) + " if it is earlier); an earlier "
+                             "year drops the later ones")
+    parser.add_argument("--append", action="store_true",
+                        help="only download, add & export the years after the last stored year, up to --last-year, "
+                             "keeping the earlier years as they are")
+    parser.add_argument("--strict", action="store_true",
+                        help="stop before drawing the maps if any country code of the data does not join with "
+                             "countries.py")
+    parser.add_argument("--maps", nargs="*", choices=MAP_NAMES + ["all"], default=["all"],
+                        help="maps to draw (default all)")
+    parser.add_argument("--years", nargs=2, type=int, metavar=("FIRST", "LAST"),
+                        help="draw the import & export maps over these years only, with totals starting at FIRST")
+    parser.add_argument("--measure", choices=si.MEASURES, default="nrdel",
+                        help="measure shown on the import, export & combined maps (default nrdel, delivered units)")
+    parser.add_argument("--metric", choices=["All"] + si.METRICS, default="All",
+                        help="value coloring the import & export maps (default All, the running total)")
+    parser.add_argument("--combined-mode", choices=map_drawing.COMBINED_MODES, default="facets",
+                        help="combined map layout: import & export maps side by side, or one net balance map "
+                             "(default facets)")
+    parser.add_argument("--region-level", choices=map_drawing.REGION_LEVELS, default="region",
+                        help="grouping of the countries on the \"regions\" maps (default region)")
+    parser.add_argument("--static", choices=static_export.IMAGE_FORMATS,
+                        help="also export the import, export, transparency & stockpiles maps as images of this format "
+                             "in " + static_export.STATIC_DIR)
+    parser.add_argument("--animation", choices=static_export.ANIMATION_FORMATS, default="gif",
+                        help="animation assembled from the yearly images of --static (default gif)")
+    parser.add_argument("--lazy", action="store_true",
+                        help="also export the import & export maps as pages loading one year at a time, in "
+                             + lazy_maps.LAZY_DIR + " (preview them with python lazy_maps.py)")
+    parser.add_argument("--workers", type=int, default=len(MAP_NAMES),
+                        help="worker processes drawing the maps (default " + str(len(MAP_NAMES)) + ")")
+    parser.add_argument("--db-workers", type=int, default=1,
+                        help="worker processes reading the countries' deals when the timelapse is updated (default "
+                             "1); updates of a few countries stay in one process")
+    parser.add_argument("--profile", action="store_true",
+                        help="time every stage & write a report (same as setting " + instrumentation.PROFILE_ENV
+                             + "=1)")
+    parser.add_argument("--profile-stage", nargs="*", choices=instrumentation.STAGES, default=[],
+                        help="stages to run under cProfile & tracemalloc (implies --profile)")
+    parser.add_argument("--profile-report", default=os.path.join(instrumentation.PROFILE_DIR, "report.json"),
+                        help="path of the JSON report (default profiles/report.json)")
+    parser.add_argument("--chrome-trace", help="also write a Chrome trace file to this path")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+
+    parsed_args = parse_args()
+    if parsed_args.profile or parsed_args.profile_stage:
+        instrumentation.enable(parsed_args.profile_stage)
+
+    if parsed_args.batch:
+        run_batch(parsed_args)
+    else:
+        run_interactive(parsed_args)
+
+    if instrumentation.enabled():
+        instrumentation.write_report(parsed_args.profile_report, parsed_args.chrome_trace)
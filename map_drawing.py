@@ -8,27 +8,225 @@ The functions in this file are used for drawing the maps.
 @author Jack Ayvazian
 """
 
-import numpy as np
-import pandas as pd
-import plotly.express as px
-from plotly.offline import plot
+from __future__ import annotations
+
+import os
+
+import instrumentation
 import sipri_info as si
+from lazy_import import lazy_module
+
+# Plotly & the data modules take most of the start-up time, so they are only imported once a map is drawn
+np = lazy_module("numpy")
+pd = lazy_module("pandas")
+px = lazy_module("plotly.express")
+go = lazy_module("plotly.graph_objects")
+offline = lazy_module("plotly.offline")
+countries = lazy_module("countries")
+db_ops = lazy_module("db_ops")
+ie_balance = lazy_module("ie_balance")
+regions = lazy_module("regions")
+timelapse_query = lazy_module("timelapse_query")
 
 LAND_COLOR = "#dddddd"
 
+MEASURE_LABELS = {
+    "nrdel": "Delivered units",
+    "tivorder": "Ordered TIV",
+    "tivdel": "Delivered TIV"
+}
+"""
+Names shown on the maps for the deal columns they can be drawn from.
+"""
+
+METRIC_LABELS = {
+    "All": "Total",
+    "yearly": "In year",
+    "rolling_3": "Last 3 years",
+    "rolling_5": "Last 5 years",
+    "yoy_change": "Change on previous year",
+    "yoy_pct": "% change on previous year",
+    "share": "Share of world total"
+}
+"""
+Names shown on the maps for the values they can color the countries by: the running total or one of db_ops.METRICS.
+"""
+
+COMBINED_MODES = ["facets", "net"]
+"""
+Layouts of the combined imports & exports map: both maps side by side, or a single map of the net balance.
+"""
+
+REGION_LEVELS = ["subregion", "region", "bloc"]
+"""
+Levels of regions.LEVELS the import & export maps can be drawn at, every country showing the totals of its group.
+"""
+
 
-def draw_tl_map(tl_map_df, is_import):
+def animation_controls(frame_names, prefix="Year="):
     """
-    Draws the "imports/exports over time" map using Plotly.
+    Creates the play/pause buttons & the slider of an animated map, laid out like Plotly Express does.
+
+    :param frame_names: Names of the frames, in order
+    :param str prefix: Text shown before the name of the current frame
+    :return: Tuple of the layout's "updatemenus" & "sliders"
+    """
+    def animate_args(duration):
+        return {"frame": {"duration": duration, "redraw": True}, "mode": "immediate", "fromcurrent": True,
+                "transition": {"duration": duration, "easing": "linear"}}
+
+    updatemenus = [{"buttons": [{"args": [None, animate_args(500)], "label": "&#9654;", "method": "animate"},
+                                {"args": [[None], animate_args(0)], "label": "&#9724;", "method": "animate"}],
+                    "direction": "left", "pad": {"r": 10, "t": 70}, "showactive": False, "type": "buttons",
+                    "x": 0.1, "xanchor": "right", "y": 0, "yanchor": "top"}]
+    sliders = [{"active": 0, "currentvalue": {"prefix": prefix}, "len": 0.9, "pad": {"b": 10, "t": 60},
+                "steps": [{"args": [[name], animate_args(0)], "label": name, "method": "animate"}
+                          for name in frame_names],
+                "x": 0.1, "xanchor": "left", "y": 0, "yanchor": "top"}]
+    return updatemenus, sliders
+
+
+def build_tl_figure(tl_map_df, title, color, value_col="All", value_label="Total", measure="nrdel") -> go.Figure:
+    """
+    Builds an animated choropleth figure over the years of a timelapse DataFrame.
+
+    The locations & country names are set once on the base trace; every frame only carries the year's "z" values and
+    the weapon category breakdown shown on hover, and all frames share the figure's layout.
 
     :param pd.DataFrame tl_map_df: Map DataFrame for drawing choropleth map over time.
-    :param boolean is_import: True is data is imports, False if exports
-    :return: None, but creates HTML file
+    :param str title: Title of the map
+    :param str color: Name of the color scale
+    :param str value_col: Column giving the color of each country (default "All")
+    :param str value_label: Name of that column on hover & on the color bar (default "Total")
+    :param str measure: One of db_ops.MEASURES; the value column & the weapon category breakdown are taken from the
+        columns of that measure (default "nrdel")
+    :return: Plotly figure
+    """
+    years = np.sort(tl_map_df["odat"].unique())
+    country_rows = tl_map_df.drop_duplicates("iso_alpha")
+    locations = country_rows["iso_alpha"].astype(str).to_numpy()
+    value_col = db_ops.measure_column(value_col, measure)
+    wcats = [wcat for wcat in si.WCATS_DICT if db_ops.measure_column(wcat, measure) in tl_map_df.columns]
+    wcat_cols = [db_ops.measure_column(wcat, measure) for wcat in wcats]
+
+    # Lay the values out as year x country (x weapon category) arrays; countries without data in a year are NaN
+    grid = pd.MultiIndex.from_product([years, locations], names=["odat", "iso_alpha"])
+    values = tl_map_df.astype({"iso_alpha": str}).set_index(["odat", "iso_alpha"])[[value_col] + wcat_cols]
+    values = values.reindex(grid)
+    z = values[value_col].to_numpy(dtype=np.float64).reshape(len(years), len(locations))
+    breakdown = values[wcat_cols].fillna(0).to_numpy(dtype=np.int64 if measure == "nrdel" else np.float64)
+    breakdown = breakdown.round(2).reshape(len(years), len(locations), len(wcats))
+    year_col = np.broadcast_to(years.astype(np.int64)[:, None, None], (len(years), len(locations), 1))
+    customdata = np.concatenate([breakdown, year_col], axis=2)
+
+    hovertemplate = ("<b>%{hovertext}</b><br><br>Year=%{customdata[" + str(len(wcats)) + "]}"
+                     "<br>ISO Code=%{location}"
+                     + "".join("<br>" + si.WCATS_DICT[wcat] + "=%{customdata[" + str(i) + "]}"
+                               for i, wcat in enumerate(wcats))
+                     + "<br>" + value_label + "=%{z}<extra></extra>")
+
+    fig = go.Figure(
+        data=[go.Choropleth(locations=locations,
+                            hovertext=country_rows["sipri_name"].astype(str).to_numpy(),
+                            z=z[0],
+                            customdata=customdata[0],
+                            coloraxis="coloraxis",
+                            hovertemplate=hovertemplate,
+                            name="")],
+        frames=[go.Frame(data=[go.Choropleth(z=z[i], customdata=customdata[i])], name=str(year), traces=[0])
+                for i, year in enumerate(years)])
+
+    updatemenus, sliders = animation_controls([str(year) for year in years])
+    fig.update_layout(title=title,
+                      coloraxis={"colorscale": color,
+                                 "cmin": np.nanmin(z) if z.size else 0,
+                                 "cmax": np.nanmax(z) if z.size else 0,
+                                 "colorbar": {"title": {"text": value_label}}},
+                      geo={"projection": {"type": "robinson"}, "landcolor": LAND_COLOR},
+                      updatemenus=updatemenus,
+                      sliders=sliders)
+
+    return fig
+
+
+def build_balance_figure(balance, title, value_label="Total") -> go.Figure:
+    """
+    Builds an animated choropleth figure of the net balance (exports - imports) of every country over the years, on a
+    diverging color scale centered on 0: net importers in red & net exporters in blue.
+
+    :param ie_balance.ImportExportBalance balance: Imports & exports on a shared country x year grid
+    :param str title: Title of the map
+    :param str value_label: Name of the compared value on hover (default "Total")
+    :return: Plotly figure
     """
-    #TODO: add "iso_alpha": "ISO Code" to the dictionary for renaming parts of the DataFrame
+    # Year x country arrays of the countries with a row in any year; those without data in a year are NaN
+    ids = np.nonzero(balance.present.any(axis=1))[0]
+    z = np.where(balance.present[ids], balance.net[ids], np.nan).T.round(2)
+    year_col = np.broadcast_to(balance.years[:, None].astype(np.float64), z.shape)
+    customdata = np.stack([balance.imports[ids].T, balance.exports[ids].T, balance.ratio[ids].T,
+                           100 * balance.export_share[ids].T, year_col], axis=2).round(2)
+
+    hovertemplate = ("<b>%{hovertext}</b><br><br>Year=%{customdata[4]}"
+                     "<br>ISO Code=%{location}"
+                     "<br>Imports (" + value_label + ")=%{customdata[0]}"
+                     "<br>Exports (" + value_label + ")=%{customdata[1]}"
+                     "<br>Export/import ratio=%{customdata[2]}"
+                     "<br>Exports share=%{customdata[3]}%"
+                     "<br>Net balance=%{z}<extra></extra>")
+
+    fig = go.Figure(
+        data=[go.Choropleth(locations=countries.COUNTRIES.iso[ids],
+                            hovertext=countries.COUNTRIES.names[ids],
+                            z=z[0] if len(z) else [],
+                            customdata=customdata[0] if len(customdata) else [],
+                            coloraxis="coloraxis",
+                            hovertemplate=hovertemplate,
+                            name="")],
+        frames=[go.Frame(data=[go.Choropleth(z=z[i], customdata=customdata[i])], name=str(year), traces=[0])
+                for i, year in enumerate(balance.years)])
+
+    # Symmetric range, so that a balance of 0 is the middle of the scale
+    bound = np.nanmax(np.abs(z)) if np.isfinite(z).any() else 1
+    updatemenus, sliders = animation_controls([str(year) for year in balance.years])
+    fig.update_layout(title=title,
+                      coloraxis={"colorscale": "RdBu", "cmin": -bound, "cmid": 0, "cmax": bound,
+                                 "colorbar": {"title": {"text": "Net balance"}}},
+                      geo={"projection": {"type": "robinson"}, "landcolor": LAND_COLOR},
+                      updatemenus=updatemenus,
+                      sliders=sliders)
+
+    return fig
+
+
+def write_html(fig, file_name):
+    """
+    Exports a figure to an HTML file that loads Plotly from its CDN.
+
+    :param go.Figure fig: Figure to export
+    :param str file_name: Path of the HTML file
+    :return: None
+    """
+    with instrumentation.stage("html_write", map=file_name):
+        fig.write_html(file_name, include_plotlyjs="cdn")
+    if instrumentation.enabled():
+        instrumentation.count("html_bytes", os.path.getsize(file_name))
 
-    tl_map_df = tl_map_df.sort_values(by="odat")
 
+def build_tl_map(tl_map_df, is_import, year_window=None, measure="nrdel", metric="All") -> tuple:
+    """
+    Builds the "imports/exports over time" map, without writing it.
+
+    :param tl_map_df: Map DataFrame for drawing choropleth map over time, or a timelapse_query.TimelapseQuery
+    :param boolean is_import: True is data is imports, False if exports
+    :param tuple year_window: First & last year to draw, with totals accumulated from the first one; the map is then
+        built from tl_map_df if it is a TimelapseQuery, or else from timelapse_query.load_timelapse_query (default the
+        years of tl_map_df)
+    :param str measure: One of db_ops.MEASURES to color the countries by (default "nrdel"); other measures than
+        "nrdel" are written to their own file, e.g. "plots/imports_map_tivdel.html"
+    :param str metric: "All" to color the countries by their running total, or one of db_ops.METRICS (default "All");
+        other metrics are written to their own file, e.g. "plots/imports_map_rolling_5.html"
+    :return: Tuple of the Plotly figure & the path of its HTML file
+    """
     if is_import:
         title = "Imports"
         file_name = "plots/imports_map.html"
@@ -38,111 +236,375 @@ def draw_tl_map(tl_map_df, is_import):
         file_name = "plots/exports_map.html"
         color = "amp"
 
-    fig = px.choropleth(tl_map_df,
-                        locations="iso_alpha",
-                        hover_name="sipri_name",
-                        color="All",
-                        range_color=[tl_map_df["All"].min(), tl_map_df["All"].max()],
-                        animation_group="sipri_name",
-                        animation_frame="odat",
-                        hover_data=si.WCATS_DICT.keys(),
-                        labels=dict(si.WCATS_DICT, **{"odat": "Year", "All": "Total"}),
-                        title="Major Conventional Weapon " + title + " over time (Source: Stockholm International Peace Research Institute)",
-                        color_continuous_scale=color,
-                        projection="robinson")
-
-    fig.update_geos(landcolor=LAND_COLOR)
+    if isinstance(tl_map_df, timelapse_query.TimelapseQuery) or year_window is not None:
+        query = tl_map_df if isinstance(tl_map_df, timelapse_query.TimelapseQuery) else \
+            timelapse_query.load_timelapse_query(is_import)
+        tl_map_df = query.tl_map_df(*(year_window or (None, None)))
+        if year_window is not None:
+            title += " " + str(year_window[0]) + "-" + str(year_window[1])
+
+    # Timelapse DataFrames written before the metrics existed get them computed here
+    if db_ops.measure_column(metric, measure) not in tl_map_df.columns:
+        tl_map_df = db_ops.add_derived_metrics(tl_map_df)
+
+    value_label = METRIC_LABELS[metric]
+    if measure != "nrdel":
+        title += " (" + MEASURE_LABELS[measure] + ")"
+        file_name = file_name[:-len(".html")] + "_" + measure + ".html"
+        value_label += " " + MEASURE_LABELS[measure]
+    if metric != "All":
+        title += " - " + METRIC_LABELS[metric]
+        file_name = file_name[:-len(".html")] + "_" + metric + ".html"
+
+    with instrumentation.stage("figure_build", map=file_name):
+        fig = build_tl_figure(tl_map_df,
+                              "Major Conventional Weapon " + title + " over time (Source: Stockholm International "
+                              "Peace Research Institute)",
+                              color,
+                              value_col=metric,
+                              value_label=value_label,
+                              measure=measure)
+
+    return fig, file_name
+
+
+def draw_tl_map(tl_map_df, is_import, show=True, year_window=None, measure="nrdel", metric="All"):
+    """
+    Draws the "imports/exports over time" map using Plotly.
+
+    :param tl_map_df: Map DataFrame for drawing choropleth map over time, or a timelapse_query.TimelapseQuery
+    :param boolean is_import: True is data is imports, False if exports
+    :param boolean show: True to also open the map in a browser (default True)
+    :param tuple year_window: First & last year to draw (default the years of tl_map_df); see build_tl_map
+    :param str measure: One of db_ops.MEASURES to color the countries by (default "nrdel"); see build_tl_map
+    :param str metric: "All" or one of db_ops.METRICS to color the countries by (default "All"); see build_tl_map
+    :return: None, but creates HTML file
+    """
+    fig, file_name = build_tl_map(tl_map_df, is_import, year_window, measure, metric)
 
     # Plot the figure
-    plot(fig)
+    if show:
+        offline.plot(fig)
     # Export to HTML
-    fig.write_html(file_name, include_plotlyjs="cdn")
+    write_html(fig, file_name)
+
+
+def build_region_map(is_import, level="region", year_window=None, measure="nrdel", cube=None,
+                     ending_year=None) -> tuple:
+    """
+    Builds the "imports/exports over time" map at a regional level, without writing it: every country is colored by the
+    running total of its group, read from the precomputed cells of a regions.RollupCube.
 
+    :param boolean is_import: True is data is imports, False if exports
+    :param str level: One of REGION_LEVELS (default "region")
+    :param tuple year_window: First & last year to draw, with totals accumulated from the first one (default 1992 to
+        ending_year)
+    :param str measure: One of db_ops.MEASURES to color the groups by (default "nrdel")
+    :param regions.RollupCube cube: Rollup of the imports or exports (default regions.load_rollup_cube over the years of
+        year_window)
+    :param int ending_year: Last year of the timelapse when there is no year_window (default
+        db_ops.default_ending_year())
+    :return: Tuple of the Plotly figure & the path of its HTML file, e.g. "plots/imports_region_map.html"
+    """
+    if cube is None:
+        cube = regions.load_rollup_cube(is_import, *(year_window or (1992, ending_year)))
+    title = ("Imports" if is_import else "Exports") + " by " + level
+    file_name = "plots/" + ("imports" if is_import else "exports") + "_" + level + "_map.html"
+    value_label = METRIC_LABELS["All"]
+
+    if year_window is not None:
+        title += " " + str(year_window[0]) + "-" + str(year_window[1])
+    if measure != "nrdel":
+        title += " (" + MEASURE_LABELS[measure] + ")"
+        file_name = file_name[:-len(".html")] + "_" + measure + ".html"
+        value_label += " " + MEASURE_LABELS[measure]
+
+    with instrumentation.stage("figure_build", map=file_name):
+        fig = build_tl_figure(cube.tl_map_df(level, *(year_window or (None, None)), measure=measure),
+                              "Major Conventional Weapon " + title + " over time (Source: Stockholm International "
+                              "Peace Research Institute)",
+                              "dense" if is_import else "amp",
+                              value_label=value_label,
+                              measure=measure)
+
+    return fig, file_name
+
+
+def draw_region_map(is_import, level="region", show=True, year_window=None, measure="nrdel", cube=None,
+                    ending_year=None):
+    """
+    Draws the "imports/exports over time" map at a regional level using Plotly.
 
-def draw_transparency_map(transparency_df):
+    :param boolean is_import: True is data is imports, False if exports
+    :param str level: One of REGION_LEVELS (default "region")
+    :param boolean show: True to also open the map in a browser (default True)
+    :param tuple year_window: First & last year to draw (default 1992 to ending_year); see build_region_map
+    :param str measure: One of db_ops.MEASURES to color the groups by (default "nrdel")
+    :param regions.RollupCube cube: Rollup of the imports or exports (default regions.load_rollup_cube)
+    :param int ending_year: Last year of the timelapse when there is no year_window (default
+        db_ops.default_ending_year())
+    :return: None, but creates HTML file
+    """
+    fig, file_name = build_region_map(is_import, level, year_window, measure, cube, ending_year)
+
+    if show:
+        offline.plot(fig)
+    write_html(fig, file_name)
+
+
+def great_circle_arcs(lat1, lon1, lat2, lon2, points=16) -> tuple:
+    """
+    Interpolates the great-circle arcs between pairs of points.
+
+    :param np.ndarray lat1: Latitudes of the starting points, in degrees
+    :param np.ndarray lon1: Longitudes of the starting points, in degrees
+    :param np.ndarray lat2: Latitudes of the end points, in degrees
+    :param np.ndarray lon2: Longitudes of the end points, in degrees
+    :param int points: Number of points along each arc, ends included (default 16)
+    :return: Tuple of the latitudes & longitudes along the arcs, as arrays with one row per arc
+    """
+    def unit_vectors(lat, lon):
+        lat, lon = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+        return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+    start, end = unit_vectors(lat1, lon1), unit_vectors(lat2, lon2)
+    omega = np.arccos(np.clip(np.sum(start * end, axis=-1), -1.0, 1.0))[:, None, None]
+    t = np.linspace(0.0, 1.0, points)[None, :, None]
+
+    # Spherical interpolation, falling back to a straight line between (almost) identical points
+    sin_omega = np.sin(omega)
+    safe = sin_omega > 1e-9
+    weight_start = np.where(safe, np.sin((1 - t) * omega) / np.where(safe, sin_omega, 1.0), 1 - t)
+    weight_end = np.where(safe, np.sin(t * omega) / np.where(safe, sin_omega, 1.0), t)
+    arc = weight_start * start[:, None, :] + weight_end * end[:, None, :]
+
+    lats = np.degrees(np.arcsin(np.clip(arc[..., 2] / np.linalg.norm(arc, axis=-1), -1.0, 1.0)))
+    lons = np.degrees(np.arctan2(arc[..., 1], arc[..., 0]))
+    return lats, lons
+
+
+def _with_gaps(values) -> list:
+    """
+    Flattens one row per line into a single list, with a gap (None) after each line, so that Plotly draws every line
+    of a trace separately.
+
+    :param np.ndarray values: Array with one row per line
+    :return: List of floats & Nones
+    """
+    padded = np.full((values.shape[0], values.shape[1] + 1), np.nan)
+    padded[:, :-1] = values
+    return [None if np.isnan(value) else value for value in padded.ravel().tolist()]
+
+
+def build_flow_figure(flow_map_df, centroids_df, measure="nrdel", points=16) -> go.Figure:
+    """
+    Builds an animated map of the seller -> buyer flows of each year. Whatever the number of flows, each frame holds
+    two traces: every arc of the year batched into one line trace, and one marker per arc, at its middle, sized &
+    colored by the flow and showing its details on hover.
+
+    :param pd.DataFrame flow_map_df: Flows, as returned by db_ops.flow_map_df
+    :param pd.DataFrame centroids_df: Country centroids, as returned by db_ops.load_centroids_df
+    :param str measure: Column of flow_map_df holding the size of each flow (default "nrdel")
+    :param int points: Number of points along each arc (default 16)
+    :return: Plotly figure
+    """
+    flow_map_df = flow_map_df[flow_map_df["seller"].isin(centroids_df.index) &
+                              flow_map_df["buyer"].isin(centroids_df.index)]
+    years = np.sort(flow_map_df["odat"].unique())
+    lats, lons = great_circle_arcs(centroids_df.loc[flow_map_df["seller"], "lat"],
+                                   centroids_df.loc[flow_map_df["seller"], "lon"],
+                                   centroids_df.loc[flow_map_df["buyer"], "lat"],
+                                   centroids_df.loc[flow_map_df["buyer"], "lon"],
+                                   points)
+    values = flow_map_df[measure].to_numpy(dtype=np.float64)
+    max_value = values.max() if len(values) else 1.0
+    label = MEASURE_LABELS.get(measure, measure)
+    hovertext = (flow_map_df["seller_name"].astype(str) + " \u2192 " + flow_map_df["buyer_name"].astype(str)
+                 + "<br>" + label + "=" + flow_map_df[measure].round(2).astype(str)).to_numpy()
+
+    def year_traces(year):
+        rows = np.flatnonzero(flow_map_df["odat"].to_numpy() == year)
+        return [go.Scattergeo(lat=_with_gaps(lats[rows]), lon=_with_gaps(lons[rows]), mode="lines",
+                              line={"width": 1, "color": "rgba(120, 30, 30, 0.5)"}, hoverinfo="skip"),
+                go.Scattergeo(lat=lats[rows, points // 2], lon=lons[rows, points // 2], mode="markers",
+                              marker={"size": 4 + 26 * np.sqrt(values[rows] / max_value), "color": values[rows],
+                                      "coloraxis": "coloraxis", "opacity": 0.8},
+                              hovertext=hovertext[rows], hoverinfo="text")]
+
+    first_traces = year_traces(years[0]) if len(years) else [go.Scattergeo(), go.Scattergeo()]
+    fig = go.Figure(data=first_traces,
+                    frames=[go.Frame(data=year_traces(year), name=str(year), traces=[0, 1]) for year in years])
+
+    updatemenus, sliders = animation_controls([str(year) for year in years])
+    fig.update_layout(title="Major Conventional Weapon Transfers over time (Source: Stockholm International Peace "
+                            "Research Institute)",
+                      coloraxis={"colorscale": "amp", "cmin": 0, "cmax": max_value,
+                                 "colorbar": {"title": {"text": label}}},
+                      geo={"projection": {"type": "robinson"}, "landcolor": LAND_COLOR, "showcountries": True},
+                      showlegend=False,
+                      updatemenus=updatemenus,
+                      sliders=sliders)
+
+    return fig
+
+
+def draw_flow_map(flow_map_df, centroids_df, measure="nrdel", show=True):
+    """
+    Draws the "who is arming whom" map of seller -> buyer flows over time using Plotly.
+
+    :param pd.DataFrame flow_map_df: Flows, as returned by db_ops.flow_map_df
+    :param pd.DataFrame centroids_df: Country centroids, as returned by db_ops.load_centroids_df
+    :param str measure: Column of flow_map_df holding the size of each flow (default "nrdel")
+    :param boolean show: True to also open the map in a browser (default True)
+    :return: None, but creates HTML file
+    """
+    with instrumentation.stage("figure_build", map="plots/flow_map.html"):
+        fig = build_flow_figure(flow_map_df, centroids_df, measure)
+
+    # Plot the figure
+    if show:
+        offline.plot(fig)
+    # Export to HTML
+    write_html(fig, "plots/flow_map.html")
+
+
+def build_transparency_figure(transparency_df) -> go.Figure:
+    """
+    Builds the "Transparency indicator" map, without writing it.
+
+    :param pd.DataFrame transparency_df: Map DataFrame for drawing choropleth map.
+    :return: Plotly figure
+    """
+    with instrumentation.stage("figure_build", map="plots/transparency_map.html"):
+        fig = px.choropleth(transparency_df,
+                            locations=transparency_df.index,
+                            hover_name="name",
+                            color="Total Reports",
+                            hover_data=['Exports/Imports', 'Military Holdings', 'National Production', 'SALW'],
+                            title="Transparency Indicator: Number of voluntary UNROCA weapon reports 1992-2020",
+                            color_continuous_scale="algae",
+                            projection="robinson")
+
+        fig.update_geos(landcolor=LAND_COLOR)
+
+    return fig
+
+
+def draw_transparency_map(transparency_df, show=True):
     """
     Draws the "Transparency indicator" map using Plotly.
 
     :param pd.DataFrame transparency_df: Map DataFrame for drawing choropleth map.
+    :param boolean show: True to also open the map in a browser (default True)
     :return: None, but creates HTML file
     """
-    fig = px.choropleth(transparency_df,
-                        locations=transparency_df.index,
-                        hover_name="name",
-                        color="Total Reports",
-                        hover_data=['Exports/Imports', 'Military Holdings', 'National Production', 'SALW'],
-                        title="Transparency Indicator: Number of voluntary UNROCA weapon reports 1992-2020",
-                        color_continuous_scale="algae",
-                        projection="robinson")
-
-    fig.update_geos(landcolor=LAND_COLOR)
+    fig = build_transparency_figure(transparency_df)
 
     # Plot the figure
-    plot(fig)
+    if show:
+        offline.plot(fig)
     # Export to HTML
-    fig.write_html("plots/transparency_map.html", include_plotlyjs="cdn")
+    write_html(fig, "plots/transparency_map.html")
 
 
-def draw_stockpiles_map(stockpiles_df):
+def build_stockpiles_figure(stockpiles_df) -> go.Figure:
+    """
+    Builds the "Stockpiles" map, without writing it.
+
+    :param pd.DataFrame stockpiles_df: Map DataFrame for drawing choropleth map.
+    :return: Plotly figure
+    """
+    with instrumentation.stage("figure_build", map="plots/stockpiles_map.html"):
+        fig = px.choropleth(stockpiles_df,
+                            locations=stockpiles_df.index,
+                            hover_name="name",
+                            color="Stockpiles",
+                            hover_data=['Year', 'Tanks', 'Combat vehicles', 'Artillery', 'Aircraft', 'Helicopters',
+                                        'Warships', 'Missiles/Missile launchers', 'Stockpiles'],
+                            title="Major Conventional Weapon Stockpiles (Source: UNROCA)",
+                            color_continuous_scale="Burg",
+                            projection="robinson")
+
+        fig.update_geos(landcolor=LAND_COLOR)
+
+    return fig
+
+
+def draw_stockpiles_map(stockpiles_df, show=True):
     """
     Draws the "Stockpiles" map using Plotly.
 
     :param pd.DataFrame stockpiles_df: Map DataFrame for drawing choropleth map.
+    :param boolean show: True to also open the map in a browser (default True)
     :return: None, but creates HTML file
     """
-    fig = px.choropleth(stockpiles_df,
-                        locations=stockpiles_df.index,
-                        hover_name="name",
-                        color="Stockpiles",
-                        hover_data=['Year', 'Tanks', 'Combat vehicles', 'Artillery', 'Aircraft', 'Helicopters',
-                                    'Warships', 'Missiles/Missile launchers', 'Stockpiles'],
-                        title="Major Conventional Weapon Stockpiles (Source: UNROCA)",
-                        color_continuous_scale="Burg",
-                        projection="robinson")
-
-    fig.update_geos(landcolor=LAND_COLOR)
+    fig = build_stockpiles_figure(stockpiles_df)
 
     # Plot the figure
-    plot(fig)
+    if show:
+        offline.plot(fig)
     # Export to HTML
-    fig.write_html("plots/stockpiles_map.html", include_plotlyjs="cdn")
+    write_html(fig, "plots/stockpiles_map.html")
 
 
 
-def draw_combined_ie_map(tl_i_map_df, tl_e_map_df):
+def draw_combined_ie_map(tl_i_map_df, tl_e_map_df, show=True, measure="nrdel", mode="facets"):
     """
     Draws a combined version of the imports & exports map over time.
 
     :param pd.DataFrame tl_i_map_df: DataFrame for Imports
     :param pd.DataFrame tl_e_map_df: DataFrame for Exports
+    :param boolean show: True to also open the map in a browser (default True)
+    :param str measure: One of db_ops.MEASURES to color the countries by (default "nrdel")
+    :param str mode: One of COMBINED_MODES: "facets" draws the import & export maps side by side, "net" draws a single
+        map of the net balance, written to "plots/combined_ie_map_net.html" (default "facets")
     :return: none, but creates HTML file
     """
-
-    tl_i_map_df = tl_i_map_df.astype({'odat': np.int64}).sort_values(by="odat")
-    tl_e_map_df = tl_e_map_df.astype({'odat': np.int64}).sort_values(by="odat")
-
-    tl_i_map_df["isImport"] = True
-    tl_e_map_df["isImport"] = False
-
-    combined_tl_map_df = tl_i_map_df.append(tl_e_map_df, ignore_index=True)
-
-    fig = px.choropleth(combined_tl_map_df,
-                        locations="iso_alpha",
-                        hover_name="sipri_name",
-                        color="All",
-                        animation_group="sipri_name",
-                        animation_frame="odat",
-                        range_color=[combined_tl_map_df["All"].min(), combined_tl_map_df["All"].max()],
-                        hover_data=si.WCATS_DICT.keys(),
-                        labels=dict(si.WCATS_DICT, **{"odat": "Year", "All": "Total"}),
-                        title="Test",
-                        facet_col="isImport",
-                        # color_continuous_scale=color,
-                        projection="robinson")
-
-    # fig.update_geos(landcolor=LAND_COLOR)
+    if mode == "net":
+        file_name = "plots/combined_ie_map_net.html"
+        with instrumentation.stage("figure_build", map=file_name):
+            balance = ie_balance.ImportExportBalance(tl_i_map_df, tl_e_map_df, measure)
+            value_label = "Total" if measure == "nrdel" else "Total " + MEASURE_LABELS[measure]
+            fig = build_balance_figure(balance,
+                                       "Major Conventional Weapon Net Exports (Exports - Imports) over time (Source: "
+                                       "Stockholm International Peace Research Institute)",
+                                       value_label)
+
+        if show:
+            offline.plot(fig)
+        write_html(fig, file_name)
+        return
+
+    total_col = db_ops.measure_column("All", measure)
+    wcat_cols = {db_ops.measure_column(wcat, measure): name for wcat, name in si.WCATS_DICT.items()}
+
+    with instrumentation.stage("figure_build", map="plots/combined_ie_map.html"):
+        tl_i_map_df = tl_i_map_df.astype({'odat': np.int64}).sort_values(by="odat")
+        tl_e_map_df = tl_e_map_df.astype({'odat': np.int64}).sort_values(by="odat")
+
+        tl_i_map_df["isImport"] = True
+        tl_e_map_df["isImport"] = False
+
+        combined_tl_map_df = pd.concat([tl_i_map_df, tl_e_map_df], ignore_index=True)
+
+        fig = px.choropleth(combined_tl_map_df,
+                            locations="iso_alpha",
+                            hover_name="sipri_name",
+                            color=total_col,
+                            animation_group="sipri_name",
+                            animation_frame="odat",
+                            range_color=[combined_tl_map_df[total_col].min(), combined_tl_map_df[total_col].max()],
+                            hover_data=[col for col in wcat_cols if col in combined_tl_map_df.columns],
+                            labels=dict(wcat_cols, **{"odat": "Year", total_col: "Total"}),
+                            title="Test",
+                            facet_col="isImport",
+                            # color_continuous_scale=color,
+                            projection="robinson")
+
+        # fig.update_geos(landcolor=LAND_COLOR)
 
     # Plot the figure
-    plot(fig)
+    if show:
+        offline.plot(fig)
     # Export to HTML
-    fig.write_html("plots/combined_ie_map.html", include_plotlyjs="cdn")
+    write_html(fig, "plots/combined_ie_map.html")
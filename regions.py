@@ -0,0 +1,341 @@
+"""
+@file regions.py
+
+The data structures & functions in this file are used for rolling the yearly imports & exports of every country up to
+groupings of countries: the subregions & regions of Regions.csv, the blocs of BLOC_DICT (NATO...) and the world. The
+sums of every group, year & weapon category are computed once per set of inputs & kept in the timelapse cache, so that
+regional totals & maps read precomputed cells instead of aggregating the deals again.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import countries
+import db_ops
+import deal_store
+import instrumentation
+import sipri_info as si
+import timelapse_cache
+import timelapse_query
+
+REGIONS_FILE = "Regions.csv"
+"""
+CSV file placing every country of ENTITY_DICT in a subregion & a region (SIPRI's regional breakdown).
+"""
+
+LEVELS = ["country", "subregion", "region", "bloc", "world"]
+"""
+Levels of the rollup. Each country is in one group of the "country", "subregion", "region" & "world" levels, which nest
+in that order; blocs may overlap and their members change over the years.
+"""
+
+WORLD = "World"
+"""
+Name of the single group of the "world" level.
+"""
+
+NOT_MEMBER = np.iinfo(np.int64).max
+"""
+Year from which a country counts towards a group it is not a member of, i.e. never.
+"""
+
+ROLLUP_VERSION = 1
+"""
+Version of the layout of the rollup cube files, part of their cache key; bump it whenever that layout changes.
+"""
+
+
+class RegionHierarchy:
+    """
+    Groups of every level of LEVELS, with countries numbered as in countries.COUNTRIES. "groups" maps each level to
+    the names of its groups and "since" to a group x country array of the year from which each country counts
+    towards each group: 0 (always) for the members of a nested level, the year joined for the members of a bloc and
+    NOT_MEMBER otherwise.
+    """
+
+    def __init__(self, regions_df=None, blocs=si.BLOC_DICT):
+        """
+        :param pd.DataFrame regions_df: Subregion & region of the countries, laid out like Regions.csv (default read
+            from REGIONS_FILE); countries without a row are only in the "country" & "world" levels
+        :param dict blocs: Blocs mapped to the ISO codes of their members & the year each one joined (default
+            BLOC_DICT)
+        """
+        table = countries.COUNTRIES
+        if regions_df is None:
+            regions_df = pd.read_csv(REGIONS_FILE)
+        ids = table.ids(regions_df["ISO Code"])
+        regions_df = regions_df[ids >= 0]
+        ids = ids[ids >= 0]
+
+        self.groups = {"country": list(table.names)}
+        self.since = {"country": np.where(np.eye(len(table), dtype=bool), 0, NOT_MEMBER)}
+
+        for level, col in (("subregion", "Subregion"), ("region", "Region")):
+            codes, names = pd.factorize(regions_df[col], sort=True)
+            self.groups[level] = list(names)
+            self.since[level] = np.full((len(names), len(table)), NOT_MEMBER, dtype=np.int64)
+            self.since[level][codes, ids] = 0
+
+        self.groups["bloc"] = list(blocs)
+        self.since["bloc"] = np.full((len(blocs), len(table)), NOT_MEMBER, dtype=np.int64)
+        for i, members in enumerate(blocs.values()):
+            member_ids = table.ids(list(members))
+            joined = np.array(list(members.values()), dtype=np.int64)
+            self.since["bloc"][i, member_ids[member_ids >= 0]] = joined[member_ids >= 0]
+
+        self.groups["world"] = [WORLD]
+        self.since["world"] = np.zeros((1, len(table)), dtype=np.int64)
+
+    def members(self, level, group, year=None) -> list:
+        """
+        Lists the countries of a group.
+
+        :param str level: One of LEVELS
+        :param str group: Name of the group
+        :param int year: Year of the membership (default any year)
+        :return: Names of the countries, in the order of countries.COUNTRIES
+        """
+        since = self.since[level][self.groups[level].index(group)]
+        member = since != NOT_MEMBER if year is None else since <= year
+        return countries.COUNTRIES.names[member].tolist()
+
+    def group_ids(self, level, years) -> np.ndarray:
+        """
+        Finds the group of every country in some years; a country in several blocs is placed in the first one.
+
+        :param str level: One of LEVELS
+        :param years: Array of years
+        :return: Country x year array of group numbers (positions in groups[level]), -1 where the country is in none
+        """
+        member = self.since[level][:, :, None] <= np.asarray(years)[None, None, :]
+        return np.where(member.any(axis=0), member.argmax(axis=0), -1)
+
+
+class RollupCube:
+    """
+    Yearly sums of each of db_ops.MEASURES for every group of every level of a RegionHierarchy, as group x year x wcat
+    arrays ("yearly"[measure][level]) whose last weapon category is "All", along with their running totals ("cum",
+    with a leading year of zeros as in timelapse_query.TimelapseQuery). A country's deals only count towards a bloc from
+    the year it joined.
+    """
+
+    def __init__(self, arrays, hierarchy=None):
+        """
+        :param dict arrays: Arrays built by build_rollup_cube
+        :param RegionHierarchy hierarchy: Groups the arrays were rolled up to (default RegionHierarchy())
+        """
+        self.arrays = arrays
+        self.hierarchy = RegionHierarchy() if hierarchy is None else hierarchy
+        self.years = arrays["years"]
+        self.first_year = int(self.years[0]) if len(self.years) else 0
+        self.last_year = self.first_year + len(self.years) - 1
+        self.wcats = [str(wcat) for wcat in arrays["wcats"]]
+        self.measures = [str(measure) for measure in arrays["measures"]]
+        self.yearly = {measure: {level: arrays["yearly_" + measure + "_" + level] for level in LEVELS}
+                       for measure in self.measures}
+        self.cum = {measure: {level: arrays["cum_" + measure + "_" + level] for level in LEVELS}
+                    for measure in self.measures}
+
+    def _cum_columns(self, years) -> np.ndarray:
+        """
+        Gets the columns of "cum" holding the running totals up to the end of some years.
+
+        :param years: Year or array of years
+        :return: Column or array of columns; see timelapse_query.cum_columns
+        """
+        return timelapse_query.cum_columns(years, self.first_year, self.last_year)
+
+    def cell(self, level, group, year, wcat="All", measure="nrdel"):
+        """
+        Gets the sum of a group, year & weapon category.
+
+        :param str level: One of LEVELS
+        :param str group: Name of the group
+        :param int year: Year
+        :param str wcat: Weapon category, or "All" (default "All")
+        :param str measure: One of db_ops.MEASURES (default "nrdel")
+        :return: The sum, 0 for years without data
+        """
+        if not self.first_year <= year <= self.last_year:
+            return 0
+        return self.yearly[measure][level][self.hierarchy.groups[level].index(group), year - self.first_year,
+                                           self.wcats.index(wcat)]
+
+    def window(self, level, start_year, end_year, measure="nrdel") -> np.ndarray:
+        """
+        Sums a measure for every group of a level & weapon category over a window of years.
+
+        :param str level: One of LEVELS
+        :param int start_year: First year of the window
+        :param int end_year: Last year of the window (inclusive)
+        :param str measure: One of db_ops.MEASURES (default "nrdel")
+        :return: Group x wcat array, in the order of hierarchy.groups[level] & "wcats"
+        """
+        cum = self.cum[measure][level]
+        return cum[:, self._cum_columns(end_year)] - cum[:, self._cum_columns(start_year - 1)]
+
+    def window_df(self, level, start_year, end_year, measure="nrdel") -> pd.DataFrame:
+        """
+        Sums a measure for every group of a level over a window of years.
+
+        :param str level: One of LEVELS
+        :param int start_year: First year of the window
+        :param int end_year: Last year of the window (inclusive)
+        :param str measure: One of db_ops.MEASURES (default "nrdel")
+        :return: DataFrame indexed by group name with one column per weapon category & "All"
+        """
+        return pd.DataFrame(self.window(level, start_year, end_year, measure),
+                            index=pd.Index(self.hierarchy.groups[level], name=level), columns=self.wcats)
+
+    def tl_map_df(self, level, start_year=None, end_year=None, measure="nrdel") -> pd.DataFrame:
+        """
+        Builds a timelapse DataFrame in which every country shows the running totals of its group since start_year:
+        each country has a row for every year of the window from the first one its group has deals in, while it is in
+        a group. "sipri_name" holds the name of the group, so that maps show it on hover.
+
+        :param str level: One of LEVELS
+        :param int start_year: First year of the window (default the first year with data)
+        :param int end_year: Last year of the window (default the last year with data)
+        :param str measure: One of db_ops.MEASURES (default "nrdel")
+        :return: Map DataFrame for map_drawing.build_tl_figure, with the weapon category & "All" columns of measure
+            (named as in db_ops.measure_column), in (country, year) order
+        """
+        start_year = self.first_year if start_year is None else start_year
+        end_year = self.last_year if end_year is None else end_year
+        years = np.arange(start_year, end_year + 1)
+
+        cum = self.cum[measure][level]
+        group = self.hierarchy.group_ids(level, years)
+        totals = cum[:, self._cum_columns(years)] - cum[:, self._cum_columns(start_year - 1)][:, None]
+        country, position = np.nonzero((group >= 0) & (totals[np.maximum(group, 0), np.arange(len(years)), -1] > 0))
+        cells = totals[group[country, position], position]
+
+        tl_map_df = pd.DataFrame({
+            "sipri_name": np.array(self.hierarchy.groups[level], dtype=object)[group[country, position]],
+            "sipri_alpha": countries.COUNTRIES.sipri[country],
+            "iso_alpha": countries.COUNTRIES.iso[country],
+            "odat": years[position]
+        })
+        tl_map_df[[db_ops.measure_column(wcat, measure) for wcat in self.wcats]] = cells
+        return tl_map_df
+
+
+def build_rollup_cube(query, hierarchy=None, starting_year=None, ending_year=None) -> RollupCube:
+    """
+    Rolls the yearly counts of every country up to every group of every level.
+
+    :param timelapse_query.TimelapseQuery query: Yearly counts of every country
+    :param RegionHierarchy hierarchy: Groups to roll the counts up to (default RegionHierarchy())
+    :param int starting_year: First year of the cube, from which its running totals start (default the first year with
+        data)
+    :param int ending_year: Last year of the cube; later deals are left out (default the last year with data)
+    :return: Rollup cube
+    """
+    hierarchy = RegionHierarchy() if hierarchy is None else hierarchy
+    years = np.arange(query.first_year if starting_year is None else starting_year,
+                      (query.last_year if ending_year is None else ending_year) + 1)
+    columns = years - query.first_year
+    in_query = (columns >= 0) & (columns <= query.last_year - query.first_year)
+
+    arrays = {
+        "years": years,
+        "wcats": np.array(query.wcats + ["All"]),
+        "measures": np.array(query.measures)
+    }
+    with instrumentation.stage("rollup", years=len(years)):
+        for measure in query.measures:
+            country_yearly = np.zeros((len(query.names), len(years), len(query.wcats) + 1),
+                                      dtype=query.yearly[measure].dtype)
+            country_yearly[:, in_query, :-1] = query.yearly[measure][:, columns[in_query]]
+            country_yearly[:, :, -1] = country_yearly[:, :, :-1].sum(axis=2)
+            for level in LEVELS:
+                sums = _group_sums(hierarchy.since[level], country_yearly, years)
+                arrays["yearly_" + measure + "_" + level] = sums
+                arrays["cum_" + measure + "_" + level] = timelapse_query.prefix_sums(sums)
+
+    return RollupCube(arrays, hierarchy)
+
+
+def _group_sums(since, country_yearly, years) -> np.ndarray:
+    """
+    Sums the yearly counts of the members of every group of a level.
+
+    :param np.ndarray since: Group x country array of the years from which the countries count towards the groups
+    :param np.ndarray country_yearly: Country x year x wcat array of yearly counts
+    :param np.ndarray years: Years of the second axis of country_yearly
+    :return: Group x year x wcat array
+    """
+    n_countries, n_years, n_wcats = country_yearly.shape
+    joined = since[since != NOT_MEMBER]
+    if not len(years) or not len(joined) or joined.max() <= years[0]:
+        # Members count in every year: a single group x country product
+        membership = (since != NOT_MEMBER).astype(country_yearly.dtype)
+        return (membership @ country_yearly.reshape(n_countries, -1)).reshape(len(since), n_years, n_wcats)
+
+    membership = (since[:, :, None] <= years[None, None, :]).astype(country_yearly.dtype)
+    return np.einsum("gcy,cyw->gyw", membership, country_yearly)
+
+
+def cube_key(is_import, starting_year=1992, ending_year=None) -> str:
+    """
+    Computes the cache key of a rollup cube from the cache key of the timelapse with the same years
+    (timelapse_cache.cache_key), the contents of REGIONS_FILE & BLOC_DICT and the version of the rollup code.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: First year of the cube (default 1992)
+    :param int ending_year: Last year of the cube (default db_ops.default_ending_year())
+    :return: SHA-256 hex digest
+    """
+    with open(REGIONS_FILE, "rb") as regions_file:
+        regions_hash = hashlib.sha256(regions_file.read()).hexdigest()
+    key_data = {
+        "version": ROLLUP_VERSION,
+        "timelapse": timelapse_cache.cache_key(is_import, starting_year, ending_year),
+        "regions": regions_hash,
+        "blocs": si.BLOC_DICT,
+        "levels": LEVELS
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+_loaded_cubes = {}
+"""
+Cubes loaded or built by load_rollup_cube, by the path of their file.
+"""
+
+
+def load_rollup_cube(is_import, starting_year=1992, ending_year=None) -> RollupCube:
+    """
+    Gets the rollup cube of the years of a timelapse from the timelapse cache, building & caching it if its inputs
+    changed. Like the timelapse files, the cube files are evicted by timelapse_cache.evict.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: First year of the cube, from which its running totals start (default 1992)
+    :param int ending_year: Last year of the cube (default db_ops.default_ending_year())
+    :return: Rollup cube
+    """
+    ending_year = db_ops.default_ending_year() if ending_year is None else ending_year
+    path = os.path.join(timelapse_cache.CACHE_DIR,
+                        "rollup_" + cube_key(is_import, starting_year, ending_year) + ".npz")
+
+    if path not in _loaded_cubes:
+        if os.path.exists(path):
+            os.utime(path)
+            _loaded_cubes[path] = RollupCube(deal_store.load_npz_mmap(path))
+        else:
+            cube = build_rollup_cube(timelapse_query.load_timelapse_query(is_import), starting_year=starting_year,
+                                     ending_year=ending_year)
+            os.makedirs(timelapse_cache.CACHE_DIR, exist_ok=True)
+            deal_store.save_npz(path, cube.arrays)
+            timelapse_cache.evict(keep=[path])
+            _loaded_cubes[path] = cube
+
+    return _loaded_cubes[path]
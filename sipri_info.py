@@ -236,6 +236,17 @@ alpha-3 code.
 # List of SIPRI codes. Deprecated because it already can be derived from ENTITY_DICT.
 # """
 
+FIRST_YEAR: int = 1950
+"""
+First year of the SIPRI queries.
+"""
+
+LAST_YEAR: int = 2020
+"""
+Default last year of the SIPRI queries & of the timelapse maps; later years can be added with an incremental update
+(see main.py --append).
+"""
+
 CSV_HEADER: str = "tidn,buyercod,sellercod,odat,odai,onum,onai,ldat,term,desig2,wcat,desc,coprod,nrdel,nrdelai," \
                   "delyears,buyer,seller,status,tivunit,tivorder,tivdel "
 """
@@ -258,3 +269,29 @@ WCATS_DICT = {
 """
 Dictionary that maps SIPRI weapon categories to their descriptions.
 """
+
+MEASURES: List[str] = ["nrdel", "tivorder", "tivdel"]
+"""
+Deal columns summed by the timelapse operations (db_ops): delivered units, TIV (SIPRI trend-indicator value) of the
+orders & delivered TIV. The timelapse columns of "nrdel" have plain names ("AC", ..., "All"); those of the other
+measures end with the measure ("AC_tivdel", ..., "All_tivdel").
+"""
+
+METRICS: List[str] = ["yearly", "rolling_3", "rolling_5", "yoy_change", "yoy_pct", "share"]
+"""
+Metrics derived from the running totals ("All") of each measure: deliveries of the year, sums over the last 3 & 5
+years, change on the previous year (absolute & relative) and share of the year's world total. Named like the
+timelapse columns, e.g. "rolling_3" for "nrdel" and "rolling_3_tivdel" for "tivdel".
+"""
+
+BLOC_DICT: Dict[str, Dict[str, int]] = {
+    "NATO": {"BEL": 1949, "CAN": 1949, "DNK": 1949, "FRA": 1949, "ISL": 1949, "ITA": 1949, "LUX": 1949, "NLD": 1949,
+             "NOR": 1949, "PRT": 1949, "GBR": 1949, "USA": 1949, "GRC": 1952, "TUR": 1952, "DEU": 1955, "ESP": 1982,
+             "CZE": 1999, "HUN": 1999, "POL": 1999, "BGR": 2004, "EST": 2004, "LVA": 2004, "LTU": 2004, "ROU": 2004,
+             "SVK": 2004, "SVN": 2004, "ALB": 2009, "HRV": 2009, "MNE": 2017, "MKD": 2020},
+    "Gulf Cooperation Council": {"BHR": 1981, "KWT": 1981, "OMN": 1981, "QAT": 1981, "SAU": 1981, "ARE": 1981}
+}
+"""
+Dictionary that maps groupings of countries that cut across the regions of Regions.csv to the ISO codes of their
+members & the year each one joined. A member's deals count towards its bloc from that year on.
+"""
@@ -0,0 +1,213 @@
+"""
+@file static_export.py
+
+The functions in this file are used for exporting the maps as static images, rendered offline with Kaleido: one image
+per year of the timelapse maps, assembled into an animated GIF or MP4, and one image of each static map. Images whose
+figure has not changed since the last export are not rendered again.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+import map_drawing
+from lazy_import import lazy_module
+
+pio = lazy_module("plotly.io")
+plotly_utils = lazy_module("plotly.utils")
+db_ops = lazy_module("db_ops")
+
+STATIC_DIR = "plots/static"
+"""
+Folder holding the static images & animations.
+"""
+
+IMAGE_FORMATS = ["png", "webp", "jpeg"]
+"""
+Formats of the exported images.
+"""
+
+ANIMATION_FORMATS = ["gif", "mp4"]
+"""
+Formats of the animations assembled from the images of each year.
+"""
+
+HASHES_FILE = "hashes.json"
+"""
+File of the export folder holding the hash of the figure each image was rendered from.
+"""
+
+
+def frame_figures(fig) -> dict:
+    """
+    Splits an animated figure built by map_drawing.build_tl_figure into one static figure per frame.
+
+    :param go.Figure fig: Animated figure
+    :return: Names of the frames (years) mapped to their figures, as dictionaries
+    """
+    base = fig.to_plotly_json()
+    layout = {key: value for key, value in base["layout"].items() if key not in ("sliders", "updatemenus")}
+    title = layout.get("title", {}).get("text", "")
+
+    figures = {}
+    for frame in base["frames"]:
+        data = [dict(trace, **frame_trace) for trace, frame_trace in zip(base["data"], frame["data"])]
+        figures[frame["name"]] = {"data": data, "layout": dict(layout, title={"text": title + " - " + frame["name"]})}
+    return figures
+
+
+def figure_hash(fig_dict, image_format, width, height) -> str:
+    """
+    Hashes a figure & the options it is rendered with.
+
+    :param dict fig_dict: Figure, as a dictionary
+    :param str image_format: One of IMAGE_FORMATS
+    :param int width: Width of the image in pixels
+    :param int height: Height of the image in pixels
+    :return: SHA-1 hex digest
+    """
+    content = json.dumps([fig_dict, image_format, width, height], cls=plotly_utils.PlotlyJSONEncoder, sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def _render_images(jobs, image_format, width, height) -> int:
+    """
+    Renders figures to image files in one Kaleido session, so that its browser is started once per worker process.
+
+    :param list jobs: Tuples of a figure (as a dictionary) & the path of its image
+    :param str image_format: One of IMAGE_FORMATS
+    :param int width: Width of the images in pixels
+    :param int height: Height of the images in pixels
+    :return: Number of images rendered
+    """
+    with instrumentation.stage("image_write", images=len(jobs)):
+        pio.write_images([fig_dict for fig_dict, _ in jobs], [path for _, path in jobs],
+                         format=image_format, width=width, height=height)
+    return len(jobs)
+
+
+def export_images(figures, out_dir, image_format="png", width=1200, height=700, workers=4, keep_existing=False) -> list:
+    """
+    Renders figures to images in a pool of worker processes, skipping those whose image is already up to date.
+
+    :param dict figures: Names of the images mapped to their figures, as dictionaries
+    :param str out_dir: Folder of the images
+    :param str image_format: One of IMAGE_FORMATS (default "png")
+    :param int width: Width of the images in pixels (default 1200)
+    :param int height: Height of the images in pixels (default 700)
+    :param int workers: Worker processes (default 4)
+    :param boolean keep_existing: True to skip every figure that already has an image, even if the figure changed,
+        e.g. to only render the years added to a timelapse (default False)
+    :return: Paths of the images, in the order of figures
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    hashes_path = os.path.join(out_dir, HASHES_FILE)
+    old_hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path) as hashes_file:
+            old_hashes = json.load(hashes_file)
+
+    # Only the images rendered now get their figure's hash: a skipped image keeps the hash of the figure it shows
+    paths, hashes, jobs = [], {}, []
+    for name, fig_dict in figures.items():
+        path = os.path.join(out_dir, name + "." + image_format)
+        paths.append(path)
+        fig_hash = figure_hash(fig_dict, image_format, width, height)
+        if not os.path.exists(path) or (not keep_existing and old_hashes.get(os.path.basename(path)) != fig_hash):
+            hashes[os.path.basename(path)] = fig_hash
+            jobs.append((fig_dict, path))
+
+    print(str(len(jobs)) + " of " + str(len(figures)) + " images of \"" + out_dir + "\" changed")
+
+    if jobs:
+        # Each worker renders a contiguous share of the images in a single Kaleido session
+        n_chunks = max(1, min(workers, len(jobs)))
+        chunks = [jobs[i * len(jobs) // n_chunks:(i + 1) * len(jobs) // n_chunks] for i in range(n_chunks)]
+        with ProcessPoolExecutor(max_workers=n_chunks) as executor:
+            futures = [executor.submit(instrumentation.traced_call, _render_images, chunk, image_format, width, height)
+                       for chunk in chunks]
+            for future in futures:
+                instrumentation.merge(future.result())
+
+    with open(hashes_path, "w") as hashes_file:
+        json.dump(dict(old_hashes, **hashes), hashes_file, indent=1)
+
+    return paths
+
+
+def assemble_animation(image_paths, out_path, fps=2):
+    """
+    Assembles images of the same size into an animated GIF or MP4 (with imageio's FFmpeg plugin).
+
+    :param list image_paths: Paths of the images, in order
+    :param str out_path: Path of the animation; its extension, one of ANIMATION_FORMATS, gives its format
+    :param int fps: Frames per second (default 2)
+    :return: None, but creates the animation file
+    """
+    # Only needed for animations, so the images can be exported without imageio
+    import imageio.v3 as iio
+
+    frames = [iio.imread(path) for path in image_paths]
+    if out_path.endswith(".gif"):
+        iio.imwrite(out_path, frames, duration=1000 / fps, loop=0)
+    else:
+        iio.imwrite(out_path, frames, fps=fps)
+
+
+def export_tl_map(tl_map_df, is_import, year_window=None, measure="nrdel", metric="All", image_format="png",
+                  animation="gif", out_dir=STATIC_DIR, workers=4, new_frames_only=False) -> str:
+    """
+    Exports every year of the "imports/exports over time" map as an image, plus an animation of them.
+
+    :param tl_map_df: Map DataFrame or timelapse_query.TimelapseQuery, as for map_drawing.draw_tl_map
+    :param boolean is_import: True is data is imports, False if exports
+    :param tuple year_window: First & last year to draw (default the years of tl_map_df)
+    :param str measure: One of db_ops.MEASURES (default "nrdel")
+    :param str metric: "All" or one of db_ops.METRICS (default "All")
+    :param str image_format: One of IMAGE_FORMATS (default "png")
+    :param str animation: One of ANIMATION_FORMATS, or None for the images only (default "gif")
+    :param str out_dir: Folder to export into (default STATIC_DIR)
+    :param int workers: Worker processes (default 4)
+    :param boolean new_frames_only: True to only render the years without an image yet, keeping the images of the
+        other years even though their color scale may have changed, e.g. after db_ops.append_db_timelapse_years
+        (default False)
+    :return: Path of the animation, or of the folder of the images if there is none
+    """
+    fig, file_name = map_drawing.build_tl_map(tl_map_df, is_import, year_window, measure, metric)
+    name = os.path.basename(file_name)[:-len(".html")]
+    image_dir = os.path.join(out_dir, name)
+
+    image_paths = export_images(frame_figures(fig), image_dir, image_format, workers=workers,
+                                keep_existing=new_frames_only)
+    if animation is None or not image_paths:
+        return image_dir
+
+    # Only assemble the animation again if an image is newer than it
+    out_path = os.path.join(out_dir, name + "." + animation)
+    if not os.path.exists(out_path) or max(map(os.path.getmtime, image_paths)) > os.path.getmtime(out_path):
+        assemble_animation(image_paths, out_path)
+    return out_path
+
+
+def export_static_maps(names=("transparency", "stockpiles"), image_format="png", out_dir=STATIC_DIR) -> list:
+    """
+    Exports the transparency and/or stockpiles maps as images.
+
+    :param names: Maps to export, "transparency" and/or "stockpiles" (default both)
+    :param str image_format: One of IMAGE_FORMATS (default "png")
+    :param str out_dir: Folder to export into (default STATIC_DIR)
+    :return: Paths of the images
+    """
+    figures = {}
+    if "transparency" in names:
+        figures["transparency_map"] = map_drawing.build_transparency_figure(db_ops.load_transparency_df())
+    if "stockpiles" in names:
+        figures["stockpiles_map"] = map_drawing.build_stockpiles_figure(db_ops.load_stockpiles_df())
+    return export_images({name: fig.to_plotly_json() for name, fig in figures.items()}, out_dir, image_format,
+                         workers=len(figures))
@@ -0,0 +1,148 @@
+"""
+@file timelapse_cache.py
+
+The functions in this file are used for caching the timelapse DataFrames under a key derived from everything they are
+built from, so that they are rebuilt exactly when one of their inputs changes.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import data_manifest as dm
+import db_ops
+import sipri_info as si
+
+CACHE_DIR = "data/tl_cache"
+"""
+Folder holding the cached timelapse CSV files, the rollup cubes of regions.load_rollup_cube & the hit/miss statistics.
+"""
+
+MAX_ENTRIES = 8
+"""
+Number of cached timelapse CSV files & rollup cubes kept before the least recently used ones are evicted.
+"""
+
+MAX_BYTES = 64 * 2 ** 20
+"""
+Total size of the cached timelapse CSV files & rollup cubes kept before the least recently used ones are evicted.
+"""
+
+
+def cache_key(is_import, starting_year=1992, ending_year=None) -> str:
+    """
+    Computes the cache key of a timelapse DataFrame from the buyer/seller files of every country, the starting & ending
+    years, the contents of ENTITY_DICT & WCATS_DICT and the version of the timelapse code.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param int ending_year: Last year of the timelapse (default db_ops.default_ending_year())
+    :return: SHA-256 hex digest
+    """
+    ending_year = db_ops.default_ending_year() if ending_year is None else ending_year
+    manifest = dm.load_manifest()
+    key_data = {
+        "version": db_ops.TIMELAPSE_VERSION,
+        "is_import": is_import,
+        "starting_year": starting_year,
+        "ending_year": ending_year,
+        "entities": si.ENTITY_DICT,
+        "wcats": si.WCATS_DICT,
+        "inputs": {dm.file_key(si.ENTITY_DICT[key][0], not is_buyer): file_hash
+                   for is_buyer in (True, False) for key, file_hash in db_ops.input_hashes(manifest, is_buyer).items()}
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def load_tl_map_dfs(starting_year=1992, ending_year=None, workers=1):
+    """
+    Loads the import & export timelapse DataFrames from the cache, rebuilding & caching them if their inputs changed.
+
+    :param int starting_year: Beginning year of the timelapse (default 1992)
+    :param int ending_year: Last year of the timelapse (default db_ops.default_ending_year())
+    :param int workers: Number of worker processes reading the countries on a miss (default 1); see
+        db_ops.gather_yearly_counts
+    :return: Tuple of the import & export map DataFrames
+    """
+    ending_year = db_ops.default_ending_year() if ending_year is None else ending_year
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    stats = _load_stats()
+    paths = [os.path.join(CACHE_DIR, cache_key(is_import, starting_year, ending_year) + ".csv")
+             for is_import in (True, False)]
+
+    if all(os.path.exists(path) for path in paths):
+        stats["hits"] += 1
+        for path in paths:
+            # Touching the file marks it as recently used
+            os.utime(path)
+        tl_map_dfs = tuple(db_ops.read_tl_map_csv(path) for path in paths)
+        print("Timelapse cache hit")
+    else:
+        stats["misses"] += 1
+        print("Timelapse cache miss; rebuilding")
+        tl_map_dfs = db_ops.update_db_timelapse_ops_both(starting_year, ending_year, workers)
+        for is_import, path in zip((True, False), paths):
+            shutil.copyfile(db_ops.tl_file(is_import, "df.csv"), path)
+        stats["evictions"] += evict(keep=paths)
+
+    _save_stats(stats)
+    print("Timelapse cache: {hits} hits, {misses} misses, {evictions} evictions".format(**stats))
+
+    return tl_map_dfs
+
+
+def evict(keep=(), max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES) -> int:
+    """
+    Deletes the least recently used cached files until both the entry & size limits are met.
+
+    :param keep: Paths that must not be deleted
+    :param int max_entries: Maximum number of cached files
+    :param int max_bytes: Maximum total size of the cached files
+    :return: Number of deleted files
+    """
+    entries = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR)
+               if name.endswith((".csv", ".npz")) and not name.endswith(".tmp.npz")]
+    entries.sort(key=os.path.getmtime)
+    total_bytes = sum(os.path.getsize(path) for path in entries)
+
+    evicted = 0
+    for path in entries:
+        if len(entries) - evicted <= max_entries and total_bytes <= max_bytes:
+            break
+        if path in keep:
+            continue
+        total_bytes -= os.path.getsize(path)
+        os.remove(path)
+        evicted += 1
+
+    return evicted
+
+
+def _load_stats() -> dict:
+    """
+    Loads the hit/miss statistics of the cache.
+
+    :return: Dictionary with "hits", "misses" & "evictions" counts
+    """
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+    path = os.path.join(CACHE_DIR, "stats.json")
+    if os.path.exists(path):
+        with open(path) as stats_file:
+            stats.update(json.load(stats_file))
+    return stats
+
+
+def _save_stats(stats):
+    """
+    Saves the hit/miss statistics of the cache.
+
+    :param dict stats: Dictionary with "hits", "misses" & "evictions" counts
+    :return: None
+    """
+    with open(os.path.join(CACHE_DIR, "stats.json"), "w") as stats_file:
+        json.dump(stats, stats_file)
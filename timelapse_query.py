@@ -0,0 +1,177 @@
+"""
+@file timelapse_query.py
+
+The functions in this file are used for answering year-window questions over the yearly import/export counts
+("deliveries between 2005 and 2012", "the timelapse map starting in 1970") straight from running totals, without
+rebuilding the timelapse DataFrames.
+
+@author Victor Mercola
+@author Benjamin Lunden
+@author Jack Ayvazian
+"""
+
+import numpy as np
+import pandas as pd
+
+import db_ops
+import deal_store
+import sipri_info as si
+
+
+def prefix_sums(yearly) -> np.ndarray:
+    """
+    Computes the running totals of yearly sums over their year axis (the second one), with a leading year of zeros, so
+    that the sums over any window of years are one subtraction of two columns; see cum_columns.
+
+    :param np.ndarray yearly: Array of yearly sums, with the years on its second axis
+    :return: Array of the same type, one year longer on its second axis
+    """
+    cum = np.zeros((yearly.shape[0], yearly.shape[1] + 1) + yearly.shape[2:], dtype=yearly.dtype)
+    np.cumsum(yearly, axis=1, out=cum[:, 1:])
+    return cum
+
+
+def cum_columns(years, first_year, last_year) -> np.ndarray:
+    """
+    Gets the columns of an array built by prefix_sums holding the running totals up to the end of some years.
+
+    :param years: Year or array of years
+    :param int first_year: Year of the first column of the yearly sums
+    :param int last_year: Year of their last column
+    :return: Column or array of columns, clamped to the years with data
+    """
+    return np.clip(np.asarray(years) - first_year + 1, 0, last_year - first_year + 1)
+
+
+class TimelapseQuery:
+    """
+    Yearly sums of each of db_ops.MEASURES for every country of ENTITY_DICT, as dense country x year x wcat arrays,
+    along with their running totals over the years. Each array of "cum" has a leading year of zeros, so the sums over
+    any window of years are cum[measure][:, end] - cum[measure][:, start] for every country at once.
+    """
+
+    def __init__(self, counts_df):
+        """
+        :param pd.DataFrame counts_df: Yearly counts, laid out like db_ops.gather_yearly_counts
+        """
+        self.names = list(si.ENTITY_DICT)
+        self.wcats = list(si.WCATS_DICT) + sorted(set(counts_df["wcat"].astype(str)) - set(si.WCATS_DICT))
+
+        odat = counts_df["odat"].to_numpy(dtype=np.int64)
+        self.first_year = int(odat.min()) if len(odat) else 0
+        self.last_year = int(odat.max()) if len(odat) else -1
+        n_years = self.last_year - self.first_year + 1
+
+        country = counts_df["sipri_name"].astype(str).map({name: i for i, name in enumerate(self.names)})
+        keep = country.notna().to_numpy()
+        country = country.to_numpy()[keep].astype(np.int64)
+        year = odat[keep] - self.first_year
+        wcat = counts_df["wcat"].astype(str).map({wcat: i for i, wcat in enumerate(self.wcats)}).to_numpy()[keep]
+
+        self.measures = [measure for measure in db_ops.MEASURES if measure in counts_df.columns]
+        self.yearly = {}
+        self.cum = {}
+        for measure in self.measures:
+            dtype = np.int64 if measure == "nrdel" else np.float64
+            self.yearly[measure] = np.zeros((len(self.names), n_years, len(self.wcats)), dtype=dtype)
+            np.add.at(self.yearly[measure], (country, year, wcat.astype(np.int64)),
+                      np.nan_to_num(counts_df[measure].to_numpy(dtype=dtype)[keep]))
+            self.cum[measure] = prefix_sums(self.yearly[measure])
+
+        self.present = np.zeros((len(self.names), n_years), dtype=bool)
+        self.present[country, year] = True
+
+    def window(self, start_year, end_year, measure="nrdel") -> np.ndarray:
+        """
+        Sums a measure for every country & weapon category over a window of years.
+
+        :param int start_year: First year of the window
+        :param int end_year: Last year of the window (inclusive)
+        :param str measure: One of db_ops.MEASURES (default "nrdel")
+        :return: Country x wcat array, in the order of "names" & "wcats"
+        """
+        cum = self.cum[measure]
+        return cum[:, cum_columns(end_year, self.first_year, self.last_year)] - \
+            cum[:, cum_columns(start_year - 1, self.first_year, self.last_year)]
+
+    def window_df(self, start_year, end_year, measure="nrdel") -> pd.DataFrame:
+        """
+        Sums a measure for every country over a window of years.
+
+        :param int start_year: First year of the window
+        :param int end_year: Last year of the window (inclusive)
+        :param str measure: One of db_ops.MEASURES (default "nrdel")
+        :return: DataFrame indexed by "sipri_name" with one column per weapon category & "All"
+        """
+        totals_df = pd.DataFrame(self.window(start_year, end_year, measure),
+                                 index=pd.Index(self.names, name="sipri_name"), columns=self.wcats)
+        totals_df["All"] = totals_df.sum(axis=1)
+        return totals_df
+
+    def tl_map_df(self, start_year=None, end_year=None) -> pd.DataFrame:
+        """
+        Builds the timelapse DataFrame of a window of years, as perform_db_timelapse_ops would with that starting year:
+        each country has a row for every year from its first year with deals in the window up to end_year; the weapon
+        category columns hold the sums of the row's year (or of the latest earlier year with deals) and "All" holds
+        the running total since start_year, for each measure (named as in db_ops.measure_column); the derived
+        metrics are computed from those running totals.
+
+        :param int start_year: First year of the window (default the first year with data)
+        :param int end_year: Last year of the window (default the last year with data)
+        :return: Map DataFrame for drawing a timeline choropleth map of imports/exports, typed as in
+            db_ops.TL_MAP_DTYPES, in (country, year) order
+        """
+        start_year = self.first_year if start_year is None else start_year
+        end_year = self.last_year if end_year is None else end_year
+        years = np.arange(start_year, end_year + 1)
+
+        # Map the window onto the stored years; years outside them have no deals
+        stored = years - self.first_year
+        inside = (stored >= 0) & (stored < self.present.shape[1])
+        present = np.zeros((len(self.names), len(years)), dtype=bool)
+        present[:, inside] = self.present[:, stored[inside]]
+
+        country, position, latest = db_ops.carry_forward(present)
+        latest_stored = np.clip(stored[latest], 0, max(self.present.shape[1] - 1, 0))
+        end_columns = cum_columns(years[position], self.first_year, self.last_year)
+        start_column = cum_columns(start_year - 1, self.first_year, self.last_year)
+
+        tl_map_df = pd.DataFrame({
+            "sipri_name": np.array(self.names, dtype=object)[country],
+            "sipri_alpha": np.array([si.ENTITY_DICT[name][0] for name in self.names], dtype=object)[country],
+            "iso_alpha": np.array([si.ENTITY_DICT[name][1] for name in self.names], dtype=object)[country],
+            "odat": years[position]
+        })
+        for measure in self.measures:
+            yearly, cum = self.yearly[measure], self.cum[measure]
+            breakdown = yearly[country, latest_stored] if yearly.size else \
+                np.zeros((len(country), len(self.wcats)), dtype=yearly.dtype)
+            tl_map_df[[db_ops.measure_column(wcat, measure) for wcat in self.wcats]] = breakdown
+            tl_map_df[db_ops.measure_column("All", measure)] = \
+                (cum[country, end_columns] - cum[country, start_column]).sum(axis=1)
+
+        return db_ops.compact_tl_map_df(db_ops.add_derived_metrics(tl_map_df))
+
+
+_loaded_queries = None
+"""
+Import & export queries built by load_timelapse_query, with the deal store they were built from.
+"""
+
+
+def load_timelapse_query(is_import) -> TimelapseQuery:
+    """
+    Gets the query over the yearly counts of every year with data, building the import & export queries in one pass
+    over the deal store the first time and whenever the deal store changes.
+
+    :param boolean is_import: True if data is imports, False if exports
+    :return: Timelapse query
+    """
+    global _loaded_queries
+
+    store = deal_store.load_deal_store()
+    if _loaded_queries is None or _loaded_queries[0] is not store:
+        counts = db_ops.gather_yearly_counts_both(starting_year=0)
+        _loaded_queries = (store, tuple(TimelapseQuery(counts_df) for counts_df in counts))
+
+    return _loaded_queries[1][0 if is_import else 1]